@@ -5,6 +5,41 @@ import os
 
 db = SQLAlchemy()
 
+def migrate():
+    """Create missing tables and add missing nullable columns; safe to run again"""
+    from app.models.image import Image
+
+    db.create_all()
+    columns = {column['name'] for column in db.inspect(db.engine).get_columns(Image.__tablename__)}
+    for column in Image.__table__.columns:
+        if column.name not in columns and column.nullable:
+            column_type = column.type.compile(db.engine.dialect)
+            with db.engine.begin() as conn:
+                conn.execute(db.text(f'ALTER TABLE {Image.__tablename__} ADD COLUMN {column.name} {column_type} NULL'))
+
+def check_schema():
+    """Fail at boot when the images table is behind the model (a deploy that skipped migrate)"""
+    from sqlalchemy import exc
+    from app.models.image import Image
+
+    try:
+        with db.engine.connect() as connection:
+            connection.execute(Image.__table__.select().limit(0))
+        return
+    except exc.DBAPIError as e:
+        error = e
+    try:
+        columns = {column['name'] for column in db.inspect(db.engine).get_columns(Image.__tablename__)}
+    except exc.NoSuchTableError:
+        columns = set()
+    except exc.DBAPIError:
+        # Database unreachable: not a schema problem, requests will retry the connection
+        print(f"Schema check skipped: {error.orig}")
+        return
+    missing = [column.name for column in Image.__table__.columns if column.name not in columns]
+    if missing:
+        raise RuntimeError(f"{Image.__tablename__} table lacks {', '.join(missing)}: run `flask --app run migrate`")
+
 def create_app():
     app = Flask(__name__)
     app.config.from_object('app.config.config.Config')
@@ -18,6 +53,10 @@ def create_app():
         origins = [o.strip() for o in cors_origins.split(',') if o.strip()]
         CORS(app, resources={r"/api/*": {"origins": origins}})
     
+    from app.services.base_storage_service import check_signing_key
+    from app.services.storage_factory import StorageFactory
+    check_signing_key(app, StorageFactory.signs_urls)
+    
     # Register blueprints
     from app.routes.import_routes import import_bp
     from app.routes.image_routes import image_bp
@@ -25,8 +64,16 @@ def create_app():
     app.register_blueprint(import_bp, url_prefix='/api')
     app.register_blueprint(image_bp, url_prefix='/api')
     
-    # Create tables
+    @app.cli.command('migrate')
+    def migrate_command():
+        """Apply the schema to the configured database"""
+        migrate()
+        print(f"Schema is up to date ({db.engine.url.render_as_string(hide_password=True)})")
+    
     with app.app_context():
-        db.create_all()
+        if app.config['DB_AUTO_MIGRATE']:
+            migrate()
+        else:
+            check_schema()
     
     return app
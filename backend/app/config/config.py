@@ -18,7 +18,10 @@ class Config:
     DB_DRIVER = os.getenv('DB_DRIVER', 'ODBC Driver 18 for SQL Server')
     
  
-    if all([DB_SERVER, DB_NAME, DB_USER, DB_PASSWORD]):
+    if os.getenv('DATABASE_URL'):
+        # Any SQLAlchemy URL, e.g. sqlite:////tmp/bench/images.db for benchmarks
+        SQLALCHEMY_DATABASE_URI = os.getenv('DATABASE_URL')
+    elif all([DB_SERVER, DB_NAME, DB_USER, DB_PASSWORD]):
         engine = DB_ENGINE or 'mysql'
 
         if engine == 'mysql':
@@ -49,6 +52,12 @@ class Config:
     else:
         SQLALCHEMY_DATABASE_URI = 'sqlite:///images.db'
     
+    # Schema changes are applied by `flask --app run migrate` once per deploy; only local
+    # SQLite files are created on boot (DB_AUTO_MIGRATE overrides either way)
+    DB_AUTO_MIGRATE = os.getenv(
+        'DB_AUTO_MIGRATE', str(SQLALCHEMY_DATABASE_URI.startswith('sqlite'))
+    ).strip().lower() in {'1', 'true', 'yes', 'on'}
+
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     SQLALCHEMY_ENGINE_OPTIONS = {
         'pool_pre_ping': True,
@@ -56,15 +65,47 @@ class Config:
     }
     
     # Cloud Storage Configuration
-    STORAGE_PROVIDER = os.getenv('STORAGE_PROVIDER', 'aws')  # aws
+    STORAGE_PROVIDER = os.getenv('STORAGE_PROVIDER', 'aws')  # aws, local or memory
+    
+    # Local filesystem storage (STORAGE_PROVIDER=local); files are served from /api/objects/<key>
+    LOCAL_STORAGE_ROOT = os.getenv('LOCAL_STORAGE_ROOT', 'storage')
+    LOCAL_STORAGE_PUBLIC_URL = os.getenv('LOCAL_STORAGE_PUBLIC_URL', '/api/objects')
+    LOCAL_STORAGE_FSYNC = os.getenv('LOCAL_STORAGE_FSYNC', '').strip().lower() in {'1', 'true', 'yes', 'on'}
+    PRESIGNED_URL_TTL = int(os.getenv('PRESIGNED_URL_TTL', 3600))
+    # Local and memory files are served from signed, expiring /api/objects URLs, as by the
+    # storage-service; STORAGE_REQUIRE_SIGNED_URLS=false also serves unsigned requests
+    STORAGE_SIGNING_KEY = os.getenv('STORAGE_SIGNING_KEY', '')
+    STORAGE_REQUIRE_SIGNED_URLS = os.getenv('STORAGE_REQUIRE_SIGNED_URLS', 'true').strip().lower() in {'1', 'true', 'yes', 'on'}
     
     # AWS Configuration
     AWS_ACCESS_KEY_ID = os.getenv('AWS_ACCESS_KEY_ID')
     AWS_SECRET_ACCESS_KEY = os.getenv('AWS_SECRET_ACCESS_KEY')
     AWS_REGION = os.getenv('AWS_REGION', 'us-east-1')
     AWS_BUCKET_NAME = os.getenv('AWS_BUCKET_NAME')
+    # Object key layout: flat (uuid_filename), hashed (ab/cd/uuid_filename)
+    # or date (YYYY/MM/DD/<import_id>/uuid_filename)
+    STORAGE_KEY_LAYOUT = os.getenv('STORAGE_KEY_LAYOUT', 'flat').strip().lower()
+    STORAGE_KEY_PREFIX = os.getenv('STORAGE_KEY_PREFIX', '').strip().strip('/')
+    S3_DELETE_CONCURRENCY = int(os.getenv('S3_DELETE_CONCURRENCY', 8))
     
     # Google Drive API
     GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY')
+    GOOGLE_DRIVE_API_ENDPOINT = os.getenv('GOOGLE_DRIVE_API_ENDPOINT')  # e.g. a fake Drive for benchmarks
+    # Adaptive Drive rate limiting: token bucket + AIMD concurrency, jittered exponential backoff
+    DRIVE_RATE_LIMIT = float(os.getenv('DRIVE_RATE_LIMIT', 10))
+    DRIVE_MIN_RATE = float(os.getenv('DRIVE_MIN_RATE', 1))
+    DRIVE_MAX_RATE = float(os.getenv('DRIVE_MAX_RATE', 100))
+    DRIVE_RATE_INCREASE = float(os.getenv('DRIVE_RATE_INCREASE', 1))
+    DRIVE_CONCURRENCY = int(os.getenv('DRIVE_CONCURRENCY', 8))
+    DRIVE_MIN_CONCURRENCY = int(os.getenv('DRIVE_MIN_CONCURRENCY', 1))
+    DRIVE_MAX_CONCURRENCY = int(os.getenv('DRIVE_MAX_CONCURRENCY', 50))
+    DRIVE_DECREASE_FACTOR = float(os.getenv('DRIVE_DECREASE_FACTOR', 0.5))
+    DRIVE_MAX_RETRIES = int(os.getenv('DRIVE_MAX_RETRIES', 6))
+    DRIVE_BACKOFF_BASE = float(os.getenv('DRIVE_BACKOFF_BASE', 0.5))
+    DRIVE_BACKOFF_MAX = float(os.getenv('DRIVE_BACKOFF_MAX', 32))
+    # Files at least this large are downloaded as parallel HTTP Range requests
+    DRIVE_RANGED_THRESHOLD = int(os.getenv('DRIVE_RANGED_THRESHOLD', 16 * 1024 * 1024))
+    DRIVE_RANGE_SIZE = max(int(os.getenv('DRIVE_RANGE_SIZE', 8 * 1024 * 1024)), 256 * 1024)
+    DRIVE_RANGE_PARALLELISM = max(int(os.getenv('DRIVE_RANGE_PARALLELISM', 4)), 1)
     
     MAX_CONTENT_LENGTH = 100 * 1024 * 1024  
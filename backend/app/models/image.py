@@ -10,9 +10,26 @@ class Image(db.Model):
     size = db.Column(db.BigInteger, nullable=False)
     mime_type = db.Column(db.String(100), nullable=False)
     storage_path = db.Column(db.String(500), nullable=False)
+    # Real object key in the bucket; NULL for rows written before keys were stored
+    storage_key = db.Column(db.String(1024), nullable=True)
     storage_provider = db.Column(db.String(20), nullable=False)  # e.g. 'aws'
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
+    @property
+    def object_key(self):
+        """Stored object key, falling back to the flat layout used before keys were stored"""
+        return self.storage_key or self.storage_path.split('/')[-1]
+    
+    @property
+    def download_url(self):
+        """storage_path, signed for files the app serves itself from /api/objects"""
+        from app.services.base_storage_service import sign_object_url
+        from app.services.storage_factory import StorageFactory
+        
+        if StorageFactory.signs_urls(self.storage_provider):
+            return sign_object_url(self.object_key)
+        return self.storage_path
+    
     def to_dict(self):
         return {
             'id': self.id,
@@ -20,7 +37,8 @@ class Image(db.Model):
             'google_drive_id': self.google_drive_id,
             'size': self.size,
             'mime_type': self.mime_type,
-            'storage_path': self.storage_path,
+            'storage_path': self.download_url,
+            'storage_key': self.storage_key,
             'storage_provider': self.storage_provider,
             'created_at': self.created_at.isoformat() if self.created_at else None
         }
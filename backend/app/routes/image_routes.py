@@ -1,6 +1,10 @@
-﻿from flask import Blueprint, request, jsonify
+﻿from flask import Blueprint, current_app, request, jsonify
 from app.models.image import Image
 from app import db
+from datetime import datetime
+
+# Rows are resolved and deleted in chunks to stay below driver bind-parameter limits
+BULK_DELETE_CHUNK_SIZE = 500
 
 image_bp = Blueprint('images', __name__)
 
@@ -86,7 +90,7 @@ def delete_image(image_id):
         # Delete from cloud storage
         from app.services.storage_factory import StorageFactory
         storage_service = StorageFactory.get_storage_service()
-        storage_service.delete_file(image.storage_path)
+        storage_service.delete_file(image.object_key)
         
         # Delete from database
         db.session.delete(image)
@@ -98,6 +102,112 @@ def delete_image(image_id):
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
+@image_bp.route('/images/bulk-delete', methods=['POST'])
+def bulk_delete_images():
+    """
+    Delete many images by id or by filter.
+    Storage objects are removed first with batched DeleteObjects calls, then the
+    rows whose objects are gone are deleted in a single transaction.
+    """
+    try:
+        data = request.get_json() or {}
+        ids = data.get('ids')
+        filters = data.get('filter')
+        
+        if ids:
+            ids = list(dict.fromkeys(int(image_id) for image_id in ids))
+            rows = []
+            for i in range(0, len(ids), BULK_DELETE_CHUNK_SIZE):
+                rows.extend(
+                    Image.query
+                    .filter(Image.id.in_(ids[i:i + BULK_DELETE_CHUNK_SIZE]))
+                    .all()
+                )
+        elif filters:
+            criteria = []
+            if filters.get('storage_provider'):
+                criteria.append(Image.storage_provider == filters['storage_provider'])
+            if filters.get('created_before'):
+                criteria.append(Image.created_at < datetime.fromisoformat(filters['created_before']))
+            if filters.get('created_after'):
+                criteria.append(Image.created_at >= datetime.fromisoformat(filters['created_after']))
+            if filters.get('name_contains'):
+                criteria.append(Image.name.contains(filters['name_contains']))
+            if not criteria:
+                return jsonify({'error': 'filter must contain at least one supported field'}), 400
+            
+            rows = Image.query.filter(*criteria).all()
+            ids = [image.id for image in rows]
+        else:
+            return jsonify({'error': 'ids or filter is required'}), 400
+        
+        # Delete from cloud storage
+        from app.services.storage_factory import StorageFactory
+        storage_service = StorageFactory.get_storage_service()
+        key_errors = storage_service.delete_files([image.object_key for image in rows])
+        
+        found_ids = {image.id for image in rows}
+        storage_errors = {
+            image.id: key_errors[image.object_key]
+            for image in rows
+            if image.object_key in key_errors
+        }
+        deletable_ids = [image_id for image_id in found_ids if image_id not in storage_errors]
+        
+        # Delete from database
+        for i in range(0, len(deletable_ids), BULK_DELETE_CHUNK_SIZE):
+            Image.query.filter(
+                Image.id.in_(deletable_ids[i:i + BULK_DELETE_CHUNK_SIZE])
+            ).delete(synchronize_session=False)
+        db.session.commit()
+        
+        results = []
+        for image_id in ids:
+            if image_id not in found_ids:
+                results.append({'id': image_id, 'success': False, 'error': 'Image not found'})
+            elif image_id in storage_errors:
+                results.append({'id': image_id, 'success': False, 'error': storage_errors[image_id]})
+            else:
+                results.append({'id': image_id, 'success': True})
+        
+        failed = len(results) - len(deletable_ids)
+        return jsonify({
+            'success': failed == 0,
+            'deleted': len(deletable_ids),
+            'failed': failed,
+            'results': results
+        }), 200 if failed == 0 else 207
+        
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
+@image_bp.route('/objects/<path:key>', methods=['GET'])
+def get_object(key):
+    """
+    Serve a stored file through the configured storage provider. Local and memory files
+    need the signature of the URL the image listings return (see sign_object_url).
+    """
+    try:
+        from app.services.base_storage_service import verify_object_signature
+        from app.services.storage_factory import StorageFactory
+        storage_service = StorageFactory.get_storage_service()
+        
+        require_signature = current_app.config.get('STORAGE_REQUIRE_SIGNED_URLS', True)
+        if storage_service.signs_urls and (require_signature or 'signature' in request.args):
+            if not verify_object_signature(key, request.args.get('expires'), request.args.get('signature')):
+                return jsonify({'error': 'Invalid or expired signature'}), 403
+        
+        return storage_service.serve(key)
+        
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @image_bp.route('/stats', methods=['GET'])
 def get_stats():
     """Get statistics about imported images"""
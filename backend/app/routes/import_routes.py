@@ -4,6 +4,7 @@ from app.models.image import Image
 from app.services.google_drive_service import GoogleDriveService
 from app.services.storage_factory import StorageFactory
 import logging
+import uuid
 
 import_bp = Blueprint('import', __name__)
 logger = logging.getLogger(__name__)
@@ -31,6 +32,7 @@ def import_from_google_drive():
         
         # Get storage service (AWS S3)
         storage_service = StorageFactory.get_storage_service()
+        import_id = str(uuid.uuid4())
         
         imported_images = []
         failed_imports = []
@@ -44,13 +46,14 @@ def import_from_google_drive():
                     continue
                 
                 # Download file from Google Drive
-                file_buffer = drive_service.download_file(file['id'])
+                file_buffer = drive_service.download_file(file['id'], file.get('size'))
                 
                 # Upload to cloud storage
-                storage_path = storage_service.upload_file(
+                stored = storage_service.upload_file(
                     file_buffer,
                     file['name'],
-                    file['mimeType']
+                    file['mimeType'],
+                    import_id
                 )
                 
                 # Save metadata to database
@@ -59,7 +62,8 @@ def import_from_google_drive():
                     google_drive_id=file['id'],
                     size=int(file.get('size', 0)),
                     mime_type=file['mimeType'],
-                    storage_path=storage_path,
+                    storage_path=stored['url'],
+                    storage_key=stored['key'],
                     storage_provider=current_app.config.get('STORAGE_PROVIDER', 'aws')
                 )
                 
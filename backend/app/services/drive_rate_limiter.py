@@ -0,0 +1,217 @@
+﻿from flask import current_app
+import json
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+# 403 reasons that mean "slow down"; other 403s (dailyLimitExceeded, forbidden) are final
+RATE_LIMIT_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded'}
+TRANSIENT_STATUSES = {500, 502, 503, 504}
+
+class DriveApiError(Exception):
+    """Error response from a raw HTTP call to the Drive API"""
+    def __init__(self, status, reason=None, retry_after=None, message=''):
+        super().__init__(message or f'Drive API returned {status} {reason or ""}'.strip())
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
+def parse_error_reason(content):
+    """Extract error.errors[0].reason from a Drive JSON error body"""
+    try:
+        if isinstance(content, bytes):
+            content = content.decode('utf-8')
+        errors = json.loads(content).get('error', {}).get('errors') or [{}]
+        return errors[0].get('reason')
+    except (ValueError, AttributeError):
+        return None
+
+def parse_retry_after(value):
+    try:
+        return max(float(value), 0.0) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+def error_details(exc):
+    """(status, reason, retry_after) for googleapiclient HttpError and DriveApiError"""
+    if isinstance(exc, DriveApiError):
+        return exc.status, exc.reason, exc.retry_after
+    resp = getattr(exc, 'resp', None)
+    if resp is not None and hasattr(resp, 'status'):
+        return int(resp.status), parse_error_reason(getattr(exc, 'content', b'')), parse_retry_after(resp.get('retry-after'))
+    return None, None, None
+
+def classify_error(exc):
+    """'throttle' for quota errors, 'transient' for retryable failures, None otherwise"""
+    status, reason, _ = error_details(exc)
+    if status == 429 or (status == 403 and reason in RATE_LIMIT_REASONS):
+        return 'throttle'
+    if status in TRANSIENT_STATUSES or (status is None and isinstance(exc, (ConnectionError, TimeoutError))):
+        return 'transient'
+    return None
+
+class TokenBucket:
+    """Thread-safe token bucket; burst holds one second worth of tokens"""
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(max(self.rate, 1.0), self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def set_rate(self, rate):
+        with self.lock:
+            self._refill(time.monotonic())
+            self.rate = rate
+            self.tokens = min(self.tokens, max(rate, 1.0))
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                self._refill(time.monotonic())
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+                wait = (1.0 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class DriveRateLimiter:
+    def __init__(self, rate=10, min_rate=1, max_rate=100, rate_increase=1, concurrency=8,
+                 min_concurrency=1, max_concurrency=50, decrease_factor=0.5, max_retries=6,
+                 backoff_base=0.5, backoff_max=32):
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.rate_increase = rate_increase
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.decrease_factor = decrease_factor
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self.rate = min(max(rate, min_rate), max_rate)
+        self.limit = float(min(max(concurrency, min_concurrency), max_concurrency))
+        self.bucket = TokenBucket(self.rate)
+        self.in_flight = 0
+        self.last_decrease = 0.0
+        self.counters = {'calls': 0, 'throttled': 0, 'retries': 0, 'failures': 0}
+        self.cond = threading.Condition()
+
+    @contextmanager
+    def slot(self):
+        """Hold one of the AIMD concurrency slots and one rate token"""
+        with self.cond:
+            while self.in_flight >= int(self.limit):
+                self.cond.wait()
+            self.in_flight += 1
+        try:
+            self.bucket.acquire()
+            yield
+        finally:
+            with self.cond:
+                self.in_flight -= 1
+                self.cond.notify_all()
+
+    def on_success(self):
+        with self.cond:
+            # Additive increase: ~rate_increase req/s per second and ~1 slot per window of calls
+            self.rate = min(self.max_rate, self.rate + self.rate_increase / max(self.rate, 1.0))
+            self.limit = min(float(self.max_concurrency), self.limit + 1.0 / self.limit)
+            self.cond.notify_all()
+        self.bucket.set_rate(self.rate)
+
+    def on_throttle(self):
+        with self.cond:
+            self.counters['throttled'] += 1
+            now = time.monotonic()
+            # Calls already in flight fail together; count them as one congestion event
+            if now - self.last_decrease < 1.0:
+                return
+            self.last_decrease = now
+            self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+            self.limit = max(float(self.min_concurrency), self.limit * self.decrease_factor)
+        self.bucket.set_rate(self.rate)
+
+    def backoff(self, attempt, retry_after=None):
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.backoff_max))
+        return delay
+
+    def count(self, name):
+        with self.cond:
+            self.counters[name] += 1
+
+    def retry_delay(self, exc, attempt):
+        """Record a failed attempt; returns the backoff before retrying, or None to give up"""
+        kind = classify_error(exc)
+        if kind == 'throttle':
+            self.on_throttle()
+        if kind is None or attempt >= self.max_retries:
+            self.count('failures')
+            return None
+        self.count('retries')
+        return self.backoff(attempt, error_details(exc)[2])
+
+    def call(self, fn, *args, **kwargs):
+        """Run fn under the limiter, retrying throttled and transient failures"""
+        attempt = 0
+        while True:
+            self.count('calls')
+            try:
+                with self.slot():
+                    result = fn(*args, **kwargs)
+            except Exception as e:
+                delay = self.retry_delay(e, attempt)
+                if delay is None:
+                    raise
+                # Sleep outside the slot so other calls are not blocked by the backoff
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self.on_success()
+            return result
+
+    def stats(self):
+        with self.cond:
+            return {
+                'rate': round(self.rate, 2),
+                'concurrency_limit': int(self.limit),
+                'in_flight': self.in_flight,
+                **self.counters
+            }
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+def reset_limiter():
+    """Drop the limiter so a forked worker process builds its own"""
+    global _limiter, _limiter_lock
+    _limiter = None
+    _limiter_lock = threading.Lock()
+
+def get_limiter():
+    """Process-wide limiter shared by every Drive call, configured from the app config"""
+    global _limiter
+    if _limiter is None:
+        with _limiter_lock:
+            if _limiter is None:
+                config = current_app.config
+                _limiter = DriveRateLimiter(
+                    rate=config.get('DRIVE_RATE_LIMIT', 10),
+                    min_rate=config.get('DRIVE_MIN_RATE', 1),
+                    max_rate=config.get('DRIVE_MAX_RATE', 100),
+                    rate_increase=config.get('DRIVE_RATE_INCREASE', 1),
+                    concurrency=config.get('DRIVE_CONCURRENCY', 8),
+                    min_concurrency=config.get('DRIVE_MIN_CONCURRENCY', 1),
+                    max_concurrency=config.get('DRIVE_MAX_CONCURRENCY', 50),
+                    decrease_factor=config.get('DRIVE_DECREASE_FACTOR', 0.5),
+                    max_retries=config.get('DRIVE_MAX_RETRIES', 6),
+                    backoff_base=config.get('DRIVE_BACKOFF_BASE', 0.5),
+                    backoff_max=config.get('DRIVE_BACKOFF_MAX', 32)
+                )
+    return _limiter
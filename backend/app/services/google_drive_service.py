@@ -1,12 +1,25 @@
-﻿from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload
-from flask import current_app
+﻿from flask import current_app
+from app.services.drive_rate_limiter import DriveApiError, get_limiter, parse_error_reason, parse_retry_after
+import concurrent.futures
 import io
 import re
+import requests
 
 class GoogleDriveService:
     def __init__(self):
         self.api_key = current_app.config.get('GOOGLE_API_KEY')
+        self.api_endpoint = current_app.config.get('GOOGLE_DRIVE_API_ENDPOINT')
+        self.limiter = get_limiter()
+        self.ranged_threshold = current_app.config.get('DRIVE_RANGED_THRESHOLD')
+        self.range_size = current_app.config.get('DRIVE_RANGE_SIZE')
+        self.range_parallelism = current_app.config.get('DRIVE_RANGE_PARALLELISM')
+    
+    def _build_service(self):
+        # googleapiclient is slow to import; only load it when Drive is first called
+        from googleapiclient.discovery import build
+
+        client_options = {'api_endpoint': self.api_endpoint} if self.api_endpoint else None
+        return build('drive', 'v3', developerKey=self.api_key, client_options=client_options, cache_discovery=False)
         
     def extract_folder_id(self, folder_url):
         """Extract folder ID from Google Drive URL"""
@@ -26,25 +39,95 @@ class GoogleDriveService:
     def list_images_in_folder(self, folder_id):
         """List all images in a Google Drive folder"""
         try:
-            service = build('drive', 'v3', developerKey=self.api_key)
+            service = self._build_service()
             
             query = f"'{folder_id}' in parents and (mimeType contains 'image/')"
             
-            results = service.files().list(
-                q=query,
-                pageSize=100,
-                fields="files(id, name, size, mimeType, webContentLink)"
-            ).execute()
-            
-            files = results.get('files', [])
-            return files
+            files = []
+            page_token = None
+            while True:
+                results = self.limiter.call(service.files().list(
+                    q=query,
+                    pageSize=1000,
+                    pageToken=page_token,
+                    fields="nextPageToken, files(id, name, size, mimeType, webContentLink)"
+                ).execute)
+                files.extend(results.get('files', []))
+                page_token = results.get('nextPageToken')
+                if not page_token:
+                    return files
         except Exception as e:
             raise Exception(f"Error fetching files from Google Drive: {str(e)}")
     
-    def download_file(self, file_id):
-        """Download a file from Google Drive"""
+    def _fetch_range(self, session, uri, view, start, end):
+        """GET bytes start..end (inclusive) and write them into view[start:end + 1]"""
+        try:
+            response = session.get(uri, headers={'Range': f'bytes={start}-{end}'}, stream=True, timeout=(10, 300))
+            try:
+                if response.status_code != 206:
+                    raise DriveApiError(
+                        response.status_code,
+                        parse_error_reason(response.content) if response.status_code >= 400 else None,
+                        parse_retry_after(response.headers.get('Retry-After')),
+                        f'Ranged download returned {response.status_code} for bytes {start}-{end}'
+                    )
+                position = start
+                for chunk in response.iter_content(chunk_size=1024 * 1024):
+                    if position + len(chunk) > end + 1:
+                        raise DriveApiError(response.status_code, message=f'Range {start}-{end} returned too many bytes')
+                    view[position:position + len(chunk)] = chunk
+                    position += len(chunk)
+                if position != end + 1:
+                    raise ConnectionError(f'Range {start}-{end} ended early at byte {position}')
+            finally:
+                response.close()
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                requests.exceptions.ChunkedEncodingError) as e:
+            # Dropped or stalled connections are transient: the limiter retries the range
+            raise ConnectionError(str(e)) from e
+    
+    def download_file_ranged(self, file_id, size):
+        """Download a file of known size as concurrent HTTP Range requests, reassembled in order"""
+        uri = self._build_service().files().get_media(fileId=file_id).uri
+        file_buffer = io.BytesIO(bytes(size))
+        view = file_buffer.getbuffer()
+        ranges = [(start, min(start + self.range_size, size) - 1) for start in range(0, size, self.range_size)]
+        sessions = [requests.Session() for _ in range(min(self.range_parallelism, len(ranges)))]
         try:
-            service = build('drive', 'v3', developerKey=self.api_key)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(sessions)) as pool:
+                futures = [
+                    pool.submit(self.limiter.call, self._fetch_range, sessions[i % len(sessions)], uri, view, start, end)
+                    for i, (start, end) in enumerate(ranges)
+                ]
+                for future in concurrent.futures.as_completed(futures):
+                    exc = future.exception()
+                    if exc is not None:
+                        for pending in futures:
+                            pending.cancel()
+                        raise exc
+        finally:
+            view.release()
+            for session in sessions:
+                session.close()
+        
+        file_buffer.seek(0)
+        return file_buffer
+    
+    def download_file(self, file_id, size=None):
+        """Download a file from Google Drive; large files (by listed size) use parallel ranged requests"""
+        try:
+            size = int(size or 0)
+            if size >= self.ranged_threshold and self.range_parallelism > 1:
+                try:
+                    return self.download_file_ranged(file_id, size)
+                except DriveApiError as e:
+                    # A server that ignores Range answers 200; fall back to a single stream
+                    if e.status != 200:
+                        raise
+            
+            from googleapiclient.http import MediaIoBaseDownload
+
+            service = self._build_service()
             
             request = service.files().get_media(fileId=file_id)
             file_buffer = io.BytesIO()
@@ -52,7 +135,8 @@ class GoogleDriveService:
             
             done = False
             while not done:
-                status, done = downloader.next_chunk()
+                # Each chunk is rate limited and retried on quota errors
+                status, done = self.limiter.call(downloader.next_chunk)
             
             file_buffer.seek(0)
             return file_buffer
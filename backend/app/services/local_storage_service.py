@@ -0,0 +1,71 @@
+﻿from flask import current_app, send_file, jsonify
+from app.services.base_storage_service import BaseStorageService
+import hashlib
+import mimetypes
+import os
+import shutil
+import tempfile
+
+class LocalStorageService(BaseStorageService):
+    """
+    Stores files on local disk under LOCAL_STORAGE_ROOT, sharded into two levels of
+    hash-prefixed directories. Writes are atomic (temp file + rename) and reads use
+    send_file, which WSGI servers turn into a zero-copy sendfile().
+    """
+    
+    signs_urls = True
+    
+    def __init__(self):
+        self.root = os.path.abspath(current_app.config.get('LOCAL_STORAGE_ROOT'))
+        self.public_url = current_app.config.get('LOCAL_STORAGE_PUBLIC_URL')
+        self.fsync = current_app.config.get('LOCAL_STORAGE_FSYNC', False)
+    
+    def path_for(self, key):
+        parts = key.split('/')
+        if not key or key.startswith('/') or any(part in ('', '.', '..') for part in parts):
+            raise ValueError(f"Invalid object key: {key}")
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.root, digest[:2], digest[2:4], *parts)
+    
+    def upload_file(self, file_buffer, filename, mime_type, import_id=None):
+        """Write a file to local disk. Returns the URL and the object key"""
+        key = self.build_key(filename, import_id)
+        path = self.path_for(key)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        
+        # Readers never see a partially written file: write a temp file, then rename it into place
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.upload-')
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file:
+                shutil.copyfileobj(file_buffer, tmp_file)
+                if self.fsync:
+                    tmp_file.flush()
+                    os.fsync(tmp_file.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        
+        return {'url': f"{self.public_url.rstrip('/')}/{key}", 'key': key}
+    
+    def delete_file(self, key):
+        """Delete a file from local disk"""
+        try:
+            os.unlink(self.path_for(key))
+        except FileNotFoundError:
+            pass
+        return True
+    
+    def serve(self, key):
+        path = self.path_for(key)
+        if not os.path.isfile(path):
+            return jsonify({'error': 'Image not found'}), 404
+        
+        return send_file(
+            path,
+            mimetype=mimetypes.guess_type(key)[0] or 'application/octet-stream',
+            conditional=True,
+            max_age=31536000
+        )
@@ -0,0 +1,38 @@
+﻿from flask import current_app, request, jsonify, Response
+from app.services.base_storage_service import BaseStorageService
+import threading
+
+class MemoryStorageService(BaseStorageService):
+    """Keeps files in process memory; for tests and local benchmarks"""
+    
+    signs_urls = True
+    
+    # Shared by every instance, since StorageFactory creates one per request
+    _objects = {}
+    _lock = threading.Lock()
+    
+    def upload_file(self, file_buffer, filename, mime_type, import_id=None):
+        """Store a file in memory. Returns the URL and the object key"""
+        key = self.build_key(filename, import_id)
+        with self._lock:
+            self._objects[key] = (file_buffer.read(), mime_type)
+        
+        public_url = current_app.config.get('LOCAL_STORAGE_PUBLIC_URL')
+        return {'url': f"{public_url.rstrip('/')}/{key}", 'key': key}
+    
+    def delete_file(self, key):
+        """Delete a file from memory"""
+        with self._lock:
+            self._objects.pop(key, None)
+        return True
+    
+    def serve(self, key):
+        with self._lock:
+            stored = self._objects.get(key)
+        if stored is None:
+            return jsonify({'error': 'Image not found'}), 404
+        
+        data, mime_type = stored
+        response = Response(data, mimetype=mime_type)
+        response.add_etag()
+        return response.make_conditional(request, accept_ranges=True, complete_length=len(data))
@@ -1,10 +1,15 @@
-﻿import boto3
-from botocore.exceptions import ClientError
-from flask import current_app
-import uuid
+﻿from flask import current_app, redirect
+from app.services.base_storage_service import BaseStorageService
+import concurrent.futures
 
-class S3StorageService:
+# S3 DeleteObjects accepts at most 1000 keys per request
+S3_DELETE_BATCH_SIZE = 1000
+
+class S3StorageService(BaseStorageService):
     def __init__(self):
+        # boto3 takes a noticeable part of a cold start; load it when S3 is first used
+        import boto3
+
         client_kwargs = {
             'region_name': current_app.config.get('AWS_REGION')
         }
@@ -21,33 +26,82 @@ class S3StorageService:
         self.s3_client = boto3.client('s3', **client_kwargs)
         self.bucket_name = current_app.config.get('AWS_BUCKET_NAME')
     
-    def upload_file(self, file_buffer, filename, mime_type):
-        """Upload a file to S3"""
+    def upload_file(self, file_buffer, filename, mime_type, import_id=None):
+        """Upload a file to S3. Returns the public URL and the object key"""
+        from botocore.exceptions import ClientError
+
         try:
 
-            unique_filename = f"{uuid.uuid4()}_{filename}"
+            key = self.build_key(filename, import_id)
             
            
             self.s3_client.upload_fileobj(
                 file_buffer,
                 self.bucket_name,
-                unique_filename,
+                key,
                 ExtraArgs={
                     'ContentType': mime_type
                 }
             )
             
-            url = f"https://{self.bucket_name}.s3.{current_app.config.get('AWS_REGION')}.amazonaws.com/{unique_filename}"
+            url = f"https://{self.bucket_name}.s3.{current_app.config.get('AWS_REGION')}.amazonaws.com/{key}"
             
-            return url
+            return {'url': url, 'key': key}
         except ClientError as e:
             raise Exception(f"Error uploading to S3: {str(e)}")
     
-    def delete_file(self, file_path):
+    def delete_file(self, key):
         """Delete a file from S3"""
+        from botocore.exceptions import ClientError
+
         try:
-            filename = file_path.split('/')[-1]
-            self.s3_client.delete_object(Bucket=self.bucket_name, Key=filename)
+            self.s3_client.delete_object(Bucket=self.bucket_name, Key=key)
             return True
         except ClientError as e:
             raise Exception(f"Error deleting from S3: {str(e)}")
+    
+    def _delete_key_batch(self, keys):
+        """Delete up to 1000 keys with a single DeleteObjects call"""
+        from botocore.exceptions import ClientError
+
+        try:
+            response = self.s3_client.delete_objects(
+                Bucket=self.bucket_name,
+                Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True}
+            )
+        except ClientError as e:
+            return {key: str(e) for key in keys}
+        
+        # In quiet mode S3 only reports the keys it failed to delete
+        return {
+            error['Key']: f"{error.get('Code')}: {error.get('Message')}"
+            for error in response.get('Errors', [])
+        }
+    
+    def delete_files(self, keys):
+        """
+        Delete many files from S3 using batched DeleteObjects calls in parallel.
+        Returns a dict of key -> error for files that could not be deleted.
+        """
+        keys = list(dict.fromkeys(keys))
+        batches = [
+            keys[i:i + S3_DELETE_BATCH_SIZE]
+            for i in range(0, len(keys), S3_DELETE_BATCH_SIZE)
+        ]
+        
+        errors_by_key = {}
+        max_workers = current_app.config.get('S3_DELETE_CONCURRENCY', 8)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+            for batch_errors in pool.map(self._delete_key_batch, batches):
+                errors_by_key.update(batch_errors)
+        
+        return errors_by_key
+    
+    def serve(self, key):
+        """Redirect to a short-lived presigned URL; S3 handles Range requests itself"""
+        url = self.s3_client.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': self.bucket_name, 'Key': key},
+            ExpiresIn=current_app.config.get('PRESIGNED_URL_TTL', 3600)
+        )
+        return redirect(url, code=302)
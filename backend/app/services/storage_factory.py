@@ -1,14 +1,33 @@
 ﻿from flask import current_app
 from app.services.s3_storage_service import S3StorageService
+from app.services.local_storage_service import LocalStorageService
+from app.services.memory_storage_service import MemoryStorageService
 
 class StorageFactory:
     """Factory class to get the appropriate storage service based on configuration"""
     
+    _providers = {
+        'aws': S3StorageService,
+        'local': LocalStorageService,
+        'memory': MemoryStorageService,
+    }
+    
+    @staticmethod
+    def register_provider(name, service_class):
+        """Register an additional storage provider (a BaseStorageService subclass)"""
+        StorageFactory._providers[name.lower()] = service_class
+    
+    @staticmethod
+    def signs_urls(provider):
+        """Whether files of provider are served from signed /api/objects URLs"""
+        service_class = StorageFactory._providers.get((provider or '').lower())
+        return service_class is not None and service_class.signs_urls
+    
     @staticmethod
     def get_storage_service():
         provider = current_app.config.get('STORAGE_PROVIDER', 'aws').lower()
         
-        if provider == 'aws':
-            return S3StorageService()
-        else:
+        service_class = StorageFactory._providers.get(provider)
+        if service_class is None:
             raise ValueError(f"Unsupported storage provider: {provider}")
+        return service_class()
@@ -0,0 +1,45 @@
+﻿"""
+Gunicorn settings for the monolith (production serving mode).
+
+    gunicorn -c gunicorn.conf.py run:app
+
+  PORT                         listen port
+  WEB_CONCURRENCY              worker processes (default 2 x cores + 1)
+  GUNICORN_THREADS             threads per worker process (default 1: prefork sync workers;
+                               more than 1 switches to the gthread worker)
+  GUNICORN_MAX_REQUESTS        recycle a worker after this many requests, +/- jitter (0 = never)
+  GUNICORN_PRELOAD             import the app once in the master before forking (default true)
+  GUNICORN_TIMEOUT / GUNICORN_GRACEFUL_TIMEOUT   seconds
+
+Imports run inside the request, and a sync worker busy for longer than GUNICORN_TIMEOUT
+is killed, so the default timeout is an hour. SIGHUP restarts the workers gracefully; with
+preloading, new code needs USR2 and then QUIT to the old master. A recycled or reloaded
+gthread worker can reset a connection it had just accepted; the sync workers do not.
+"""
+import multiprocessing
+import os
+
+def env_flag(name, default):
+    return os.getenv(name, default).strip().lower() in {'1', 'true', 'yes', 'on'}
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+workers = int(os.getenv('WEB_CONCURRENCY', 0)) or multiprocessing.cpu_count() * 2 + 1
+threads = int(os.getenv('GUNICORN_THREADS', 1))
+worker_class = 'gthread' if threads > 1 else 'sync'
+preload_app = env_flag('GUNICORN_PRELOAD', 'true')
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', 1000))
+max_requests_jitter = int(os.getenv('GUNICORN_MAX_REQUESTS_JITTER', max_requests // 10))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 3600))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', 60))
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', 5))
+accesslog = '-' if env_flag('GUNICORN_ACCESS_LOG', 'false') else None
+errorlog = '-'
+
+def post_fork(server, worker):
+    """Connections and locks created in the master belong to it; each worker opens its own"""
+    from app import db
+    from app.services import drive_rate_limiter
+
+    drive_rate_limiter.reset_limiter()
+    with server.app.wsgi().app_context():
+        db.engine.dispose(close=False)
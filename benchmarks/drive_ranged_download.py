@@ -0,0 +1,65 @@
+﻿"""
+Ranged download benchmark: downloads large files from a fake Drive whose responses are
+capped at --stream-bandwidth bytes/second each, once as a single stream and once as
+parallel byte ranges, and checks the reassembled bytes.
+
+    python benchmarks/drive_ranged_download.py --files 4 --file-size 33554432 --parallelism 4
+
+Prints one JSON object per mode with seconds, MB/s and whether every file matched.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'services'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fake_drive  # noqa: E402
+
+def main():
+    parser = argparse.ArgumentParser(description='Drive ranged download benchmark')
+    parser.add_argument('--files', type=int, default=4)
+    parser.add_argument('--file-size', type=int, default=32 * 1024 * 1024)
+    parser.add_argument('--stream-bandwidth', type=int, default=16 * 1024 * 1024)
+    parser.add_argument('--range-size', type=int, default=8 * 1024 * 1024)
+    parser.add_argument('--parallelism', type=int, default=4)
+    args = parser.parse_args()
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    app = fake_drive.create_app(files=args.files, file_size=args.file_size, stream_bandwidth=args.stream_bandwidth)
+    server, base_url = fake_drive.serve_in_thread(app)
+
+    from common import drive
+    drive.GOOGLE_DRIVE_API_ENDPOINT = f'{base_url}/drive/v3/'
+    drive._limiter = drive.DriveRateLimiter(rate=1000, max_rate=1000, concurrency=50)
+
+    try:
+        file_ids = [f'fake-{i:06d}' for i in range(args.files)]
+        for mode in ('single', 'ranged'):
+            ok = True
+            started = time.perf_counter()
+            for file_id in file_ids:
+                if mode == 'ranged':
+                    data = drive.download_ranged(file_id, args.file_size, 'bench', args.range_size, args.parallelism)
+                else:
+                    data = drive.download_media(file_id, 'bench')
+                ok = ok and data.getvalue() == fake_drive.file_content(file_id, args.file_size)
+            elapsed = time.perf_counter() - started
+            print(json.dumps({
+                'mode': mode,
+                'files': args.files,
+                'file_size': args.file_size,
+                'parallelism': args.parallelism if mode == 'ranged' else 1,
+                'seconds': round(elapsed, 2),
+                'mb_per_second': round(args.files * args.file_size / elapsed / 1e6, 1),
+                'verified': ok,
+            }))
+    finally:
+        server.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+﻿"""
+Drive rate limiter benchmark: downloads every file of a fake Drive folder with the
+worker's 50 threads against a server that throttles above --quota requests/second,
+once through the shared limiter and once with plain calls (--mode both).
+
+    python benchmarks/drive_rate_limit.py --files 300 --quota 25
+
+Prints one JSON object per mode: achieved requests/second, throttled responses seen by
+the server, failed downloads and the limiter's final rate / concurrency.
+"""
+import argparse
+import concurrent.futures
+import json
+import logging
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'services'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fake_drive  # noqa: E402
+
+def run(mode, args, base_url, app):
+    from common import drive
+
+    drive.GOOGLE_DRIVE_API_ENDPOINT = f'{base_url}/drive/v3/'
+    drive._limiter = drive.DriveRateLimiter(rate=args.start_rate, max_concurrency=args.threads)
+    stats = app.config['FAKE_DRIVE_STATS']
+    for name in stats:
+        stats[name] = 0
+
+    files = drive.execute(drive.build_drive_service('bench').files().list(q="'bench' in parents", pageSize=1000))['files']
+
+    def download(file_id):
+        if mode == 'limiter':
+            return drive.download_media(file_id, 'bench')
+        # Baseline: the worker's previous behaviour, one attempt per file
+        from googleapiclient.http import MediaIoBaseDownload
+        import io
+        buffer = io.BytesIO()
+        downloader = MediaIoBaseDownload(buffer, drive.build_drive_service('bench').files().get_media(fileId=file_id))
+        done = False
+        while not done:
+            _, done = downloader.next_chunk()
+        return buffer
+
+    failed = 0
+    started = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.threads) as pool:
+        for future in concurrent.futures.as_completed([pool.submit(download, f['id']) for f in files]):
+            if future.exception() is not None:
+                failed += 1
+    elapsed = time.perf_counter() - started
+
+    return {
+        'mode': mode,
+        'files': len(files),
+        'failed': failed,
+        'seconds': round(elapsed, 2),
+        'files_per_second': round((len(files) - failed) / elapsed, 2),
+        'quota_rps': args.quota,
+        'server': dict(stats),
+        'limiter': drive.get_limiter().stats() if mode == 'limiter' else None,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Drive rate limiter benchmark')
+    parser.add_argument('--files', type=int, default=300)
+    parser.add_argument('--file-size', type=int, default=64 * 1024)
+    parser.add_argument('--quota', type=float, default=25)
+    parser.add_argument('--throttle-status', type=int, choices=(403, 429), default=403)
+    parser.add_argument('--threads', type=int, default=50)
+    parser.add_argument('--start-rate', type=float, default=10)
+    parser.add_argument('--mode', choices=('limiter', 'baseline', 'both'), default='both')
+    args = parser.parse_args()
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    app = fake_drive.create_app(
+        files=args.files, file_size=args.file_size, quota=args.quota,
+        throttle_status=args.throttle_status
+    )
+    server, base_url = fake_drive.serve_in_thread(app)
+    try:
+        modes = ('baseline', 'limiter') if args.mode == 'both' else (args.mode,)
+        for mode in modes:
+            print(json.dumps(run(mode, args, base_url, app)))
+    finally:
+        server.shutdown()
+
+if __name__ == '__main__':
+    main()
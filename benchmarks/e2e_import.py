@@ -0,0 +1,341 @@
+﻿"""
+End-to-end import benchmark: imports a fake Drive folder through the monolith
+(backend/app) and through the microservices (gateway -> import -> worker -> storage /
+metadata), with every external dependency replaced by a local stand-in:
+
+  Drive     fake_drive.py, serving synthetic images with a configurable size distribution
+  S3        moto's S3 server (the services reach it through AWS_ENDPOINT_URL)
+  Database  a fresh SQLite file per target (DATABASE_URL)
+
+    python benchmarks/e2e_import.py --files 300 --sizes lognormal:500k:1.0 --output results.json
+
+Prints one JSON document (and writes it to --output) with, per target: files/second,
+MB/second, p50/p99 per-file latency and the peak RSS of every service process (sampled
+from /proc, so Linux only). Per-file latency is the time from a file's first step to
+its metadata row. The microservices measure it from trace spans, so queueing before the
+first step is excluded. The monolith imports files one after another, so there it is the
+gap between consecutive rows. Service logs are kept in --workdir.
+
+--workers N runs N worker-service processes that register with the import-service by
+heartbeat, which spreads the batches over them by load.
+"""
+import argparse
+import json
+import os
+import platform
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+SERVICES_DIR = os.path.join(ROOT, 'services')
+sys.path.insert(0, SERVICES_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from common import tracing  # noqa: E402
+from fake_drive import parse_sizes  # noqa: E402
+from worker_engines import proc_status, wait_for  # noqa: E402
+
+FOLDER_URL = 'https://drive.google.com/drive/folders/bench-folder'
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def descendants(pid):
+    """pid and every process below it (the async worker engine runs child processes)"""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(ppid, []).append(int(entry))
+    found, pending = [], [pid]
+    while pending:
+        current = pending.pop()
+        found.append(current)
+        pending.extend(children.get(current, []))
+    return found
+
+class RssSampler(threading.Thread):
+    """Peak summed RSS of each named process tree"""
+    def __init__(self, pids, interval=0.1):
+        super().__init__(daemon=True)
+        self.pids = pids
+        self.interval = interval
+        self.peaks = {name: 0 for name in pids}
+        self.running = True
+
+    def run(self):
+        while self.running:
+            for name, pid in self.pids.items():
+                rss = sum(proc_status(p)[0] for p in descendants(pid))
+                self.peaks[name] = max(self.peaks[name], rss)
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.running = False
+        self.join()
+        return {name: round(peak / 1e6, 1) for name, peak in self.peaks.items()}
+
+class Processes:
+    """Subprocesses of one run, each logging to <workdir>/<name>.log"""
+    def __init__(self, workdir):
+        self.workdir = workdir
+        self.running = {}
+
+    def start(self, name, argv, env, cwd=None):
+        log = open(os.path.join(self.workdir, f'{name}.log'), 'wb')
+        self.running[name] = subprocess.Popen(argv, env=env, cwd=cwd, stdout=log, stderr=subprocess.STDOUT)
+        log.close()
+        return self.running[name]
+
+    def pids(self, names):
+        return {name: self.running[name].pid for name in names}
+
+    def stop(self, names=None):
+        for name in list(names or self.running):
+            process = self.running.pop(name)
+            process.terminate()
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+
+def request_json(method, url, body=None, timeout=30):
+    data = json.dumps(body).encode('utf-8') if body is not None else None
+    req = urllib.request.Request(url, data=data, method=method, headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(req, timeout=timeout) as response:
+        return json.loads(response.read())
+
+def percentile(values, share):
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(share * len(ordered)))], 1) if ordered else None
+
+def summarize(target, expected, imported_sizes, failed, seconds, latencies_ms, peak_rss_mb, s3_objects):
+    return {
+        'target': target,
+        'files': expected,
+        'imported': len(imported_sizes),
+        'failed': failed,
+        'seconds': round(seconds, 2),
+        'files_per_second': round(len(imported_sizes) / seconds, 2),
+        'mb_per_second': round(sum(imported_sizes) / 1e6 / seconds, 2),
+        'latency_ms': {
+            'p50': percentile(latencies_ms, 0.5),
+            'p99': percentile(latencies_ms, 0.99),
+            'max': round(max(latencies_ms), 1) if latencies_ms else None,
+        },
+        'peak_rss_mb': peak_rss_mb,
+        's3_objects': s3_objects,
+    }
+
+def create_bucket(s3_url, bucket):
+    import boto3
+    client = boto3.client('s3', endpoint_url=s3_url, region_name='us-east-1',
+                          aws_access_key_id='bench', aws_secret_access_key='bench')
+    client.create_bucket(Bucket=bucket)
+    return client
+
+def count_objects(client, bucket):
+    paginator = client.get_paginator('list_objects_v2')
+    return sum(page.get('KeyCount', 0) for page in paginator.paginate(Bucket=bucket))
+
+def run_monolith(args, env, processes, s3):
+    port = free_port()
+    database = os.path.join(args.workdir, 'monolith.db')
+    env = dict(env, PORT=str(port), DATABASE_URL=f'sqlite:///{database}', AWS_BUCKET_NAME='bench-monolith')
+    s3_client = create_bucket(s3, 'bench-monolith')
+    processes.start('backend', [sys.executable, 'run.py'], env, cwd=os.path.join(ROOT, 'backend'))
+    base_url = f'http://127.0.0.1:{port}'
+    try:
+        wait_for(f'{base_url}/api/stats')
+        sampler = RssSampler(processes.pids(['backend']))
+        sampler.start()
+        started_at = datetime.utcnow()
+        started = time.perf_counter()
+        # The monolith imports inside the request
+        result = request_json('POST', f'{base_url}/api/import/google-drive', {'folder_url': FOLDER_URL}, timeout=24 * 3600)
+        seconds = time.perf_counter() - started
+        peak_rss = sampler.stop()
+    finally:
+        processes.stop(['backend'])
+
+    with sqlite3.connect(database) as conn:
+        created = [datetime.fromisoformat(row[0]) for row in conn.execute('SELECT created_at FROM images ORDER BY id')]
+    latencies = [(b - a).total_seconds() * 1000 for a, b in zip([started_at] + created, created)]
+    return summarize(
+        'monolith', args.files, [image['size'] for image in result.get('imported', [])],
+        len(result.get('failed', [])), seconds, latencies, peak_rss, count_objects(s3_client, 'bench-monolith')
+    )
+
+def file_latencies(trace_file, job_id):
+    """Per file: first span of the file to the end of its import_file span"""
+    spans = [s for s in tracing.load_spans([trace_file]) if s['attributes'].get('job_id') == job_id]
+    first_start, done = {}, {}
+    for s in spans:
+        file_id = s['attributes'].get('file_id')
+        if not file_id:
+            continue
+        if s['name'] == 'import_file':
+            done[file_id] = s['start'] + s['duration_ms'] / 1000
+        else:
+            first_start[file_id] = min(first_start.get(file_id, s['start']), s['start'])
+    return [(done[f] - first_start[f]) * 1000 for f in done if f in first_start]
+
+def run_microservices(args, env, processes, s3):
+    worker_names = ['worker'] + [f'worker-{i}' for i in range(2, args.workers + 1)]
+    ports = {name: free_port() for name in ('gateway', 'import', *worker_names, 'storage', 'metadata')}
+    urls = {name: f'http://127.0.0.1:{port}' for name, port in ports.items()}
+    trace_file = os.path.join(args.workdir, 'traces.jsonl')
+    env = dict(
+        env,
+        PYTHONPATH=SERVICES_DIR,
+        AWS_BUCKET_NAME='bench-microservices',
+        DATABASE_URL=f"sqlite:///{os.path.join(args.workdir, 'microservices.db')}",
+        JOB_MANIFEST_PATH=os.path.join(args.workdir, 'manifest.db'),
+        IMPORT_SERVICE_URL=urls['import'],
+        WORKER_SERVICE_URL=urls['worker'],
+        STORAGE_SERVICE_URL=urls['storage'],
+        METADATA_SERVICE_URL=urls['metadata'],
+        WORKER_ENGINE=args.worker_engine,
+        TRACING_EXPORTER='file',
+        TRACING_FILE=trace_file,
+        TRACING_FLUSH_INTERVAL='0.2',
+    )
+    s3_client = create_bucket(s3, 'bench-microservices')
+    scripts = {
+        'metadata': 'metadata-service/app/metadata_service.py',
+        'storage': 'storage-service/app/storage_service.py',
+        **{name: 'worker-service/worker.py' for name in worker_names},
+        'import': 'import-service/app/import_service.py',
+        'gateway': 'api-gateway/app/gateway.py',
+    }
+    for name, script in scripts.items():
+        service_env = dict(env, PORT=str(ports[name]))
+        if name in worker_names and args.workers > 1:
+            service_env['WORKER_ADVERTISE_URL'] = urls[name]
+        processes.start(name, [sys.executable, os.path.join(SERVICES_DIR, script)], service_env)
+    try:
+        for url in urls.values():
+            wait_for(f'{url}/health')
+        if args.workers > 1:
+            deadline = time.monotonic() + 30
+            while len(request_json('GET', f"{urls['import']}/workers")['workers']) < args.workers:
+                if time.monotonic() > deadline:
+                    raise RuntimeError('workers did not register with the import-service')
+                time.sleep(0.2)
+        sampler = RssSampler(processes.pids(scripts))
+        sampler.start()
+        started = time.perf_counter()
+        job = request_json('POST', f"{urls['gateway']}/api/import/google-drive", {'folder_url': FOLDER_URL}, timeout=600)
+        while True:
+            status = request_json('GET', f"{urls['gateway']}/api/import/status/{job['job_id']}")
+            if status['processed'] + status['failed'] >= status['total']:
+                break
+            time.sleep(0.1)
+        seconds = time.perf_counter() - started
+        peak_rss = sampler.stop()
+        time.sleep(1)  # last span batches
+    finally:
+        processes.stop(scripts)
+
+    target = f'microservices-{args.worker_engine}' + (f'-x{args.workers}' if args.workers > 1 else '')
+    return summarize(
+        target, args.files, [image['size'] for image in status['imported']],
+        status['failed'], seconds, file_latencies(trace_file, job['job_id']), peak_rss,
+        count_objects(s3_client, 'bench-microservices')
+    )
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end import benchmark (monolith and microservices)')
+    parser.add_argument('--target', choices=('monolith', 'microservices', 'all'), default='all')
+    parser.add_argument('--files', type=int, default=200)
+    parser.add_argument('--sizes', default='lognormal:300k:0.8',
+                        help='fixed:SIZE, uniform:MIN:MAX, lognormal:MEDIAN:SIGMA or mix:SIZE=WEIGHT,...')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--drive-latency', type=float, default=0.0, help='seconds added to every fake Drive request')
+    parser.add_argument('--drive-bandwidth', type=int, default=0, help='bytes/second per Drive response (0 = unlimited)')
+    parser.add_argument('--worker-engine', choices=('pipeline', 'async', 'threads'), default='pipeline')
+    parser.add_argument('--workers', type=int, default=1, help='worker-service processes (more than 1 registers them)')
+    parser.add_argument('--workdir', help='databases, traces and service logs (default: a new temp directory)')
+    parser.add_argument('--output', help='also write the JSON result here')
+    args = parser.parse_args()
+    args.workdir = args.workdir or tempfile.mkdtemp(prefix='e2e-import-')
+    os.makedirs(args.workdir, exist_ok=True)
+
+    sizes = parse_sizes(args.sizes, args.files, args.seed)
+    drive_port, s3_port = free_port(), free_port()
+    processes = Processes(args.workdir)
+    processes.start('fake-drive', [
+        sys.executable, os.path.join(BENCH_DIR, 'fake_drive.py'), '--host', '127.0.0.1', '--port', str(drive_port),
+        '--files', str(args.files), '--sizes', args.sizes, '--seed', str(args.seed),
+        '--latency', str(args.drive_latency), '--stream-bandwidth', str(args.drive_bandwidth)
+    ], dict(os.environ))
+    processes.start('s3', [sys.executable, '-m', 'moto.server', '-H', '127.0.0.1', '-p', str(s3_port)], dict(os.environ))
+    s3 = f'http://127.0.0.1:{s3_port}'
+
+    env = dict(
+        os.environ,
+        GOOGLE_API_KEY='bench',
+        GOOGLE_DRIVE_API_ENDPOINT=f'http://127.0.0.1:{drive_port}/drive/v3/',
+        STORAGE_PROVIDER='aws',
+        AWS_ENDPOINT_URL=s3,
+        AWS_ACCESS_KEY_ID='bench',
+        AWS_SECRET_ACCESS_KEY='bench',
+        AWS_REGION='us-east-1',
+        # The fake Drive has no quota; keep the limiter out of the measurement
+        DRIVE_RATE_LIMIT='100000', DRIVE_MAX_RATE='100000',
+        DRIVE_CONCURRENCY='1000', DRIVE_MAX_CONCURRENCY='1000',
+    )
+    results = []
+    try:
+        wait_for(f'http://127.0.0.1:{drive_port}/_stats')
+        wait_for(s3)
+        if args.target in ('monolith', 'all'):
+            results.append(run_monolith(args, env, processes, s3))
+        if args.target in ('microservices', 'all'):
+            results.append(run_microservices(args, env, processes, s3))
+    finally:
+        processes.stop()
+
+    report = {
+        'benchmark': 'e2e_import',
+        'revision': git_revision(),
+        'timestamp': datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+        'machine': {'python': platform.python_version(), 'cpus': os.cpu_count()},
+        'config': {
+            'files': args.files, 'sizes': args.sizes, 'seed': args.seed, 'total_mb': round(sum(sizes) / 1e6, 1),
+            'drive_latency': args.drive_latency, 'drive_bandwidth': args.drive_bandwidth,
+            'worker_engine': args.worker_engine, 'workers': args.workers,
+        },
+        'results': results,
+        'workdir': args.workdir,
+    }
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+
+if __name__ == '__main__':
+    main()
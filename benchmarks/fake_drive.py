@@ -0,0 +1,242 @@
+﻿"""
+Fake Google Drive v3 server for load tests and benchmarks.
+
+Serves a synthetic folder of images at /drive/v3/files (list, metadata and
+alt=media downloads with Range support) and enforces a request quota the way Drive
+does: requests above --quota per second get 403 userRateLimitExceeded (or 429 with
+--throttle-status 429). Extra rate-limit and 5xx responses can be injected at random,
+and --stream-bandwidth caps each response's bytes/second like a single Drive stream.
+For tests, throttle_first throttles the first N requests and drop_first cuts the first
+N media responses off halfway (the connection closes mid-body).
+File sizes are fixed (--file-size) or drawn from a distribution (--sizes, see parse_sizes).
+
+Point the services at it with GOOGLE_DRIVE_API_ENDPOINT=http://localhost:9000/drive/v3/
+
+    python benchmarks/fake_drive.py --port 9000 --files 500 --file-size 2000000 --quota 20
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+
+from flask import Flask, Response, jsonify, request
+from werkzeug.serving import make_server
+
+RATE_LIMIT_BODIES = {
+    403: {'reason': 'userRateLimitExceeded', 'message': 'User Rate Limit Exceeded'},
+    429: {'reason': 'rateLimitExceeded', 'message': 'Rate Limit Exceeded'},
+}
+
+def error_response(status, reason, message, retry_after=None):
+    body = {'error': {'errors': [{'domain': 'usageLimits', 'reason': reason, 'message': message}],
+                      'code': status, 'message': message}}
+    response = Response(json.dumps(body), status=status, mimetype='application/json')
+    if retry_after is not None:
+        response.headers['Retry-After'] = str(retry_after)
+    return response
+
+def file_content(file_id, size):
+    """Deterministic bytes for a file, so downloads can be verified"""
+    seed = hashlib.sha256(file_id.encode('utf-8')).digest()
+    return (seed * (size // len(seed) + 1))[:size]
+
+def parse_size(value):
+    """Bytes from 512, 200k or 8m"""
+    value = value.strip().lower()
+    multiplier = {'k': 1024, 'm': 1024 * 1024, 'g': 1024 * 1024 * 1024}.get(value[-1:], 1)
+    return int(float(value.rstrip('kmg')) * multiplier)
+
+def parse_sizes(spec, count, seed=0):
+    """
+    File sizes for a catalog, deterministic for a given seed:
+      fixed:SIZE                 every file SIZE bytes
+      uniform:MIN:MAX            uniformly between MIN and MAX
+      lognormal:MEDIAN:SIGMA     log-normal around MEDIAN (photo libraries look like this)
+      mix:SIZE=WEIGHT,...        e.g. mix:200k=0.7,2m=0.25,20m=0.05
+    """
+    rng = random.Random(seed)
+    kind, _, params = spec.partition(':')
+    if kind == 'fixed':
+        return [parse_size(params)] * count
+    if kind == 'uniform':
+        low, high = (parse_size(p) for p in params.split(':'))
+        return [rng.randint(low, high) for _ in range(count)]
+    if kind == 'lognormal':
+        median, sigma = params.split(':')
+        median = parse_size(median)
+        return [max(1, int(median * rng.lognormvariate(0, float(sigma)))) for _ in range(count)]
+    if kind == 'mix':
+        choices = [member.split('=') for member in params.split(',')]
+        sizes = [parse_size(size) for size, _ in choices]
+        weights = [float(weight) for _, weight in choices]
+        return rng.choices(sizes, weights, k=count)
+    raise ValueError(f'Unknown size distribution: {spec}')
+
+class Quota:
+    """Token bucket holding one second of requests, like Drive's per-user rate quota"""
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def allow(self):
+        if not self.rate:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+def paced(data, bandwidth, chunk_size=64 * 1024):
+    """Yield data at most bandwidth bytes/second"""
+    started = time.monotonic()
+    for offset in range(0, len(data), chunk_size):
+        ahead = offset / bandwidth - (time.monotonic() - started)
+        if ahead > 0:
+            time.sleep(ahead)
+        yield data[offset:offset + chunk_size]
+
+def dropped(data):
+    """Yield half of data, then break the response so the client sees the connection close early"""
+    yield data[:len(data) // 2]
+    raise ConnectionAbortedError('fake_drive: dropped the connection')
+
+def create_app(files=100, file_size=256 * 1024, quota=0, throttle_status=403, throttle_rate=0.0,
+               error_rate=0.0, latency=0.0, retry_after=None, folder_id=None, stream_bandwidth=0, sizes=None,
+               throttle_first=0, drop_first=0):
+    """sizes: one size per file (see parse_sizes); otherwise every file is file_size bytes"""
+    app = Flask(__name__)
+    sizes = sizes or [file_size] * files
+    catalog = [
+        {'id': f'fake-{i:06d}', 'name': f'image_{i:06d}.jpg', 'mimeType': 'image/jpeg', 'size': str(sizes[i])}
+        for i in range(files)
+    ]
+    by_id = {f['id']: f for f in catalog}
+    quota_bucket = Quota(quota)
+    stats = {'requests': 0, 'served': 0, 'throttled': 0, 'errors': 0, 'dropped': 0, 'bytes': 0, 'media': 0}
+    stats_lock = threading.Lock()
+    app.config['FAKE_DRIVE_STATS'] = stats
+
+    def count(name, amount=1):
+        with stats_lock:
+            stats[name] += amount
+            return stats[name]
+
+    @app.before_request
+    def enforce_quota():
+        if request.path.startswith('/_'):
+            return None
+        number = count('requests')
+        if latency:
+            time.sleep(latency)
+        if number <= throttle_first or not quota_bucket.allow() or random.random() < throttle_rate:
+            count('throttled')
+            body = RATE_LIMIT_BODIES[throttle_status]
+            return error_response(throttle_status, body['reason'], body['message'], retry_after)
+        if random.random() < error_rate:
+            count('errors')
+            return error_response(503, 'backendError', 'Backend Error')
+        return None
+
+    @app.route('/drive/v3/files', methods=['GET'])
+    def list_files():
+        match = re.search(r"'([^']+)' in parents", request.args.get('q', ''))
+        if folder_id and (not match or match.group(1) != folder_id):
+            count('served')
+            return jsonify({'files': []})
+        page_size = min(int(request.args.get('pageSize', 100)), 1000)
+        start = int(request.args.get('pageToken') or 0)
+        page = catalog[start:start + page_size]
+        body = {'files': page}
+        if start + page_size < len(catalog):
+            body['nextPageToken'] = str(start + page_size)
+        count('served')
+        return jsonify(body)
+
+    @app.route('/drive/v3/files/<file_id>', methods=['GET'])
+    def get_file(file_id):
+        meta = by_id.get(file_id)
+        if meta is None:
+            return error_response(404, 'notFound', f'File not found: {file_id}')
+        if request.args.get('alt') != 'media':
+            count('served')
+            return jsonify(meta)
+
+        data = file_content(file_id, int(meta['size']))
+        status = 200
+        headers = {'Accept-Ranges': 'bytes'}
+        range_match = re.match(r'bytes=(\d+)-(\d*)$', request.headers.get('Range', ''))
+        if range_match:
+            start = int(range_match.group(1))
+            end = int(range_match.group(2)) if range_match.group(2) else len(data) - 1
+            if start >= len(data):
+                return Response(status=416, headers={'Content-Range': f'bytes */{len(data)}'})
+            end = min(end, len(data) - 1)
+            headers['Content-Range'] = f'bytes {start}-{end}/{len(data)}'
+            data = data[start:end + 1]
+            status = 206
+        headers['Content-Length'] = str(len(data))
+        if count('media') <= drop_first:
+            count('dropped')
+            return Response(dropped(data), status=status, mimetype=meta['mimeType'], headers=headers)
+        count('served')
+        count('bytes', len(data))
+        body = paced(data, stream_bandwidth) if stream_bandwidth else data
+        return Response(body, status=status, mimetype=meta['mimeType'], headers=headers)
+
+    @app.route('/_stats', methods=['GET'])
+    def get_stats():
+        with stats_lock:
+            return jsonify(dict(stats))
+
+    @app.route('/_reset', methods=['POST'])
+    def reset_stats():
+        with stats_lock:
+            for name in stats:
+                stats[name] = 0
+        return jsonify({'reset': True})
+
+    return app
+
+def serve_in_thread(app, host='127.0.0.1', port=0):
+    """Start the app on a background thread; returns (server, base_url)"""
+    server = make_server(host, port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://{host}:{server.server_port}'
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--files', type=int, default=100)
+    parser.add_argument('--file-size', type=int, default=256 * 1024)
+    parser.add_argument('--sizes', help='size distribution, e.g. lognormal:500k:1.0 (overrides --file-size)')
+    parser.add_argument('--seed', type=int, default=0, help='seed for --sizes')
+    parser.add_argument('--quota', type=float, default=0, help='requests/second before throttling (0 = unlimited)')
+    parser.add_argument('--throttle-status', type=int, choices=(403, 429), default=403)
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='fraction of requests throttled at random')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests failing with 503')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every request')
+    parser.add_argument('--retry-after', type=int, default=None)
+    parser.add_argument('--stream-bandwidth', type=int, default=0, help='bytes/second per response (0 = unlimited)')
+    args = parser.parse_args()
+
+    app = create_app(
+        files=args.files, file_size=args.file_size, quota=args.quota,
+        throttle_status=args.throttle_status, throttle_rate=args.throttle_rate,
+        error_rate=args.error_rate, latency=args.latency, retry_after=args.retry_after,
+        stream_bandwidth=args.stream_bandwidth,
+        sizes=parse_sizes(args.sizes, args.files, args.seed) if args.sizes else None
+    )
+    app.run(host=args.host, port=args.port, threaded=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,231 @@
+﻿"""
+Read-path load test for the gateway and metadata-service.
+
+Starts the metadata-service (on its own database, SQLite by default) and the gateway,
+seeds the images table with synthetic rows, and runs scripted scenarios at several
+concurrency levels for every table size in --rows:
+
+  dashboard  GET /api/stats, the dashboard polling for totals
+  gallery    GET /api/images?page=N, users paging anywhere in the gallery (deep pages included)
+  detail     GET /api/images/<id> for random ids
+  export     GET /api/images/all, skipped once the table is larger than --export-max-rows
+
+    python benchmarks/read_path.py --rows 10000,100000,1000000 --concurrency 1,8,32 --output read.json
+
+Each scenario runs closed-loop: every client sends its next request as soon as the last
+one returns. The JSON output has throughput, errors and p50/p90/p99 latency per (rows,
+scenario, concurrency), plus a per-scenario summary of how latency grows with table
+size. The load generator shares the machine with the services, so compare runs from the
+same host.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+
+from e2e_import import SERVICES_DIR, Processes, free_port, git_revision, percentile  # noqa: E402
+from worker_engines import wait_for  # noqa: E402
+
+SCENARIOS = ('dashboard', 'gallery', 'detail', 'export')
+SEED_BATCH = 20000
+
+def seed(database_url, target_rows, rng):
+    """Top the images table up to target_rows synthetic rows"""
+    from sqlalchemy import MetaData, Table, create_engine, func, select
+
+    engine = create_engine(database_url)
+    images = Table('images', MetaData(), autoload_with=engine)
+    with engine.begin() as conn:
+        existing = conn.execute(select(func.count()).select_from(images)).scalar()
+    started = datetime(2020, 1, 1)
+    for offset in range(existing, target_rows, SEED_BATCH):
+        rows = []
+        for i in range(offset, min(offset + SEED_BATCH, target_rows)):
+            key = f'{i:08x}-seed_{i}.jpg'
+            rows.append({
+                'name': f'seed_{i}.jpg',
+                'google_drive_id': f'seed-{i:09d}',
+                'size': int(rng.lognormvariate(13, 1)),
+                'mime_type': 'image/jpeg',
+                'storage_path': f'https://bench.s3.us-east-1.amazonaws.com/{key}',
+                'storage_key': key,
+                'storage_provider': 'aws' if i % 10 else 'local',
+                'created_at': started + timedelta(seconds=i * 7),
+            })
+        with engine.begin() as conn:
+            conn.execute(images.insert(), rows)
+    engine.dispose()
+    return max(existing, target_rows)
+
+class Scenario:
+    """
+    Builds the next request path for one scenario. prefix is /api for the gateway and
+    empty for the metadata-service, which serves the same paths without it.
+    """
+    def __init__(self, name, rows, per_page, prefix='/api'):
+        self.name = name
+        self.rows = rows
+        self.per_page = per_page
+        self.prefix = prefix
+
+    def path(self, rng):
+        if self.name == 'dashboard':
+            return f'{self.prefix}/stats'
+        if self.name == 'gallery':
+            pages = max(1, -(-self.rows // self.per_page))
+            return f'{self.prefix}/images?page={rng.randint(1, pages)}&per_page={self.per_page}'
+        if self.name == 'detail':
+            return f'{self.prefix}/images/{rng.randint(1, self.rows)}'
+        return f'{self.prefix}/images/all'
+
+def run_load(base_url, scenario, concurrency, duration, timeout):
+    """Closed-loop load: concurrency clients for duration seconds"""
+    latencies, errors = [], []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def client(index):
+        rng = random.Random(index)
+        session = requests.Session()
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            try:
+                response = session.get(base_url + scenario.path(rng), timeout=timeout)
+                response.content
+                ok = response.status_code == 200
+            except requests.RequestException:
+                ok = False
+            elapsed = (time.perf_counter() - started) * 1000
+            with lock:
+                (latencies if ok else errors).append(elapsed)
+
+    started = time.perf_counter()
+    clients = [threading.Thread(target=client, args=(i,), daemon=True) for i in range(concurrency)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    seconds = time.perf_counter() - started
+    return {
+        'requests': len(latencies),
+        'errors': len(errors),
+        'seconds': round(seconds, 2),
+        'requests_per_second': round(len(latencies) / seconds, 1),
+        'latency_ms': {
+            'p50': percentile(latencies, 0.5),
+            'p90': percentile(latencies, 0.9),
+            'p99': percentile(latencies, 0.99),
+            'max': round(max(latencies), 1) if latencies else None,
+        },
+    }
+
+def scaling_summary(results):
+    """p50 latency per table size at the lowest concurrency, per scenario"""
+    summary = {}
+    for scenario in SCENARIOS:
+        cells = [r for r in results if r['scenario'] == scenario and not r.get('skipped')]
+        if not cells:
+            continue
+        lowest = min(r['concurrency'] for r in cells)
+        points = {r['rows']: r['latency_ms']['p50'] for r in cells if r['concurrency'] == lowest}
+        sizes = sorted(points)
+        summary[scenario] = {
+            'concurrency': lowest,
+            'p50_ms_by_rows': {str(rows): points[rows] for rows in sizes},
+            # p50 on the largest table divided by p50 on the smallest
+            'growth': round(points[sizes[-1]] / points[sizes[0]], 2) if len(sizes) > 1 and points[sizes[0]] else None,
+        }
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(description='Read-path load test (gateway + metadata-service)')
+    parser.add_argument('--rows', default='10000,100000,1000000', help='table sizes to test, comma-separated')
+    parser.add_argument('--concurrency', default='1,8,32', help='concurrent clients, comma-separated')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--duration', type=float, default=10, help='seconds per scenario and concurrency level')
+    parser.add_argument('--per-page', type=int, default=50)
+    parser.add_argument('--export-max-rows', type=int, default=200000)
+    parser.add_argument('--timeout', type=float, default=120, help='per-request timeout in seconds')
+    parser.add_argument('--direct', action='store_true', help='call the metadata-service directly, not the gateway')
+    parser.add_argument('--database-url', help='seed and serve this database instead of a fresh SQLite file')
+    parser.add_argument('--workdir', help='database and service logs (default: a new temp directory)')
+    parser.add_argument('--output', help='also write the JSON result here')
+    args = parser.parse_args()
+    args.workdir = args.workdir or tempfile.mkdtemp(prefix='read-path-')
+    os.makedirs(args.workdir, exist_ok=True)
+
+    row_counts = sorted(int(n) for n in args.rows.split(','))
+    levels = [int(n) for n in args.concurrency.split(',')]
+    scenarios = [s.strip() for s in args.scenarios.split(',') if s.strip() in SCENARIOS]
+    database_url = args.database_url or f"sqlite:///{os.path.join(args.workdir, 'images.db')}"
+
+    ports = {'metadata': free_port(), 'gateway': free_port()}
+    env = dict(
+        os.environ,
+        PYTHONPATH=SERVICES_DIR,
+        DATABASE_URL=database_url,
+        # --database-url may point at an empty server database; create the table on boot
+        DB_AUTO_MIGRATE='true',
+        METADATA_SERVICE_URL=f"http://127.0.0.1:{ports['metadata']}",
+    )
+    processes = Processes(args.workdir)
+    processes.start('metadata', [sys.executable, os.path.join(SERVICES_DIR, 'metadata-service/app/metadata_service.py')],
+                    dict(env, PORT=str(ports['metadata'])))
+    processes.start('gateway', [sys.executable, os.path.join(SERVICES_DIR, 'api-gateway/app/gateway.py')],
+                    dict(env, PORT=str(ports['gateway'])))
+    base_url = f"http://127.0.0.1:{ports['metadata' if args.direct else 'gateway']}"
+
+    results = []
+    rng = random.Random(0)
+    try:
+        for name in ports:
+            wait_for(f'http://127.0.0.1:{ports[name]}/health')
+        for rows in row_counts:
+            started = time.perf_counter()
+            seed(database_url, rows, rng)
+            print(f'seeded {rows} rows in {time.perf_counter() - started:.1f}s', file=sys.stderr)
+            for name in scenarios:
+                scenario = Scenario(name, rows, args.per_page, '' if args.direct else '/api')
+                for concurrency in levels:
+                    cell = {'rows': rows, 'scenario': name, 'concurrency': concurrency}
+                    if name == 'export' and rows > args.export_max_rows:
+                        results.append(dict(cell, skipped=f'more than --export-max-rows={args.export_max_rows}'))
+                        continue
+                    cell.update(run_load(base_url, scenario, concurrency, args.duration, args.timeout))
+                    results.append(cell)
+                    print(json.dumps(cell), file=sys.stderr)
+    finally:
+        processes.stop()
+
+    report = {
+        'benchmark': 'read_path',
+        'revision': git_revision(),
+        'timestamp': datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+        'machine': {'cpus': os.cpu_count()},
+        'config': {
+            'rows': row_counts, 'concurrency': levels, 'scenarios': scenarios, 'duration': args.duration,
+            'per_page': args.per_page, 'target': 'metadata-service' if args.direct else 'gateway',
+            'database': database_url.split(':', 1)[0],
+        },
+        'results': results,
+        'scaling': scaling_summary(results),
+        'workdir': args.workdir,
+    }
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+
+if __name__ == '__main__':
+    main()
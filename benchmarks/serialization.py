@@ -0,0 +1,136 @@
+﻿"""
+Microbenchmark: listing serialization in the metadata-service.
+
+Loads the metadata-service in-process on a seeded SQLite file and times one listing
+page, from query to encoded bytes, four ways:
+
+  orm_to_dict     Image ORM objects, to_dict() and jsonify (the previous listing path)
+  columns_json    column tuples encoded with the standard library json module
+  columns_orjson  column tuples encoded with orjson (the listing default)
+  columns_msgpack column tuples encoded as MessagePack (Accept: application/msgpack)
+
+    python benchmarks/serialization.py --rows 20000 --page-sizes 50,1000,10000 --output ser.json
+
+Reports rows serialized per second and the encoded size for every page size, and the
+speedup of each variant over orm_to_dict.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+
+from e2e_import import SERVICES_DIR, git_revision  # noqa: E402
+from read_path import seed  # noqa: E402
+
+VARIANTS = ('orm_to_dict', 'columns_json', 'columns_orjson', 'columns_msgpack')
+
+def load_service(database_url):
+    os.environ['DATABASE_URL'] = database_url
+    os.environ['DB_AUTO_MIGRATE'] = 'true'
+    sys.path[:0] = [SERVICES_DIR, os.path.join(SERVICES_DIR, 'metadata-service/app')]
+    import metadata_service
+    return metadata_service
+
+def encoders(service):
+    """variant -> function(limit) returning the encoded bytes of the newest limit rows"""
+    from common import serialization
+
+    Image, db = service.Image, service.db
+
+    def statement(limit):
+        return db.select(*service.LISTING_COLUMNS).order_by(Image.created_at.desc()).limit(limit)
+
+    def orm_to_dict(limit):
+        images = Image.query.order_by(Image.created_at.desc()).limit(limit).all()
+        return service.jsonify({'images': [image.to_dict() for image in images]}).get_data()
+
+    def columns_json(limit):
+        payload = {'images': service.listing_rows(statement(limit))}
+        return json.dumps(payload, default=serialization._default, separators=(',', ':')).encode('utf-8')
+
+    def columns_orjson(limit):
+        return serialization.dumps({'images': service.listing_rows(statement(limit))}, serialization.JSON)
+
+    def columns_msgpack(limit):
+        return serialization.dumps({'images': service.listing_rows(statement(limit))}, serialization.MSGPACK)
+
+    return {
+        'orm_to_dict': orm_to_dict, 'columns_json': columns_json,
+        'columns_orjson': columns_orjson, 'columns_msgpack': columns_msgpack,
+    }
+
+def measure(function, limit, min_seconds, session):
+    """Repeat function(limit) for at least min_seconds; rows/s over all repetitions"""
+    function(limit)  # warm up caches and the connection pool
+    repetitions, started = 0, time.perf_counter()
+    while True:
+        size = len(function(limit))
+        repetitions += 1
+        # A fresh session per repetition, as every request gets one
+        session.remove()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_seconds:
+            return {'rows_per_second': round(limit * repetitions / elapsed), 'bytes': size,
+                    'ms_per_page': round(elapsed / repetitions * 1000, 2)}
+
+def main():
+    parser = argparse.ArgumentParser(description='Listing serialization microbenchmark (metadata-service)')
+    parser.add_argument('--rows', type=int, default=20000, help='rows seeded into the table')
+    parser.add_argument('--page-sizes', default='50,1000,10000')
+    parser.add_argument('--variants', default=','.join(VARIANTS))
+    parser.add_argument('--seconds', type=float, default=2, help='minimum seconds per measurement')
+    parser.add_argument('--workdir', help='database directory (default: a new temp directory)')
+    parser.add_argument('--output', help='also write the JSON result here')
+    args = parser.parse_args()
+    args.workdir = args.workdir or tempfile.mkdtemp(prefix='serialization-')
+    os.makedirs(args.workdir, exist_ok=True)
+
+    database_url = f"sqlite:///{os.path.join(args.workdir, 'images.db')}"
+    service = load_service(database_url)
+    seed(database_url, args.rows, random.Random(0))
+    functions = encoders(service)
+    variants = [v.strip() for v in args.variants.split(',') if v.strip() in functions]
+
+    results = []
+    with service.app.test_request_context():
+        for limit in sorted(int(n) for n in args.page_sizes.split(',')):
+            limit = min(limit, args.rows)
+            for variant in variants:
+                cell = {'page_size': limit, 'variant': variant}
+                cell.update(measure(functions[variant], limit, args.seconds, service.db.session))
+                results.append(cell)
+                print(json.dumps(cell), file=sys.stderr)
+
+    baseline = {r['page_size']: r['rows_per_second'] for r in results if r['variant'] == 'orm_to_dict'}
+    speedup = {
+        str(size): {
+            r['variant']: round(r['rows_per_second'] / baseline[size], 2)
+            for r in results if r['page_size'] == size and r['variant'] != 'orm_to_dict'
+        }
+        for size in baseline
+    }
+    report = {
+        'benchmark': 'serialization',
+        'revision': git_revision(),
+        'timestamp': datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+        'machine': {'cpus': os.cpu_count()},
+        'config': {'rows': args.rows, 'variants': variants, 'seconds': args.seconds},
+        'results': results,
+        # rows/s of each variant divided by orm_to_dict's, per page size
+        'speedup': speedup,
+    }
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+﻿"""
+Flask development server vs gunicorn for the metadata-service.
+
+Seeds a SQLite database, then serves it with the development server (app.run, one
+process) and with gunicorn (services/common/gunicorn_conf.py) at each --workers count,
+and runs the same closed-loop read load against each:
+
+    python benchmarks/serving.py --workers 1,2,4,8 --concurrency 32 --output serving.json
+
+The JSON output has requests/s, errors and p50/p99 latency per server, scenario and
+worker count, plus the speedup of every gunicorn run over the development server. The
+load generator runs on the same machine, so throughput stops scaling before the worker
+count reaches the number of cores; compare runs from the same host.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+
+from e2e_import import SERVICES_DIR, Processes, free_port, git_revision  # noqa: E402
+from read_path import Scenario, run_load, seed  # noqa: E402
+from worker_engines import wait_for  # noqa: E402
+
+METADATA_DIR = os.path.join(SERVICES_DIR, 'metadata-service/app')
+
+def server_command(workers):
+    """argv for the development server (workers=None) or gunicorn with that many workers"""
+    if workers is None:
+        return [sys.executable, os.path.join(METADATA_DIR, 'metadata_service.py')]
+    return [
+        sys.executable, '-m', 'gunicorn', '-c', os.path.join(SERVICES_DIR, 'common/gunicorn_conf.py'),
+        '--chdir', METADATA_DIR, 'metadata_service:app',
+    ]
+
+def main():
+    parser = argparse.ArgumentParser(description='Development server vs gunicorn (metadata-service)')
+    default_workers = sorted({1, 2, os.cpu_count() or 1, 2 * (os.cpu_count() or 1) + 1})
+    parser.add_argument('--workers', default=','.join(map(str, default_workers)),
+                        help='gunicorn worker counts, comma-separated')
+    parser.add_argument('--threads', type=int, default=1, help='GUNICORN_THREADS per worker')
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--scenarios', default='detail,gallery')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per scenario and server')
+    parser.add_argument('--per-page', type=int, default=50)
+    parser.add_argument('--timeout', type=float, default=60, help='per-request timeout in seconds')
+    parser.add_argument('--workdir', help='database and server logs (default: a new temp directory)')
+    parser.add_argument('--output', help='also write the JSON result here')
+    args = parser.parse_args()
+    args.workdir = args.workdir or tempfile.mkdtemp(prefix='serving-')
+    os.makedirs(args.workdir, exist_ok=True)
+
+    worker_counts = sorted(int(n) for n in args.workers.split(','))
+    scenarios = [s.strip() for s in args.scenarios.split(',') if s.strip()]
+    database_url = f"sqlite:///{os.path.join(args.workdir, 'images.db')}"
+    env = dict(os.environ, PYTHONPATH=SERVICES_DIR, DATABASE_URL=database_url, GUNICORN_THREADS=str(args.threads))
+
+    results = []
+    processes = Processes(args.workdir)
+    try:
+        for workers in [None] + worker_counts:
+            name = 'dev' if workers is None else f'gunicorn-{workers}'
+            port = free_port()
+            processes.start(name, server_command(workers),
+                            dict(env, PORT=str(port), WEB_CONCURRENCY=str(workers or 1)))
+            base_url = f'http://127.0.0.1:{port}'
+            try:
+                wait_for(f'{base_url}/health')
+                if not results:
+                    # The first server creates the table; seed it once for every run
+                    started = time.perf_counter()
+                    seed(database_url, args.rows, random.Random(0))
+                    print(f'seeded {args.rows} rows in {time.perf_counter() - started:.1f}s', file=sys.stderr)
+                for scenario in scenarios:
+                    cell = {'server': 'dev' if workers is None else 'gunicorn', 'workers': workers or 1,
+                            'scenario': scenario}
+                    cell.update(run_load(base_url, Scenario(scenario, args.rows, args.per_page, ''),
+                                         args.concurrency, args.duration, args.timeout))
+                    results.append(cell)
+                    print(json.dumps(cell), file=sys.stderr)
+            finally:
+                processes.stop([name])
+    finally:
+        processes.stop()
+
+    baseline = {r['scenario']: r['requests_per_second'] for r in results if r['server'] == 'dev'}
+    speedup = {
+        scenario: {
+            str(r['workers']): round(r['requests_per_second'] / baseline[scenario], 2)
+            for r in results if r['server'] == 'gunicorn' and r['scenario'] == scenario and baseline[scenario]
+        }
+        for scenario in baseline
+    }
+    report = {
+        'benchmark': 'serving',
+        'revision': git_revision(),
+        'timestamp': datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+        'machine': {'cpus': os.cpu_count()},
+        'config': {
+            'workers': worker_counts, 'threads': args.threads, 'rows': args.rows,
+            'concurrency': args.concurrency, 'scenarios': scenarios, 'duration': args.duration,
+        },
+        'results': results,
+        # gunicorn requests/s divided by the development server's, per worker count
+        'speedup': speedup,
+        'workdir': args.workdir,
+    }
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+
+if __name__ == '__main__':
+    main()
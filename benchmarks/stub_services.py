@@ -0,0 +1,95 @@
+﻿"""
+Stub storage, metadata and import services for worker benchmarks.
+
+One Flask app answers the endpoints the worker calls (/upload, /multipart/*, /images,
+/import/update-status) after an optional fixed --latency, without storing anything, and
+counts what it saw at /_stats. Set STORAGE_SERVICE_URL, METADATA_SERVICE_URL and
+IMPORT_SERVICE_URL to its address.
+
+    python benchmarks/stub_services.py --port 9100 --latency 0.02
+"""
+import argparse
+import itertools
+import threading
+import time
+import uuid
+
+from flask import Flask, jsonify, request
+
+def create_app(latency=0.0):
+    app = Flask(__name__)
+    stats = {'uploads': 0, 'parts': 0, 'images': 0, 'status_updates': 0, 'recorded': 0, 'failed': 0}
+    stats_lock = threading.Lock()
+    image_ids = itertools.count(1)
+
+    def count(name, amount=1):
+        with stats_lock:
+            stats[name] += amount
+
+    @app.before_request
+    def delay():
+        if latency and not request.path.startswith('/_'):
+            time.sleep(latency)
+
+    @app.route('/upload', methods=['POST'])
+    def upload():
+        data = request.get_json()
+        count('uploads')
+        key = f"{uuid.uuid4()}_{data['filename']}"
+        return jsonify({'success': True, 'url': f'http://stub/{key}', 'key': key, 'provider': data.get('provider', 'memory')})
+
+    @app.route('/multipart', methods=['POST'])
+    def multipart_start():
+        data = request.get_json()
+        return jsonify({'upload_id': uuid.uuid4().hex, 'key': f"{uuid.uuid4()}_{data['filename']}",
+                        'provider': data.get('provider', 'memory')}), 201
+
+    @app.route('/multipart/<upload_id>', methods=['GET'])
+    def multipart_parts(upload_id):
+        return jsonify({'upload_id': upload_id, 'parts': []})
+
+    @app.route('/multipart/<upload_id>/parts/<int:part_number>', methods=['PUT'])
+    def multipart_part(upload_id, part_number):
+        count('parts')
+        return jsonify({'part_number': part_number, 'size': len(request.get_data())})
+
+    @app.route('/multipart/<upload_id>/complete', methods=['POST'])
+    def multipart_complete(upload_id):
+        data = request.get_json()
+        count('uploads')
+        return jsonify({'success': True, 'url': f"http://stub/{data['key']}", 'key': data['key'],
+                        'provider': data.get('provider', 'memory')})
+
+    @app.route('/images', methods=['POST'])
+    def save_image():
+        data = request.get_json()
+        count('images')
+        return jsonify({**data, 'id': next(image_ids)}), 201
+
+    @app.route('/import/update-status', methods=['POST'])
+    def update_status():
+        data = request.get_json()
+        count('status_updates')
+        if data.get('state') == 'recorded':
+            count('recorded')
+        elif data.get('state') == 'failed':
+            count('failed')
+        return jsonify({'success': True})
+
+    @app.route('/_stats', methods=['GET'])
+    def get_stats():
+        with stats_lock:
+            return jsonify(dict(stats))
+
+    return app
+
+def main():
+    parser = argparse.ArgumentParser(description='Stub storage/metadata/import services')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9100)
+    parser.add_argument('--latency', type=float, default=0.0)
+    args = parser.parse_args()
+    create_app(args.latency).run(host=args.host, port=args.port, threaded=True)
+
+if __name__ == '__main__':
+    main()
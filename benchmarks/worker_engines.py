@@ -0,0 +1,175 @@
+﻿"""
+Worker engine benchmark: imports --files files through each worker engine (the
+thread pool, the staged pipeline and the asyncio engine) against local stubs (fake_drive.py for Drive, stub_services.py
+for storage/metadata/import), each engine in a fresh process.
+
+    python benchmarks/worker_engines.py --files 2000 --latency 0.05
+
+Prints one JSON object per engine: files/second, failures, and the peak RSS and thread
+count of the worker process tree (sampled from /proc, so Linux only).
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+WORKER_DIR = os.path.join(ROOT, 'services', 'worker-service')
+
+def proc_status(pid):
+    """(rss_bytes, threads) of a process from /proc/<pid>/status"""
+    rss = threads = 0
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1]) * 1024
+                elif line.startswith('Threads:'):
+                    threads = int(line.split()[1])
+    except OSError:
+        pass
+    return rss, threads
+
+class TreeSampler(threading.Thread):
+    """Samples the summed RSS and threads of this process and its children"""
+    def __init__(self, interval=0.05):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_threads = 0
+        self.running = True
+
+    def run(self):
+        import multiprocessing
+        while self.running:
+            pids = [os.getpid()] + [child.pid for child in multiprocessing.active_children()]
+            samples = [proc_status(pid) for pid in pids]
+            self.peak_rss = max(self.peak_rss, sum(rss for rss, _ in samples))
+            self.peak_threads = max(self.peak_threads, sum(threads for _, threads in samples))
+            time.sleep(self.interval)
+
+def run_engine(args):
+    """Child mode: process every file with one engine and print the result"""
+    sys.path.insert(0, WORKER_DIR)
+    import worker
+
+    files = [
+        {'id': f'fake-{i:06d}', 'name': f'image_{i:06d}.jpg', 'mimeType': 'image/jpeg', 'size': str(args.file_size)}
+        for i in range(args.files)
+    ]
+    sampler = TreeSampler()
+    sampler.start()
+    started = time.perf_counter()
+
+    if args.run == 'async':
+        engine = worker.get_async_engine()
+        engine.submit('bench', files)
+        while True:
+            stats = engine.stats()
+            if stats['completed'] + stats['failed'] >= len(files):
+                break
+            time.sleep(0.05)
+        failed = stats['failed']
+    elif args.run == 'pipeline':
+        active_pipeline = worker.get_pipeline()
+        for file_data in files:
+            active_pipeline.submit(worker.new_item(file_data, 'bench'))
+        active_pipeline.join()
+        failed = sum(stage['failed'] for stage in active_pipeline.stats()['stages'])
+    else:
+        futures = [worker.executor.submit(worker.process_single_image, f, 'bench') for f in files]
+        failed = sum(1 for future in futures if not future.result()['success'])
+
+    elapsed = time.perf_counter() - started
+    sampler.running = False
+    sampler.join()
+    if args.run == 'async':
+        engine.stop(timeout=10)
+
+    print(json.dumps({
+        'engine': args.run,
+        'files': len(files),
+        'failed': failed,
+        'seconds': round(elapsed, 2),
+        'files_per_second': round((len(files) - failed) / elapsed, 1),
+        'peak_rss_mb': round(sampler.peak_rss / 1e6, 1),
+        'peak_threads': sampler.peak_threads,
+    }))
+
+def wait_for(url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(url, timeout=1).read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f'{url} did not come up')
+
+def main():
+    parser = argparse.ArgumentParser(description='Worker engine benchmark')
+    parser.add_argument('--files', type=int, default=2000)
+    parser.add_argument('--file-size', type=int, default=64 * 1024)
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds added by every stub request')
+    parser.add_argument('--engine', choices=('threads', 'pipeline', 'async', 'all'), default='all')
+    parser.add_argument('--processes', type=int, default=0, help='async event-loop processes (0 = one per core)')
+    parser.add_argument('--in-flight', type=int, default=1000, help='async files in flight per process')
+    parser.add_argument('--drive-port', type=int, default=9000)
+    parser.add_argument('--stub-port', type=int, default=9100)
+    parser.add_argument('--run', choices=('threads', 'pipeline', 'async'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        run_engine(args)
+        return
+
+    servers = [
+        subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, 'fake_drive.py'), '--host', '127.0.0.1',
+                          '--port', str(args.drive_port), '--files', str(args.files),
+                          '--file-size', str(args.file_size), '--latency', str(args.latency)],
+                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL),
+        subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, 'stub_services.py'),
+                          '--port', str(args.stub_port), '--latency', str(args.latency)],
+                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL),
+    ]
+    stub_url = f'http://127.0.0.1:{args.stub_port}'
+    env = dict(
+        os.environ,
+        PYTHONPATH=os.pathsep.join([os.path.join(ROOT, 'services'), WORKER_DIR]),
+        GOOGLE_DRIVE_API_ENDPOINT=f'http://127.0.0.1:{args.drive_port}/drive/v3/',
+        GOOGLE_API_KEY='bench',
+        STORAGE_SERVICE_URL=stub_url,
+        METADATA_SERVICE_URL=stub_url,
+        IMPORT_SERVICE_URL=stub_url,
+        STORAGE_PROVIDER='memory',
+        # Take the Drive limiter out of the comparison
+        DRIVE_RATE_LIMIT='100000', DRIVE_MAX_RATE='100000',
+        DRIVE_CONCURRENCY='100000', DRIVE_MAX_CONCURRENCY='100000',
+        WORKER_ASYNC_PROCESSES=str(args.processes),
+        WORKER_ASYNC_MAX_IN_FLIGHT=str(args.in_flight),
+        WORKER_ASYNC_DOWNLOAD_CONCURRENCY=str(args.in_flight),
+        WORKER_ASYNC_UPLOAD_CONCURRENCY=str(args.in_flight),
+        WORKER_ASYNC_RECORD_CONCURRENCY=str(args.in_flight),
+    )
+    try:
+        wait_for(f'http://127.0.0.1:{args.drive_port}/_stats')
+        wait_for(f'{stub_url}/_stats')
+        engines = ('threads', 'pipeline', 'async') if args.engine == 'all' else (args.engine,)
+        for engine in engines:
+            subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--run', engine,
+                 '--files', str(args.files), '--file-size', str(args.file_size)],
+                env=dict(env, WORKER_ENGINE=engine), check=True
+            )
+    finally:
+        for server in servers:
+            server.terminate()
+            server.wait()
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,13 @@
 import React, { useState, useEffect, useCallback } from 'react';
-import { getImages, getStats } from '../services/api';
+import { getImages, getImageUrls, getStats } from '../services/api';
 import './ImageGallery.css';
 
+// Columns the cards render; the rest of each row is not fetched
+const GALLERY_FIELDS = ['name', 'size', 'mime_type', 'storage_path', 'storage_key', 'storage_provider'];
+
 const ImageGallery = ({ refreshTrigger }) => {
   const [images, setImages] = useState([]);
+  const [signedUrls, setSignedUrls] = useState({});
   const [stats, setStats] = useState(null);
   const [loading, setLoading] = useState(true);
   const [error, setError] = useState(null);
@@ -13,7 +17,19 @@ const ImageGallery = ({ refreshTrigger }) => {
   const fetchImages = useCallback(async () => {
     try {
       setLoading(true);
-      const data = await getImages(page, 20);
+      const data = await getImages(page, 20, GALLERY_FIELDS);
+
+      // Sign the whole page before rendering so images load straight from storage
+      const keys = data.images.map((image) => image.storage_key).filter(Boolean);
+      if (keys.length > 0) {
+        try {
+          const signed = await getImageUrls(keys);
+          setSignedUrls(signed.urls || {});
+        } catch (err) {
+          console.error('Failed to sign image URLs:', err);
+        }
+      }
+
       setImages(data.images);
       setTotalPages(data.total_pages);
       setError(null);
@@ -39,6 +55,8 @@ const ImageGallery = ({ refreshTrigger }) => {
   }, [page, refreshTrigger, fetchImages, fetchStats]);
 
 
+  const imageUrl = (image) => signedUrls[image.storage_key] || image.storage_path;
+
   const formatBytes = (bytes) => {
     if (bytes === 0) return '0 Bytes';
     const k = 1024;
@@ -104,7 +122,7 @@ const ImageGallery = ({ refreshTrigger }) => {
         {images.map((image) => (
           <div key={image.id} className="image-card">
             <div className="image-preview">
-              <img src={image.storage_path} alt={image.name} />
+              <img src={imageUrl(image)} alt={image.name} />
             </div>
             <div className="image-info">
               <h4>{image.name}</h4>
@@ -117,7 +135,7 @@ const ImageGallery = ({ refreshTrigger }) => {
               </p>
               <div className="image-actions">
                 <a 
-                  href={image.storage_path} 
+                  href={imageUrl(image)} 
                   target="_blank" 
                   rel="noopener noreferrer"
                   className="btn-secondary"
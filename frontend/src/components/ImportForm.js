@@ -1,5 +1,5 @@
 import React, { useState, useEffect } from 'react';
-import { importFromGoogleDrive, getImportStatus } from '../services/api';
+import { importFromGoogleDrive, subscribeImportProgress } from '../services/api';
 import './ImportForm.css';
 
 const ImportForm = ({ onImportComplete }) => {
@@ -13,11 +13,9 @@ const ImportForm = ({ onImportComplete }) => {
   useEffect(() => {
     if (!jobId) return;
 
-    const pollInterval = setInterval(async () => {
-      try {
-        const status = await getImportStatus(jobId);
-
-        
+    // Progress is pushed by the server as it happens, or polled when it refuses the stream
+    const close = subscribeImportProgress(jobId, {
+      onProgress: (status) => {
         setMessage({
           text: `Processing: ${status.processed + status.failed} of ${status.total} images`,
           total: status.total,
@@ -25,28 +23,27 @@ const ImportForm = ({ onImportComplete }) => {
           failed: status.failed,
           status: status.status
         });
-
-        
-        if (status.status === 'completed') {
-          setLoading(false);
-          setJobId(null);
-          setMessage({
-            text: 'Import completed!',
-            total: status.total,
-            processed: status.processed,
-            failed: status.failed,
-            status: 'completed'
-          });
-          if (onImportComplete) {
-            onImportComplete();
-          }
+      },
+      onCompleted: (status) => {
+        setLoading(false);
+        setJobId(null);
+        setMessage({
+          text: 'Import completed!',
+          total: status.total,
+          processed: status.processed,
+          failed: status.failed,
+          status: 'completed'
+        });
+        if (onImportComplete) {
+          onImportComplete();
         }
-      } catch (err) {
-        console.error('Error polling job status:', err);
+      },
+      onError: (err) => {
+        console.error('Error fetching job progress:', err);
       }
-    }, 2000); 
+    });
 
-    return () => clearInterval(pollInterval);
+    return close;
   }, [jobId, onImportComplete]);
 
   const handleSubmit = async (e) => {
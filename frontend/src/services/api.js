@@ -8,6 +8,25 @@ const apiClient = axios.create({
     'Content-Type': 'application/json',
   },
 });
+
+// Deletes return a write token; sending it back keeps the next reads on the primary
+// database, so they show the change even while read replicas lag behind
+const WRITE_TOKEN_HEADER = 'x-last-write';
+let lastWriteToken = null;
+
+apiClient.interceptors.request.use((config) => {
+  if (lastWriteToken) {
+    config.headers[WRITE_TOKEN_HEADER] = lastWriteToken;
+  }
+  return config;
+});
+
+apiClient.interceptors.response.use((response) => {
+  if (response.headers[WRITE_TOKEN_HEADER]) {
+    lastWriteToken = response.headers[WRITE_TOKEN_HEADER];
+  }
+  return response;
+});
 // Import Functions
 export const importFromGoogleDrive = async (folderUrl) => {
   const response = await apiClient.post('/import/google-drive', {
@@ -21,15 +40,71 @@ export const getImportStatus = async (jobId) => {
   return response.data;
 };
 
-export const getImages = async (page = 1, perPage = 50) => {
+const STATUS_POLL_MS = 2000;
+
+// Server-pushed progress for an import job; returns a function that closes the stream.
+// EventSource reconnects on its own and resumes from the last event it received.
+// When the server refuses the stream (too many open, or an error), progress is polled instead.
+export const subscribeImportProgress = (jobId, { onProgress, onCompleted, onError }) => {
+  let timer = null;
+  let closed = false;
+
+  const poll = async () => {
+    try {
+      const status = await getImportStatus(jobId);
+      if (closed) return;
+      if (status.status === 'processing') {
+        onProgress(status);
+        timer = setTimeout(poll, STATUS_POLL_MS);
+      } else {
+        onCompleted(status);
+      }
+    } catch (err) {
+      if (!closed && onError) {
+        onError(err);
+      }
+    }
+  };
+
+  const source = new EventSource(`${API_BASE_URL}/import/events/${jobId}`);
+  source.addEventListener('progress', (event) => onProgress(JSON.parse(event.data)));
+  source.addEventListener('completed', (event) => {
+    source.close();
+    onCompleted(JSON.parse(event.data));
+  });
+  source.onerror = () => {
+    // CLOSED means the server refused the stream; otherwise EventSource is reconnecting
+    if (source.readyState === EventSource.CLOSED && !closed && timer === null) {
+      timer = setTimeout(poll, STATUS_POLL_MS);
+    }
+  };
+  return () => {
+    closed = true;
+    clearTimeout(timer);
+    source.close();
+  };
+};
+
+// fields: optional list of columns to return (id is always included)
+export const getImages = async (page = 1, perPage = 50, fields) => {
+  const response = await apiClient.get('/images', {
+    params: { page, per_page: perPage, fields: fields && fields.join(',') },
+  });
+  return response.data;
+};
+
+// Many images in one request: { images (in ids order), missing }
+export const getImagesById = async (ids, fields) => {
   const response = await apiClient.get('/images', {
-    params: { page, per_page: perPage },
+    params: { ids: ids.join(','), fields: fields && fields.join(',') },
   });
   return response.data;
 };
 
-export const getImage = async (imageId) => {
-  const response = await apiClient.get(`/images/${imageId}`);
+export const getImage = async (imageId, fields) => {
+  const response = await apiClient.get(`/images/${imageId}`, {
+    params: { fields: fields && fields.join(',') },
+  });
   return response.data;
 };
 
@@ -38,6 +113,12 @@ export const deleteImage = async (imageId) => {
   return response.data;
 };
 
+// Sign download URLs for a whole gallery page in one call
+export const getImageUrls = async (keys) => {
+  const response = await apiClient.post('/storage/urls', { keys });
+  return response.data;
+};
+
 export const getStats = async () => {
   const response = await apiClient.get('/stats');
   return response.data;
@@ -46,9 +127,12 @@ export const getStats = async () => {
 const api = {
   importFromGoogleDrive,
   getImportStatus,
+  subscribeImportProgress,
   getImages,
+  getImagesById,
   getImage,
   deleteImage,
+  getImageUrls,
   getStats,
 };
 
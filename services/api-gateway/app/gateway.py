@@ -1,96 +1,274 @@
-﻿from flask import Flask, request, jsonify
+﻿from flask import Flask, request, jsonify, Response
 from flask_cors import CORS
 import requests
+import math
 import os
 from dotenv import load_dotenv
 
 load_dotenv()
 
+from common import instrumentation, profiling, startup, tracing
+
+import upstream
+
+startup.mark('imports')
 app = Flask(__name__)
+instrumentation.init_app(app, 'api-gateway')
+tracing.init_app(app, 'api-gateway')
+profiling.init_app(app, 'api-gateway')
 
 cors_origins = os.getenv('CORS_ORIGINS', '*').strip()
+# Token of a client's last write to the metadata-service; its reads carry it back so
+# they are served from the primary database until replicas have caught up
+WRITE_TOKEN_HEADER = 'X-Last-Write'
+
 if cors_origins == '*' or cors_origins == '':
-    CORS(app)
+    CORS(app, expose_headers=[WRITE_TOKEN_HEADER])
 else:
     origins = [o.strip() for o in cors_origins.split(',') if o.strip()]
-    CORS(app, resources={r"/api/*": {"origins": origins}})
+    CORS(app, resources={r"/api/*": {"origins": origins}}, expose_headers=[WRITE_TOKEN_HEADER])
+startup.mark('app')
 
 # Service URLs
 IMPORT_SERVICE_URL = os.getenv('IMPORT_SERVICE_URL', 'http://import-service:5001')
 METADATA_SERVICE_URL = os.getenv('METADATA_SERVICE_URL', 'http://metadata-service:5002')
+STORAGE_SERVICE_URL = os.getenv('STORAGE_SERVICE_URL', 'http://storage-service:5003')
+
+# Every call goes through a bulkhead, per-instance circuit breakers and, for reads,
+# retries (see upstream.py). A URL may list several instances, comma-separated.
+import_service = upstream.Upstream('import-service', IMPORT_SERVICE_URL)
+metadata_service = upstream.Upstream('metadata-service', METADATA_SERVICE_URL)
+storage_service = upstream.Upstream('storage-service', STORAGE_SERVICE_URL)
+instrumentation.register_gauge(
+    'gateway_circuit_state', 'Circuit breaker state per upstream instance (0 closed, 1 half-open, 2 open)',
+    upstream.breaker_states, label='instance'
+)
+
+# Headers relayed between clients and the storage-service object serving path
+OBJECT_REQUEST_HEADERS = ('Range', 'If-None-Match', 'If-Modified-Since')
+OBJECT_RESPONSE_HEADERS = (
+    'Content-Type', 'Content-Length', 'Content-Range', 'Accept-Ranges',
+    'Cache-Control', 'ETag', 'Last-Modified', 'Location'
+)
+
+# A progress stream sends at least a keepalive comment every SSE_KEEPALIVE_SECONDS (15 by default)
+SSE_READ_TIMEOUT = float(os.getenv('SSE_READ_TIMEOUT', 60))
 
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
     return jsonify({'status': 'healthy', 'service': 'api-gateway'}), 200
 
+@app.route('/upstream/stats', methods=['GET'])
+def upstream_stats():
+    """Breaker state, in-flight calls, retries and hedges per upstream"""
+    return jsonify(upstream.stats()), 200
+
+def unavailable(service, e):
+    """503 for an upstream that failed or was not called; Retry-After while its circuits are open"""
+    response = jsonify({'error': f'{service} service unavailable: {str(e)}'})
+    if getattr(e, 'retry_after', None):
+        response.headers['Retry-After'] = str(math.ceil(e.retry_after))
+    return response, 503
+
+def read_headers():
+    """Forward the client's Accept (JSON or MessagePack) and write token (if any) to the metadata-service"""
+    headers = {'Accept': request.headers.get('Accept', 'application/json')}
+    token = request.headers.get(WRITE_TOKEN_HEADER)
+    if token:
+        headers[WRITE_TOKEN_HEADER] = token
+    return headers
+
+def relay(response):
+    """Pass a service response body through as is, without decoding and re-encoding it"""
+    proxied = Response(response.content, status=response.status_code,
+                       content_type=response.headers.get('Content-Type', 'application/json'))
+    for header in ('Vary', 'Retry-After'):
+        if header in response.headers:
+            proxied.headers[header] = response.headers[header]
+    return proxied
+
+def relay_write_token(response, proxied):
+    """Pass a write token issued by the metadata-service back to the client"""
+    if WRITE_TOKEN_HEADER in response.headers:
+        proxied.headers[WRITE_TOKEN_HEADER] = response.headers[WRITE_TOKEN_HEADER]
+    return proxied
+
 @app.route('/api/import/google-drive', methods=['POST'])
 def import_from_google_drive():
     """Route import request to Import Service"""
     try:
-        response = requests.post(
-            f"{IMPORT_SERVICE_URL}/import/google-drive",
+        response = import_service.post(
+            "/import/google-drive",
             json=request.get_json(),
             timeout=300
         )
         return jsonify(response.json()), response.status_code
     except requests.exceptions.RequestException as e:
-        return jsonify({'error': f'Import service unavailable: {str(e)}'}), 503
+        return unavailable('Import', e)
 
 @app.route('/api/import/status/<job_id>', methods=['GET'])
 def get_import_status(job_id):
     """Get import job status from Import Service"""
     try:
-        response = requests.get(f"{IMPORT_SERVICE_URL}/import/status/{job_id}", timeout=30)
+        response = import_service.get(f"/import/status/{job_id}")
         return jsonify(response.json()), response.status_code
     except requests.exceptions.RequestException as e:
-        return jsonify({'error': f'Import service unavailable: {str(e)}'}), 503
+        return unavailable('Import', e)
+
+@app.route('/api/import/events/<job_id>', methods=['GET'])
+def stream_import_events(job_id):
+    """Relay a job's Server-Sent Events progress stream from Import Service, event by event"""
+    try:
+        headers = {'Accept': 'text/event-stream'}
+        if 'Last-Event-ID' in request.headers:
+            headers['Last-Event-ID'] = request.headers['Last-Event-ID']
+        response = import_service.get(
+            f"/import/events/{job_id}",
+            params=request.args.to_dict(),
+            headers=headers,
+            stream=True,
+            timeout=SSE_READ_TIMEOUT
+        )
+        if response.status_code != 200:
+            return relay(response)
+        # chunk_size=None yields each chunk as it arrives instead of filling a buffer first
+        proxied = Response(
+            response.iter_content(chunk_size=None),
+            mimetype='text/event-stream',
+            direct_passthrough=True,
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        )
+        proxied.call_on_close(response.close)
+        return proxied
+    except requests.exceptions.RequestException as e:
+        return unavailable('Import', e)
+
+@app.route('/api/import/resume/<job_id>', methods=['POST'])
+def resume_import(job_id):
+    """Resume an interrupted import job via Import Service"""
+    try:
+        response = import_service.post(
+            f"/import/resume/{job_id}",
+            params=request.args.to_dict(),
+            timeout=300
+        )
+        return jsonify(response.json()), response.status_code
+    except requests.exceptions.RequestException as e:
+        return unavailable('Import', e)
 
 @app.route('/api/images', methods=['GET'])
 def get_images():
-    """Route request to Metadata Service"""
+    """Route request to Metadata Service: a page, or a multi-get with ids=; fields= projects"""
     try:
         params = request.args.to_dict()
-        response = requests.get(f"{METADATA_SERVICE_URL}/images", params=params, timeout=30)
-        return jsonify(response.json()), response.status_code
+        response = metadata_service.get("/images", params=params, headers=read_headers(), hedge=True)
+        return relay(response)
     except requests.exceptions.RequestException as e:
-        return jsonify({'error': f'Metadata service unavailable: {str(e)}'}), 503
+        return unavailable('Metadata', e)
 
 @app.route('/api/images/all', methods=['GET'])
 def get_all_images():
     """Get all images from Metadata Service"""
     try:
-        response = requests.get(f"{METADATA_SERVICE_URL}/images/all", timeout=30)
-        return jsonify(response.json()), response.status_code
+        response = metadata_service.get(
+            "/images/all", params=request.args.to_dict(), headers=read_headers(), hedge=True, timeout=30
+        )
+        return relay(response)
     except requests.exceptions.RequestException as e:
-        return jsonify({'error': f'Metadata service unavailable: {str(e)}'}), 503
+        return unavailable('Metadata', e)
 
 @app.route('/api/images/<int:image_id>', methods=['GET'])
 def get_image(image_id):
     """Get specific image from Metadata Service"""
     try:
-        response = requests.get(f"{METADATA_SERVICE_URL}/images/{image_id}", timeout=30)
-        return jsonify(response.json()), response.status_code
+        response = metadata_service.get(
+            f"/images/{image_id}", params=request.args.to_dict(), headers=read_headers(), hedge=True
+        )
+        return relay(response)
     except requests.exceptions.RequestException as e:
-        return jsonify({'error': f'Metadata service unavailable: {str(e)}'}), 503
+        return unavailable('Metadata', e)
 
 @app.route('/api/images/<int:image_id>', methods=['DELETE'])
 def delete_image(image_id):
     """Delete image via Metadata Service"""
     try:
-        response = requests.delete(f"{METADATA_SERVICE_URL}/images/{image_id}", timeout=30)
-        return jsonify(response.json()), response.status_code
+        response = metadata_service.delete(f"/images/{image_id}", timeout=30)
+        return relay_write_token(response, jsonify(response.json())), response.status_code
+    except requests.exceptions.RequestException as e:
+        return unavailable('Metadata', e)
+
+@app.route('/api/images/bulk-delete', methods=['POST'])
+def bulk_delete_images():
+    """Bulk delete images (by ids or filter) via Metadata Service"""
+    try:
+        response = metadata_service.post(
+            "/images/bulk-delete",
+            json=request.get_json(),
+            timeout=300
+        )
+        return relay_write_token(response, jsonify(response.json())), response.status_code
     except requests.exceptions.RequestException as e:
-        return jsonify({'error': f'Metadata service unavailable: {str(e)}'}), 503
+        return unavailable('Metadata', e)
 
 @app.route('/api/stats', methods=['GET'])
 def get_stats():
     """Get statistics from Metadata Service"""
     try:
-        response = requests.get(f"{METADATA_SERVICE_URL}/stats", timeout=30)
+        response = metadata_service.get("/stats", headers=read_headers(), hedge=True)
+        return relay(response)
+    except requests.exceptions.RequestException as e:
+        return unavailable('Metadata', e)
+
+@app.route('/api/storage/url', methods=['GET'])
+def get_presigned_url():
+    """Get a presigned download URL for one object from Storage Service"""
+    try:
+        response = storage_service.get("/url", params=request.args.to_dict())
+        proxied = jsonify(response.json())
+        if 'Cache-Control' in response.headers:
+            proxied.headers['Cache-Control'] = response.headers['Cache-Control']
+        return proxied, response.status_code
+    except requests.exceptions.RequestException as e:
+        return unavailable('Storage', e)
+
+@app.route('/api/storage/urls', methods=['POST'])
+def get_presigned_urls():
+    """Get presigned download URLs for many objects in one call from Storage Service"""
+    try:
+        # Signing is safe to repeat, so this POST is retried like a GET
+        response = storage_service.post("/urls", json=request.get_json(), idempotent=True)
         return jsonify(response.json()), response.status_code
     except requests.exceptions.RequestException as e:
-        return jsonify({'error': f'Metadata service unavailable: {str(e)}'}), 503
+        return unavailable('Storage', e)
+
+@app.route('/api/objects/<path:key>', methods=['GET'])
+def get_object(key):
+    """Relay the Storage Service object serving path (redirects and ranged streams)"""
+    try:
+        headers = {name: request.headers[name] for name in OBJECT_REQUEST_HEADERS if name in request.headers}
+        response = storage_service.get(
+            f"/objects/{key}",
+            params=request.args.to_dict(),
+            headers=headers,
+            allow_redirects=False,
+            stream=True,
+            timeout=30
+        )
+        proxied = Response(
+            response.iter_content(chunk_size=256 * 1024),
+            status=response.status_code,
+            direct_passthrough=True
+        )
+        for name in OBJECT_RESPONSE_HEADERS:
+            if name in response.headers:
+                proxied.headers[name] = response.headers[name]
+        proxied.call_on_close(response.close)
+        return proxied
+    except requests.exceptions.RequestException as e:
+        return unavailable('Storage', e)
+
+startup.ready('api-gateway')
 
 if __name__ == '__main__':
     port = int(os.getenv('PORT', 5000))
@@ -0,0 +1,285 @@
+﻿"""
+Resilient calls from the gateway to the services behind it.
+
+Each upstream (import, metadata, storage) is one or more instances: its *_SERVICE_URL
+may list several base URLs, comma-separated. Every call goes through three guards:
+
+- A bulkhead: at most GATEWAY_MAX_IN_FLIGHT calls per upstream wait on it at once. Any
+  more fail at once instead of tying up gateway threads behind a slow service.
+- A circuit breaker per instance: BREAKER_FAILURE_THRESHOLD failures in a row (connection
+  errors, timeouts or 502/503/504) open it, and calls to that instance fail fast for
+  BREAKER_RESET_SECONDS. Then one probe call is let through (half-open); it closes the
+  breaker again on success, or reopens it on failure. Other statuses (a 500 from a bad
+  request) mean the instance answered.
+- Idempotent calls (GETs) are retried up to GATEWAY_RETRIES times, with full-jitter
+  backoff and on another instance when there is one.
+
+A 502/503/504 carrying X-Error-Source is not the instance failing: a dependency behind it
+failed (X-Error-Source: dependency, e.g. the storage-service during a delete) or it shed
+load on purpose (X-Error-Source: capacity). Such responses are returned as they are,
+neither counted by the breaker nor retried.
+
+Hedged calls (GATEWAY_HEDGE_AFTER_MS > 0, upstreams with several instances) send a
+second copy to another instance when the first has not answered within that time, and
+use whichever answers first.
+
+Calls that cannot be made raise UpstreamUnavailable, a requests RequestException, so
+the gateway's existing error handling answers them with 503.
+"""
+import concurrent.futures
+import contextvars
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from common import profiling, server
+
+GATEWAY_CONNECT_TIMEOUT = float(os.getenv('GATEWAY_CONNECT_TIMEOUT', 2))
+GATEWAY_READ_TIMEOUT = float(os.getenv('GATEWAY_READ_TIMEOUT', 10))
+GATEWAY_RETRIES = int(os.getenv('GATEWAY_RETRIES', 2))
+GATEWAY_RETRY_BACKOFF = float(os.getenv('GATEWAY_RETRY_BACKOFF', 0.05))
+GATEWAY_RETRY_BACKOFF_MAX = float(os.getenv('GATEWAY_RETRY_BACKOFF_MAX', 1))
+GATEWAY_MAX_IN_FLIGHT = int(os.getenv('GATEWAY_MAX_IN_FLIGHT', 64))
+GATEWAY_HEDGE_AFTER_MS = float(os.getenv('GATEWAY_HEDGE_AFTER_MS', 0))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv('BREAKER_FAILURE_THRESHOLD', 5))
+BREAKER_RESET_SECONDS = float(os.getenv('BREAKER_RESET_SECONDS', 10))
+
+RETRY_STATUSES = {502, 503, 504}
+ERROR_SOURCE_HEADER = 'X-Error-Source'
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+def instance_failed(response):
+    """Whether a response means the instance itself is failing (not relaying a dependency's error)"""
+    return response.status_code in RETRY_STATUSES and ERROR_SOURCE_HEADER not in response.headers
+
+class UpstreamUnavailable(requests.exceptions.RequestException):
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_seconds=BREAKER_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """Whether a call may go out now; in half-open state only one probe at a time"""
+        with self.lock:
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_seconds:
+                self.state = HALF_OPEN
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN and not self.probing:
+                self.probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.state = CLOSED
+            self.failures = 0
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.probing = False
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+
+    def retry_after(self):
+        """Seconds until the next probe"""
+        with self.lock:
+            return max(self.reset_seconds - (time.monotonic() - self.opened_at), 0)
+
+class Instance:
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.breaker = CircuitBreaker()
+        self.session = None
+
+    def reset(self):
+        """Connection pool sized to the bulkhead, so pooled connections are reused, not dropped"""
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_maxsize=GATEWAY_MAX_IN_FLIGHT))
+        self.session.mount('https://', HTTPAdapter(pool_maxsize=GATEWAY_MAX_IN_FLIGHT))
+
+class Upstream:
+    def __init__(self, name, urls, read_timeout=GATEWAY_READ_TIMEOUT):
+        self.name = name
+        self.instances = [Instance(url) for url in urls.split(',') if url.strip()]
+        self.read_timeout = read_timeout
+        self.slots = threading.BoundedSemaphore(GATEWAY_MAX_IN_FLIGHT)
+        self.in_flight = 0
+        self.counters = {'calls': 0, 'retries': 0, 'hedges': 0, 'hedge_wins': 0, 'rejected': 0, 'failures': 0}
+        self.lock = threading.Lock()
+        for instance in self.instances:
+            instance.reset()
+        _upstreams.append(self)
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def pick(self, exclude=()):
+        """A random instance whose breaker lets a call through, preferring ones not in exclude"""
+        candidates = [i for i in self.instances if i not in exclude] or list(self.instances)
+        random.shuffle(candidates)
+        for instance in candidates:
+            if instance.breaker.allow():
+                return instance
+        return None
+
+    def unavailable(self, reason, retry_after=None):
+        self.count('rejected')
+        return UpstreamUnavailable(f'{self.name}: {reason}', retry_after=retry_after)
+
+    def attempt(self, instance, method, path, timeout, **kwargs):
+        """One call to one instance; updates its breaker. Returns the response or raises"""
+        started = time.perf_counter()
+        try:
+            response = instance.session.request(method, f'{instance.base_url}{path}', timeout=timeout, **kwargs)
+        except Exception:
+            instance.breaker.record_failure()
+            raise
+        finally:
+            profiling.record_timing(self.name, time.perf_counter() - started)
+        if instance_failed(response):
+            instance.breaker.record_failure()
+        else:
+            instance.breaker.record_success()
+        return response
+
+    def hedged(self, instance, method, path, timeout, **kwargs):
+        """Call instance; if it has not answered in GATEWAY_HEDGE_AFTER_MS, race a copy on another instance"""
+        executor = _hedge_executor()
+        first = executor.submit(contextvars.copy_context().run, self.attempt, instance, method, path, timeout, **kwargs)
+        done, _ = concurrent.futures.wait([first], timeout=GATEWAY_HEDGE_AFTER_MS / 1000)
+        other = None if done else self.pick(exclude=[instance])
+        if other is None:
+            return first.result()
+
+        self.count('hedges')
+        second = executor.submit(contextvars.copy_context().run, self.attempt, other, method, path, timeout, **kwargs)
+        pending = {first, second}
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            answered = [f for f in done if f.exception() is None and not instance_failed(f.result())]
+            if answered or not pending:
+                winner = answered[0] if answered else done.pop()
+                if winner is second:
+                    self.count('hedge_wins')
+                for loser in (done | pending) - {winner}:
+                    loser.add_done_callback(_close_response)
+                return winner.result()
+
+    def request(self, method, path, idempotent=None, hedge=False, timeout=None, **kwargs):
+        """
+        Call the upstream. idempotent (default: GET) enables retries; hedge enables hedging
+        when it is configured and there are several instances.
+        """
+        idempotent = method == 'GET' if idempotent is None else idempotent
+        timeout = (GATEWAY_CONNECT_TIMEOUT, timeout or self.read_timeout)
+        hedge = hedge and GATEWAY_HEDGE_AFTER_MS > 0 and len(self.instances) > 1
+        if not self.slots.acquire(blocking=False):
+            raise self.unavailable('too many requests in flight')
+        with self.lock:
+            self.in_flight += 1
+        try:
+            tried = []
+            retries = GATEWAY_RETRIES if idempotent else 0
+            for attempt in range(retries + 1):
+                self.count('calls' if attempt == 0 else 'retries')
+                instance = self.pick(exclude=tried)
+                if instance is None:
+                    raise self.unavailable('circuit open', min(i.breaker.retry_after() for i in self.instances))
+                tried.append(instance)
+                try:
+                    call = self.hedged if hedge else self.attempt
+                    response = call(instance, method, path, timeout, **kwargs)
+                except requests.exceptions.RequestException:
+                    if attempt == retries:
+                        self.count('failures')
+                        raise
+                else:
+                    if not instance_failed(response) or attempt == retries:
+                        return response
+                    response.close()
+                time.sleep(random.uniform(0, min(GATEWAY_RETRY_BACKOFF_MAX, GATEWAY_RETRY_BACKOFF * (2 ** attempt))))
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+            self.slots.release()
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request('DELETE', path, **kwargs)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'instances': [
+                    {'url': i.base_url, 'state': i.breaker.state, 'consecutive_failures': i.breaker.failures}
+                    for i in self.instances
+                ],
+                'in_flight': self.in_flight,
+                **self.counters
+            }
+
+_upstreams = []
+_executor = None
+_executor_lock = threading.Lock()
+
+def _hedge_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # Each hedged call holds up to two of these threads
+            _executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=2 * GATEWAY_MAX_IN_FLIGHT, thread_name_prefix='hedge'
+            )
+        return _executor
+
+def _close_response(future):
+    """Release the connection of a hedged call that lost the race"""
+    if future.exception() is None:
+        future.result().close()
+
+def stats():
+    return {upstream.name: upstream.stats() for upstream in _upstreams}
+
+def breaker_states():
+    """Breaker state of every instance by URL: 0 closed, 1 half-open, 2 open"""
+    return {
+        instance.base_url: STATE_VALUES[instance.breaker.state]
+        for upstream in _upstreams for instance in upstream.instances
+    }
+
+@server.after_fork
+def reset_after_fork():
+    """A forked worker gets its own connection pools and hedge threads"""
+    global _executor, _executor_lock
+    _executor = None
+    _executor_lock = threading.Lock()
+    for upstream in _upstreams:
+        for instance in upstream.instances:
+            instance.reset()
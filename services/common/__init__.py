@@ -0,0 +1 @@
+﻿"""Modules shared by the microservices (copied into each image as the `common` package)."""
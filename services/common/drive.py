@@ -0,0 +1,487 @@
+﻿"""
+Google Drive API access shared by the import-service and the worker-service.
+
+Every Drive call goes through one process-wide DriveRateLimiter:
+- a token bucket caps the request rate,
+- an AIMD limit caps the number of concurrent calls.
+
+Both grow additively while Drive answers normally and are halved when it answers
+403 rateLimitExceeded / 429, so throughput settles just under the quota instead of
+failing in bursts. Throttled and transient (5xx, connection) errors are retried with
+full-jitter exponential backoff, honouring Retry-After when Drive sends it.
+
+Files of at least DRIVE_RANGED_THRESHOLD bytes are downloaded as DRIVE_RANGE_SIZE byte
+ranges fetched concurrently (DRIVE_RANGE_PARALLELISM per file) and written in place
+into one preallocated buffer, so they are not limited to a single stream's throughput.
+
+AsyncDriveRateLimiter and download_media_async are the same for one asyncio event
+loop (the worker's async engine): waiting happens with asyncio instead of blocking threads.
+"""
+import asyncio
+import concurrent.futures
+import io
+import json
+import os
+import random
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+import requests
+
+from common import server
+
+GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY')
+# Point the Drive client at another server (e.g. benchmarks/fake_drive.py), including /drive/v3/
+GOOGLE_DRIVE_API_ENDPOINT = os.getenv('GOOGLE_DRIVE_API_ENDPOINT')
+DEFAULT_DRIVE_API_ENDPOINT = 'https://www.googleapis.com/drive/v3/'
+
+DRIVE_RATE_LIMIT = float(os.getenv('DRIVE_RATE_LIMIT', 10))  # starting requests/second
+DRIVE_MIN_RATE = float(os.getenv('DRIVE_MIN_RATE', 1))
+DRIVE_MAX_RATE = float(os.getenv('DRIVE_MAX_RATE', 100))
+DRIVE_RATE_INCREASE = float(os.getenv('DRIVE_RATE_INCREASE', 1))  # requests/second gained per second of success
+DRIVE_CONCURRENCY = int(os.getenv('DRIVE_CONCURRENCY', 8))  # starting concurrent calls
+DRIVE_MIN_CONCURRENCY = int(os.getenv('DRIVE_MIN_CONCURRENCY', 1))
+DRIVE_MAX_CONCURRENCY = int(os.getenv('DRIVE_MAX_CONCURRENCY', 50))
+DRIVE_DECREASE_FACTOR = float(os.getenv('DRIVE_DECREASE_FACTOR', 0.5))
+DRIVE_MAX_RETRIES = int(os.getenv('DRIVE_MAX_RETRIES', 6))
+DRIVE_BACKOFF_BASE = float(os.getenv('DRIVE_BACKOFF_BASE', 0.5))
+DRIVE_BACKOFF_MAX = float(os.getenv('DRIVE_BACKOFF_MAX', 32))
+
+# Parallel ranged downloads for large files
+DRIVE_RANGED_THRESHOLD = int(os.getenv('DRIVE_RANGED_THRESHOLD', 16 * 1024 * 1024))
+DRIVE_RANGE_SIZE = max(int(os.getenv('DRIVE_RANGE_SIZE', 8 * 1024 * 1024)), 256 * 1024)
+DRIVE_RANGE_PARALLELISM = max(int(os.getenv('DRIVE_RANGE_PARALLELISM', 4)), 1)
+
+# 403 reasons that mean "slow down"; other 403s (dailyLimitExceeded, forbidden) are final
+RATE_LIMIT_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded'}
+TRANSIENT_STATUSES = {500, 502, 503, 504}
+
+class DriveApiError(Exception):
+    """Error response from a raw HTTP call to the Drive API"""
+    def __init__(self, status, reason=None, retry_after=None, message=''):
+        super().__init__(message or f'Drive API returned {status} {reason or ""}'.strip())
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
+def parse_error_reason(content):
+    """Extract error.errors[0].reason from a Drive JSON error body"""
+    try:
+        if isinstance(content, bytes):
+            content = content.decode('utf-8')
+        errors = json.loads(content).get('error', {}).get('errors') or [{}]
+        return errors[0].get('reason')
+    except (ValueError, AttributeError):
+        return None
+
+def parse_retry_after(value):
+    try:
+        return max(float(value), 0.0) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+def error_details(exc):
+    """(status, reason, retry_after) for googleapiclient HttpError and DriveApiError"""
+    if isinstance(exc, DriveApiError):
+        return exc.status, exc.reason, exc.retry_after
+    resp = getattr(exc, 'resp', None)
+    if resp is not None and hasattr(resp, 'status'):
+        return int(resp.status), parse_error_reason(getattr(exc, 'content', b'')), parse_retry_after(resp.get('retry-after'))
+    return None, None, None
+
+def classify_error(exc):
+    """'throttle' for quota errors, 'transient' for retryable failures, None otherwise"""
+    status, reason, _ = error_details(exc)
+    if status == 429 or (status == 403 and reason in RATE_LIMIT_REASONS):
+        return 'throttle'
+    if status in TRANSIENT_STATUSES or (status is None and isinstance(exc, (ConnectionError, TimeoutError))):
+        return 'transient'
+    return None
+
+class TokenBucket:
+    """Thread-safe token bucket; burst holds one second worth of tokens"""
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(max(self.rate, 1.0), self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def set_rate(self, rate):
+        with self.lock:
+            self._refill(time.monotonic())
+            self.rate = rate
+            self.tokens = min(self.tokens, max(rate, 1.0))
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                self._refill(time.monotonic())
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+                wait = (1.0 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class DriveRateLimiter:
+    def __init__(self, rate=DRIVE_RATE_LIMIT, min_rate=DRIVE_MIN_RATE, max_rate=DRIVE_MAX_RATE,
+                 rate_increase=DRIVE_RATE_INCREASE, concurrency=DRIVE_CONCURRENCY,
+                 min_concurrency=DRIVE_MIN_CONCURRENCY, max_concurrency=DRIVE_MAX_CONCURRENCY,
+                 decrease_factor=DRIVE_DECREASE_FACTOR, max_retries=DRIVE_MAX_RETRIES,
+                 backoff_base=DRIVE_BACKOFF_BASE, backoff_max=DRIVE_BACKOFF_MAX):
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.rate_increase = rate_increase
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.decrease_factor = decrease_factor
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self.rate = min(max(rate, min_rate), max_rate)
+        self.limit = float(min(max(concurrency, min_concurrency), max_concurrency))
+        self.bucket = TokenBucket(self.rate)
+        self.in_flight = 0
+        self.last_decrease = 0.0
+        self.counters = {'calls': 0, 'throttled': 0, 'retries': 0, 'failures': 0}
+        self.cond = threading.Condition()
+
+    @contextmanager
+    def slot(self):
+        """Hold one of the AIMD concurrency slots and one rate token"""
+        with self.cond:
+            while self.in_flight >= int(self.limit):
+                self.cond.wait()
+            self.in_flight += 1
+        try:
+            self.bucket.acquire()
+            yield
+        finally:
+            with self.cond:
+                self.in_flight -= 1
+                self.cond.notify_all()
+
+    def on_success(self):
+        with self.cond:
+            # Additive increase: ~rate_increase req/s per second and ~1 slot per window of calls
+            self.rate = min(self.max_rate, self.rate + self.rate_increase / max(self.rate, 1.0))
+            self.limit = min(float(self.max_concurrency), self.limit + 1.0 / self.limit)
+            self.cond.notify_all()
+        self.bucket.set_rate(self.rate)
+
+    def on_throttle(self):
+        with self.cond:
+            self.counters['throttled'] += 1
+            now = time.monotonic()
+            # Calls already in flight fail together; count them as one congestion event
+            if now - self.last_decrease < 1.0:
+                return
+            self.last_decrease = now
+            self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+            self.limit = max(float(self.min_concurrency), self.limit * self.decrease_factor)
+        self.bucket.set_rate(self.rate)
+
+    def backoff(self, attempt, retry_after=None):
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.backoff_max))
+        return delay
+
+    def count(self, name):
+        with self.cond:
+            self.counters[name] += 1
+
+    def retry_delay(self, exc, attempt):
+        """Record a failed attempt; returns the backoff before retrying, or None to give up"""
+        kind = classify_error(exc)
+        if kind == 'throttle':
+            self.on_throttle()
+        if kind is None or attempt >= self.max_retries:
+            self.count('failures')
+            return None
+        self.count('retries')
+        return self.backoff(attempt, error_details(exc)[2])
+
+    def call(self, fn, *args, **kwargs):
+        """Run fn under the limiter, retrying throttled and transient failures"""
+        attempt = 0
+        while True:
+            self.count('calls')
+            try:
+                with self.slot():
+                    result = fn(*args, **kwargs)
+            except Exception as e:
+                delay = self.retry_delay(e, attempt)
+                if delay is None:
+                    raise
+                # Sleep outside the slot so other calls are not blocked by the backoff
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self.on_success()
+            return result
+
+    def stats(self):
+        with self.cond:
+            return {
+                'rate': round(self.rate, 2),
+                'concurrency_limit': int(self.limit),
+                'in_flight': self.in_flight,
+                **self.counters
+            }
+
+class AsyncDriveRateLimiter(DriveRateLimiter):
+    """DriveRateLimiter for one event loop; call() takes a coroutine function"""
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.waiters = asyncio.Condition()
+
+    async def acquire_token(self):
+        bucket = self.bucket
+        while True:
+            with bucket.lock:
+                bucket._refill(time.monotonic())
+                if bucket.tokens >= 1.0:
+                    bucket.tokens -= 1.0
+                    return
+                wait = (1.0 - bucket.tokens) / bucket.rate
+            await asyncio.sleep(wait)
+
+    @asynccontextmanager
+    async def async_slot(self):
+        async with self.waiters:
+            await self.waiters.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+        try:
+            await self.acquire_token()
+            yield
+        finally:
+            async with self.waiters:
+                self.in_flight -= 1
+                self.waiters.notify_all()
+
+    async def call(self, fn, *args, **kwargs):
+        attempt = 0
+        while True:
+            self.count('calls')
+            try:
+                async with self.async_slot():
+                    result = await fn(*args, **kwargs)
+            except Exception as e:
+                delay = self.retry_delay(e, attempt)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            self.on_success()
+            # A success may have raised the concurrency limit
+            async with self.waiters:
+                self.waiters.notify_all()
+            return result
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+def get_limiter():
+    """Process-wide limiter shared by every Drive call"""
+    global _limiter
+    if _limiter is None:
+        with _limiter_lock:
+            if _limiter is None:
+                _limiter = DriveRateLimiter()
+    return _limiter
+
+def build_drive_service(api_key=None):
+    """Drive v3 client; each thread should build its own (httplib2 is not thread-safe)"""
+    from googleapiclient.discovery import build
+
+    client_options = {'api_endpoint': GOOGLE_DRIVE_API_ENDPOINT} if GOOGLE_DRIVE_API_ENDPOINT else None
+    return build(
+        'drive', 'v3',
+        developerKey=api_key or GOOGLE_API_KEY,
+        client_options=client_options,
+        cache_discovery=False
+    )
+
+def execute(request_obj):
+    """Execute a googleapiclient request under the shared limiter"""
+    return get_limiter().call(request_obj.execute)
+
+_http = threading.local()
+
+def _session():
+    """Per-thread requests session so range fetches reuse their connections"""
+    session = getattr(_http, 'session', None)
+    if session is None:
+        session = _http.session = requests.Session()
+    return session
+
+@server.after_fork
+def reset_after_fork():
+    """A forked worker gets its own limiter and HTTP sessions"""
+    global _limiter, _limiter_lock, _http
+    _limiter = None
+    _limiter_lock = threading.Lock()
+    _http = threading.local()
+
+def _fetch_range(uri, view, start, end):
+    """GET bytes start..end (inclusive) and write them into view[start:end + 1]"""
+    try:
+        response = _session().get(uri, headers={'Range': f'bytes={start}-{end}'}, stream=True, timeout=(10, 300))
+        try:
+            if response.status_code != 206:
+                raise DriveApiError(
+                    response.status_code,
+                    parse_error_reason(response.content) if response.status_code >= 400 else None,
+                    parse_retry_after(response.headers.get('Retry-After')),
+                    f'Ranged download returned {response.status_code} for bytes {start}-{end}'
+                )
+            position = start
+            for chunk in response.iter_content(chunk_size=1024 * 1024):
+                if position + len(chunk) > end + 1:
+                    raise DriveApiError(response.status_code, message=f'Range {start}-{end} returned too many bytes')
+                view[position:position + len(chunk)] = chunk
+                position += len(chunk)
+            if position != end + 1:
+                raise ConnectionError(f'Range {start}-{end} ended early at byte {position}')
+        finally:
+            response.close()
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+            requests.exceptions.ChunkedEncodingError) as e:
+        # Dropped or stalled connections are transient, as on the async path
+        raise ConnectionError(str(e)) from e
+
+def download_ranged(file_id, size, api_key=None, range_size=DRIVE_RANGE_SIZE, parallelism=DRIVE_RANGE_PARALLELISM):
+    """Download a file of known size as concurrent HTTP Range requests, reassembled in order"""
+    uri = build_drive_service(api_key).files().get_media(fileId=file_id).uri
+    limiter = get_limiter()
+    # Every range writes straight into its own slice, so ranges can finish in any order
+    file_buffer = io.BytesIO(bytes(size))
+    view = file_buffer.getbuffer()
+    try:
+        ranges = [(start, min(start + range_size, size) - 1) for start in range(0, size, range_size)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(parallelism, len(ranges))) as pool:
+            futures = [pool.submit(limiter.call, _fetch_range, uri, view, start, end) for start, end in ranges]
+            for future in concurrent.futures.as_completed(futures):
+                exc = future.exception()
+                if exc is not None:
+                    for pending in futures:
+                        pending.cancel()
+                    raise exc
+    finally:
+        view.release()
+
+    file_buffer.seek(0)
+    return file_buffer
+
+def download_media(file_id, api_key=None, size=None):
+    """
+    Download a file's content. Files of at least DRIVE_RANGED_THRESHOLD bytes (size as
+    listed by Drive) use parallel ranged requests; smaller ones a single stream where each
+    chunk is a separately limited and retried call.
+    """
+    from googleapiclient.http import MediaIoBaseDownload
+
+    size = int(size or 0)
+    if size >= DRIVE_RANGED_THRESHOLD and DRIVE_RANGE_PARALLELISM > 1:
+        try:
+            return download_ranged(file_id, size, api_key)
+        except DriveApiError as e:
+            # A server that ignores Range answers 200; fall back to a single stream
+            if e.status != 200:
+                raise
+
+    service = build_drive_service(api_key)
+    file_buffer = io.BytesIO()
+    downloader = MediaIoBaseDownload(file_buffer, service.files().get_media(fileId=file_id))
+    limiter = get_limiter()
+
+    done = False
+    while not done:
+        status, done = limiter.call(downloader.next_chunk)
+
+    file_buffer.seek(0)
+    return file_buffer
+
+def media_url(file_id):
+    return f"{(GOOGLE_DRIVE_API_ENDPOINT or DEFAULT_DRIVE_API_ENDPOINT).rstrip('/')}/files/{file_id}"
+
+async def _raise_for_media_status(response, expected):
+    if response.status != expected:
+        content = await response.read() if response.status >= 400 else b''
+        raise DriveApiError(
+            response.status,
+            parse_error_reason(content),
+            parse_retry_after(response.headers.get('Retry-After')),
+            f'Drive media download returned {response.status}'
+        )
+
+async def _fetch_media_async(session, url, params):
+    import aiohttp
+
+    try:
+        async with session.get(url, params=params) as response:
+            await _raise_for_media_status(response, 200)
+            return await response.read()
+    except aiohttp.ClientError as e:
+        raise ConnectionError(str(e)) from e
+
+async def _fetch_range_async(session, url, params, view, start, end):
+    import aiohttp
+
+    try:
+        async with session.get(url, params=params, headers={'Range': f'bytes={start}-{end}'}) as response:
+            await _raise_for_media_status(response, 206)
+            position = start
+            async for chunk in response.content.iter_chunked(1024 * 1024):
+                if position + len(chunk) > end + 1:
+                    raise DriveApiError(response.status, message=f'Range {start}-{end} returned too many bytes')
+                view[position:position + len(chunk)] = chunk
+                position += len(chunk)
+            if position != end + 1:
+                raise ConnectionError(f'Range {start}-{end} ended early at byte {position}')
+    except aiohttp.ClientError as e:
+        raise ConnectionError(str(e)) from e
+
+async def download_media_async(session, limiter, file_id, api_key=None, size=None):
+    """download_media on an aiohttp session, under an AsyncDriveRateLimiter"""
+    url = media_url(file_id)
+    params = {'alt': 'media'}
+    if api_key or GOOGLE_API_KEY:
+        params['key'] = api_key or GOOGLE_API_KEY
+
+    size = int(size or 0)
+    if size >= DRIVE_RANGED_THRESHOLD and DRIVE_RANGE_PARALLELISM > 1:
+        file_buffer = io.BytesIO(bytes(size))
+        view = file_buffer.getbuffer()
+        per_file = asyncio.Semaphore(DRIVE_RANGE_PARALLELISM)
+
+        async def fetch(start, end):
+            async with per_file:
+                await limiter.call(_fetch_range_async, session, url, params, view, start, end)
+
+        tasks = [
+            asyncio.ensure_future(fetch(start, min(start + DRIVE_RANGE_SIZE, size) - 1))
+            for start in range(0, size, DRIVE_RANGE_SIZE)
+        ]
+        try:
+            await asyncio.gather(*tasks)
+            file_buffer.seek(0)
+            return file_buffer
+        except DriveApiError as e:
+            # A server that ignores Range answers 200; fall back to a single stream
+            if e.status != 200:
+                raise
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            view.release()
+
+    return io.BytesIO(await limiter.call(_fetch_media_async, session, url, params))
@@ -0,0 +1,85 @@
+﻿"""
+Gunicorn settings shared by every service (the production serving mode).
+
+    gunicorn -c common/gunicorn_conf.py --chdir app gateway:app
+
+  PORT                         listen port
+  WEB_CONCURRENCY              worker processes (default 2 x cores + 1)
+  GUNICORN_THREADS             threads per worker process (default 1: prefork sync workers;
+                               more than 1 switches to the gthread worker)
+  GUNICORN_MAX_REQUESTS        recycle a worker after this many requests, +/- jitter (0 = never)
+  GUNICORN_PRELOAD             import the app once in the master before forking (default true)
+  GUNICORN_TIMEOUT / GUNICORN_GRACEFUL_TIMEOUT   seconds
+  PROMETHEUS_MULTIPROC_DIR     where the workers' metrics are merged (a temp directory by default)
+  PROFILING_DIR                where the workers share profiles and captures (likewise, with
+                               PROFILING_ENABLED)
+
+SIGHUP restarts the workers gracefully with reloaded settings. With preloading, new code
+needs a new master: send USR2, then QUIT to the old master.
+
+A gthread worker that is recycled or reloaded can close a connection it had just
+accepted but not read yet, and that client sees a reset. Combine threads with
+recycling only behind something that retries.
+"""
+import glob
+import multiprocessing
+import os
+import tempfile
+
+def env_flag(name, default):
+    return os.getenv(name, default).strip().lower() in {'1', 'true', 'yes', 'on'}
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+workers = int(os.getenv('WEB_CONCURRENCY', 0)) or multiprocessing.cpu_count() * 2 + 1
+threads = int(os.getenv('GUNICORN_THREADS', 1))
+worker_class = 'gthread' if threads > 1 else 'sync'
+preload_app = env_flag('GUNICORN_PRELOAD', 'true')
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', 1000))
+max_requests_jitter = int(os.getenv('GUNICORN_MAX_REQUESTS_JITTER', max_requests // 10))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 120))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', 60))
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', 5))
+accesslog = '-' if env_flag('GUNICORN_ACCESS_LOG', 'false') else None
+errorlog = '-'
+
+# Several processes: each writes its Prometheus samples to a shared directory that
+# /metrics merges. Set here, before the app (and prometheus_client) is imported.
+if workers > 1 and not os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+    os.environ['PROMETHEUS_MULTIPROC_DIR'] = tempfile.mkdtemp(prefix='prometheus-')
+if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+    os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'], exist_ok=True)
+    # Samples of a previous run would be merged into this one's
+    for stale in glob.glob(os.path.join(os.environ['PROMETHEUS_MULTIPROC_DIR'], '*.db')):
+        os.remove(stale)
+    # Imported now: child_exit runs inside the arbiter's SIGCHLD handling, where a
+    # first import can be re-entered by the next signal
+    from prometheus_client import multiprocess
+
+# Likewise the processes share one profile and their captures (see profiling.py)
+if workers > 1 and env_flag('PROFILING_ENABLED', 'false') and not os.getenv('PROFILING_DIR'):
+    os.environ['PROFILING_DIR'] = tempfile.mkdtemp(prefix='profiling-')
+
+def on_starting(server):
+    # Once per master, not on reload (SIGHUP), which must not end a running profile: a
+    # session left open by a previous run would start sampling in the new workers
+    if os.getenv('PROFILING_DIR'):
+        for stale in glob.glob(os.path.join(os.environ['PROFILING_DIR'], 'session.json')) + \
+                glob.glob(os.path.join(os.environ['PROFILING_DIR'], 'stacks', '*')):
+            os.remove(stale)
+
+def post_fork(server, worker):
+    from common import server as lifecycle
+    lifecycle.run_after_fork()
+
+def post_worker_init(worker):
+    # Runs once the app is loaded in the worker, with or without preloading
+    from common import server as lifecycle
+    lifecycle.run_when_serving()
+
+def worker_exit(server, worker):
+    from common import server as lifecycle
+    lifecycle.run_before_exit()
+
+def child_exit(server, worker):
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,180 @@
+﻿"""
+Prometheus instrumentation shared by all services.
+
+init_app(app, service) adds per-route request latency / count / error metrics and a
+/metrics endpoint. Services time their transfer stages with stage(), count bytes with
+record_bytes(), errors with record_error(), and publish live values such as queue depths
+or DB pool usage with register_gauge(). Stage and db_query timings also feed the
+per-request breakdown of profiling captures.
+
+With PROMETHEUS_MULTIPROC_DIR set (several processes per service, e.g. the async
+worker engine), every process writes its samples there and /metrics merges them.
+"""
+import os
+import time
+from contextlib import contextmanager
+
+from flask import Response, g, got_request_exception, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest
+)
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+from common import profiling
+
+# Transfers run from milliseconds (metadata writes) to minutes (large Drive files)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+REQUEST_LATENCY = Histogram(
+    'http_request_duration_seconds', 'HTTP request latency by route',
+    ['service', 'method', 'route', 'status'], buckets=LATENCY_BUCKETS
+)
+REQUESTS = Counter('http_requests_total', 'HTTP requests by route', ['service', 'method', 'route', 'status'])
+STAGE_LATENCY = Histogram(
+    'stage_duration_seconds', 'Duration of a processing stage (drive_download, storage_upload, metadata_save, ...)',
+    ['service', 'stage', 'outcome'], buckets=LATENCY_BUCKETS
+)
+BYTES = Counter('transfer_bytes_total', 'Bytes transferred', ['service', 'direction'])
+ERRORS = Counter('errors_total', 'Errors by cause', ['service', 'cause'])
+
+SERVICE = os.getenv('SERVICE_NAME', 'unknown')
+_callbacks = []
+
+def record_bytes(direction, amount):
+    BYTES.labels(SERVICE, direction).inc(amount)
+
+def record_error(cause):
+    ERRORS.labels(SERVICE, cause).inc()
+
+@contextmanager
+def stage(name):
+    """Time a block as one stage; failures are recorded with outcome=error and cause <stage>:<exception>"""
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        STAGE_LATENCY.labels(SERVICE, name, 'error').observe(time.perf_counter() - started)
+        profiling.record_timing(name, time.perf_counter() - started)
+        record_error(f'{name}:{type(e).__name__}')
+        raise
+    STAGE_LATENCY.labels(SERVICE, name, 'ok').observe(time.perf_counter() - started)
+    profiling.record_timing(name, time.perf_counter() - started)
+
+class CallbackCollector:
+    """Reads values at scrape time; names ending in _total are exported as counters"""
+    def __init__(self, name, documentation, callback, label=None):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+        self.label = label
+
+    def collect(self):
+        values = self.callback()
+        if not isinstance(values, dict):
+            values = {None: values}
+        family_class = CounterMetricFamily if self.name.endswith('_total') else GaugeMetricFamily
+        labels = ['service'] + ([self.label] if self.label else [])
+        family = family_class(self.name, self.documentation, labels=labels)
+        for key, value in values.items():
+            if value is not None:
+                family.add_metric([SERVICE] + ([str(key)] if self.label else []), float(value))
+        yield family
+
+def register_gauge(name, documentation, callback, label=None):
+    """
+    Publish callback() at scrape time. callback returns a number, or a dict of
+    {label value: number} when label is given (e.g. queue depth per stage).
+    """
+    collector = CallbackCollector(name, documentation, callback, label)
+    REGISTRY.register(collector)
+    _callbacks.append(collector)
+    return collector
+
+def instrument_sqlalchemy(engine, pool_gauge=True):
+    """
+    Statement timings (stage db_query), DB errors and connection pool usage of a SQLAlchemy
+    engine. Pass pool_gauge=False for further engines of the same service (read replicas).
+    """
+    from sqlalchemy import event
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('metrics_started', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['metrics_started'].pop()
+        STAGE_LATENCY.labels(SERVICE, 'db_query', 'ok').observe(elapsed)
+        profiling.record_timing('db_query', elapsed)
+
+    @event.listens_for(engine, 'handle_error')
+    def on_error(context):
+        started = context.connection.info.get('metrics_started') if context.connection is not None else None
+        if started:
+            STAGE_LATENCY.labels(SERVICE, 'db_query', 'error').observe(time.perf_counter() - started.pop())
+        record_error(f'db:{type(context.original_exception).__name__}')
+
+    if not pool_gauge:
+        return
+    pool = engine.pool
+
+    def usage():
+        stats = {}
+        for name in ('size', 'checkedout', 'checkedin', 'overflow'):
+            method = getattr(pool, name, None)
+            if callable(method):
+                stats[name] = method()
+        return stats
+
+    register_gauge('db_pool_connections', 'Database connection pool usage', usage, label='state')
+
+def register_drive_limiter(get_limiter):
+    """Current limits and call/throttle/retry counters of the shared Drive rate limiter"""
+    register_gauge('drive_rate_limit', 'Drive requests/second currently allowed', lambda: get_limiter().rate)
+    register_gauge('drive_concurrency_limit', 'Concurrent Drive calls currently allowed', lambda: int(get_limiter().limit))
+    register_gauge('drive_in_flight', 'Drive calls in flight', lambda: get_limiter().in_flight)
+    register_gauge(
+        'drive_limiter_events_total', 'Drive calls, throttled responses, retries and final failures',
+        lambda: dict(get_limiter().counters), label='event'
+    )
+
+def metrics_response():
+    multiproc_dir = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+    if multiproc_dir:
+        from prometheus_client import multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry, path=multiproc_dir)
+        for collector in _callbacks:
+            registry.register(collector)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+def init_app(app, service):
+    """Instrument every request of a Flask app and add GET /metrics"""
+    global SERVICE
+    SERVICE = service
+
+    @app.before_request
+    def start_timer():
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def observe_request(response):
+        started = g.pop('metrics_started', None)
+        if started is not None and request.endpoint != 'metrics':
+            # Route templates (/images/<int:image_id>) keep label cardinality bounded
+            route = request.url_rule.rule if request.url_rule else 'unmatched'
+            status = str(response.status_code)
+            REQUEST_LATENCY.labels(SERVICE, request.method, route, status).observe(time.perf_counter() - started)
+            REQUESTS.labels(SERVICE, request.method, route, status).inc()
+            if response.status_code >= 500:
+                record_error(f'http_{status}')
+        return response
+
+    def count_exception(sender, exception, **extra):
+        record_error(f'unhandled:{type(exception).__name__}')
+
+    got_request_exception.connect(count_exception, app, weak=False)
+    app.add_url_rule('/metrics', 'metrics', metrics_response, methods=['GET'])
+    return app
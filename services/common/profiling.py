@@ -0,0 +1,497 @@
+﻿"""
+On-demand CPU profiling and slow-request capture shared by all services.
+
+Off unless PROFILING_ENABLED=true: init_app then adds no request hooks and no routes.
+When on, init_app(app, service) adds:
+
+  POST /debug/profile/start     sample the stacks of every thread of the service every
+                                PROFILING_INTERVAL_MS (?interval_ms=, ?seconds= to stop on
+                                its own; at most PROFILING_MAX_SECONDS)
+  POST /debug/profile/stop      stop and return the samples as folded stacks
+                                ("frame;frame;frame count" per line), the input of
+                                flamegraph.pl, inferno, speedscope and similar tools
+  GET  /debug/profile/captures  recent per-request captures (newest first)
+  GET  /debug/profile/captures/<id>   one capture; ?format=folded for its stacks only
+
+A request sent with `X-Profile: 1` has its own thread sampled from start to finish; the
+response carries X-Profile-Id, the id of its capture. With PROFILING_SLOW_REQUEST_MS set,
+any request still running after that many milliseconds is sampled from then on and kept
+as a capture, together with the time it spent per stage (instrumentation.stage() names
+and db_query). The last PROFILING_KEEP captures are kept in memory.
+
+Under gunicorn a service runs several worker processes, and any of them may receive a
+given request. With PROFILING_DIR set (gunicorn_conf.py sets it when there are several)
+they share the profile and the captures through that directory: start writes
+session.json there, every process samples its own threads while the file exists and
+writes its stacks to stacks/ once it is gone, and stop merges them (X-Profile-Processes
+says how many). Captures are kept as captures/<id>.json, so any process can list and
+serve them. Without PROFILING_DIR the profile and captures belong to the process that
+handled the request (start reports its pid), which only suits a single process.
+
+Every endpoint and the X-Profile header need the X-Profiling-Token header to match
+PROFILING_TOKEN; without a token configured, only requests from localhost are allowed.
+Samples cover the service's own processes (not the async worker engine's children).
+"""
+import collections
+import contextvars
+import glob
+import hmac
+import json
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from common import server
+
+def env_flag(name, default):
+    return os.getenv(name, default).strip().lower() in {'1', 'true', 'yes', 'on'}
+
+PROFILING_ENABLED = env_flag('PROFILING_ENABLED', 'false')
+PROFILING_TOKEN = os.getenv('PROFILING_TOKEN', '')
+PROFILING_INTERVAL_MS = float(os.getenv('PROFILING_INTERVAL_MS', 5))
+PROFILING_MAX_SECONDS = float(os.getenv('PROFILING_MAX_SECONDS', 300))
+PROFILING_SLOW_REQUEST_MS = float(os.getenv('PROFILING_SLOW_REQUEST_MS', 0))
+PROFILING_KEEP = int(os.getenv('PROFILING_KEEP', 50))
+# Shared by the processes of one service; unset, each process profiles on its own
+PROFILING_DIR = os.getenv('PROFILING_DIR', '')
+
+PROFILE_HEADER = 'X-Profile'
+TOKEN_HEADER = 'X-Profiling-Token'
+UNWATCHED_PATHS = {'/health', '/metrics'}
+# How often the watchdog looks for requests crossing the slow threshold while none is sampled
+IDLE_POLL_SECONDS = 0.05
+# How often each process looks for a profile started or stopped by another one
+SESSION_POLL_SECONDS = 0.2
+# How long stop waits for processes that sampled to write their stacks (one may have died)
+STOP_WAIT_SECONDS = 5
+
+SERVICE = os.getenv('SERVICE_NAME', 'unknown')
+
+# Per-request stage timings, collected while a request is watched
+_timings = contextvars.ContextVar('profiling_timings', default=None)
+
+def record_timing(name, seconds):
+    """Add a stage's duration to the current request's breakdown (a no-op outside watched requests)"""
+    timings = _timings.get()
+    if timings is not None:
+        total, count = timings.get(name, (0.0, 0))
+        timings[name] = (total + seconds, count + 1)
+
+def frame_label(code):
+    path = code.co_filename.replace('\\', '/').rsplit('/', 2)[-2:]
+    return f"{code.co_name} ({'/'.join(path)}:{code.co_firstlineno})"
+
+def fold(frame, root):
+    """One stack as a folded line: root first, the innermost frame last"""
+    labels = []
+    while frame is not None:
+        labels.append(frame_label(frame.f_code))
+        frame = frame.f_back
+    labels.append(root)
+    return ';'.join(reversed(labels))
+
+def folded(stacks):
+    return ''.join(f'{stack} {count}\n' for stack, count in stacks.most_common())
+
+def write_json(path, data):
+    """Write a file other processes read whole: they never see it half written"""
+    temporary = f'{path}.{os.getpid()}.tmp'
+    with open(temporary, 'w') as f:
+        json.dump(data, f)
+    os.replace(temporary, path)
+
+def read_json(path):
+    """A file's JSON, or None when it is missing (or still being created)"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def modified(path):
+    try:
+        return os.path.getmtime(path)
+    except FileNotFoundError:
+        return 0
+
+class Sampler:
+    """Samples every thread of the process (except its own) until stopped or max_seconds"""
+    def __init__(self, interval, max_seconds):
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='profiler', daemon=True)
+        self.started = time.monotonic()
+
+    def run(self):
+        own = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident != own:
+                    self.stacks[fold(frame, names.get(ident, str(ident)))] += 1
+            self.samples += 1
+            if time.monotonic() - self.started >= self.max_seconds:
+                return
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        return self.stacks
+
+class SharedProfile:
+    """
+    One profile across every process of the service, through PROFILING_DIR: each process
+    follows session.json, samples while it exists and writes its stacks when it is removed
+    """
+    def __init__(self, directory):
+        self.path = os.path.join(directory, 'session.json')
+        self.stacks_dir = os.path.join(directory, 'stacks')
+        os.makedirs(self.stacks_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.session_id = None
+        self.sampler = None
+        self.stopped = threading.Event()
+
+    def start(self, interval, max_seconds):
+        """Open a session for every process; False when one is open already"""
+        session = {'id': uuid.uuid4().hex[:16], 'interval': interval, 'max_seconds': max_seconds, 'started': time.time()}
+        try:
+            # Exclusive create: of two concurrent starts, one fails
+            with open(self.path, 'x') as f:
+                json.dump(session, f)
+        except FileExistsError:
+            return False
+        return True
+
+    def stop(self):
+        """Close the session; (stacks, samples, processes, seconds) merged over every process, or None"""
+        session = read_json(self.path)
+        if session is None:
+            return None
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            return None
+        prefix = os.path.join(self.stacks_dir, session['id'])
+        deadline = time.monotonic() + STOP_WAIT_SECONDS
+        # A process announces it is sampling with a .started file; wait for its .json
+        while time.monotonic() < deadline:
+            started = {path[:-len('.started')] for path in glob.glob(f'{prefix}-*.started')}
+            if all(os.path.exists(f'{name}.json') for name in started):
+                break
+            time.sleep(SESSION_POLL_SECONDS / 2)
+        stacks, samples, processes = collections.Counter(), 0, 0
+        for path in glob.glob(f'{prefix}-*'):
+            if path.endswith('.json'):
+                result = read_json(path) or {'stacks': {}, 'samples': 0}
+                stacks.update(result['stacks'])
+                samples += result['samples']
+                processes += 1
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        return stacks, samples, processes, time.time() - session['started']
+
+    def follow(self):
+        """This process's side: start and stop sampling as session.json comes and goes"""
+        self.stopped = threading.Event()
+        threading.Thread(target=self.run, name='profiler-session', daemon=True).start()
+
+    def run(self):
+        while not self.stopped.wait(SESSION_POLL_SECONDS):
+            session = read_json(self.path)
+            with self.lock:
+                if (session and session['id']) == self.session_id:
+                    continue
+                self.flush()
+                remaining = session['max_seconds'] - (time.time() - session['started']) if session else 0
+                if remaining > 0:
+                    name = os.path.join(self.stacks_dir, f"{session['id']}-{os.getpid()}")
+                    open(f'{name}.started', 'w').close()
+                    self.session_id = session['id']
+                    self.sampler = Sampler(session['interval'], remaining).start()
+
+    def flush(self):
+        """Stop sampling and write this process's stacks for stop to merge; call with the lock held"""
+        if self.sampler is not None:
+            stacks = self.sampler.stop()
+            name = os.path.join(self.stacks_dir, f'{self.session_id}-{os.getpid()}')
+            write_json(f'{name}.json', {'stacks': dict(stacks), 'samples': self.sampler.samples})
+        self.session_id = None
+        self.sampler = None
+
+    def leave(self):
+        """Before this process exits: hand in what it sampled"""
+        self.stopped.set()
+        with self.lock:
+            self.flush()
+
+class WatchedRequest:
+    def __init__(self, profile):
+        self.thread_id = threading.get_ident()
+        self.started = time.perf_counter()
+        self.profile = profile
+        self.stacks = collections.Counter()
+        self.timings = {}
+
+class Watchdog:
+    """
+    Samples the threads of requests that asked for a profile, and of requests running past
+    the slow threshold; finished ones become captures
+    """
+    def __init__(self, interval, slow_seconds, keep, directory=None):
+        self.interval = interval
+        self.slow_seconds = slow_seconds
+        self.requests = {}
+        self.keep = keep
+        # Captures live in directory when the processes share them, else in memory
+        self.directory = directory
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.captures = collections.deque(maxlen=keep)
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.thread = None
+
+    def watch(self, request_id, profile):
+        watched = WatchedRequest(profile)
+        with self.lock:
+            self.requests[request_id] = watched
+            if self.thread is None:
+                # Started by the first watched request, so only in a serving process
+                self.thread = threading.Thread(target=self.run, name='profiler-watchdog', daemon=True)
+                self.thread.start()
+        if profile:
+            # Sample a profiled request from its start, not after the idle poll
+            self.wake.set()
+        return watched
+
+    def due(self, now):
+        with self.lock:
+            return [
+                watched for watched in self.requests.values()
+                if watched.profile or (self.slow_seconds and now - watched.started >= self.slow_seconds)
+            ]
+
+    def run(self):
+        while True:
+            due = self.due(time.perf_counter())
+            if due:
+                frames = sys._current_frames()
+                for watched in due:
+                    frame = frames.get(watched.thread_id)
+                    if frame is not None:
+                        watched.stacks[fold(frame, SERVICE)] += 1
+            self.wake.wait(self.interval if due else max(self.interval, IDLE_POLL_SECONDS))
+            self.wake.clear()
+
+    def finish(self, request_id, **details):
+        """Stop watching a request; returns its capture when it was profiled or slow, else None"""
+        with self.lock:
+            watched = self.requests.pop(request_id, None)
+        if watched is None:
+            return None
+        seconds = time.perf_counter() - watched.started
+        if not watched.profile and not (self.slow_seconds and seconds >= self.slow_seconds):
+            return None
+        capture = {
+            'id': request_id,
+            'kind': 'profile' if watched.profile else 'slow',
+            'service': SERVICE,
+            'pid': os.getpid(),
+            'finished_at': datetime.utcnow().isoformat(timespec='milliseconds') + 'Z',
+            'duration_ms': round(seconds * 1000, 1),
+            **details,
+            'timings_ms': {
+                name: {'total': round(total * 1000, 1), 'count': count}
+                for name, (total, count) in sorted(watched.timings.items(), key=lambda item: -item[1][0])
+            },
+            'samples': sum(watched.stacks.values()),
+            'stacks': folded(watched.stacks),
+        }
+        self.store(capture)
+        return capture
+
+    def store(self, capture):
+        if not self.directory:
+            self.captures.appendleft(capture)
+            return
+        write_json(os.path.join(self.directory, f"{capture['id']}.json"), capture)
+        for stale in self.capture_files()[self.keep:]:
+            try:
+                os.remove(stale)
+            except FileNotFoundError:
+                pass
+
+    def capture_files(self):
+        """Capture files, newest first"""
+        return sorted(glob.glob(os.path.join(self.directory, '*.json')), key=modified, reverse=True)
+
+    def recent(self):
+        """Kept captures, newest first"""
+        if not self.directory:
+            return list(self.captures)
+        return [capture for capture in map(read_json, self.capture_files()) if capture is not None]
+
+    def find(self, capture_id):
+        if not self.directory:
+            return next((c for c in list(self.captures) if c['id'] == capture_id), None)
+        if not re.fullmatch(r'[0-9a-f]+', capture_id):
+            return None
+        return read_json(os.path.join(self.directory, f'{capture_id}.json'))
+
+    def reset(self):
+        """After a fork: the watchdog thread and the requests it watched stay in the parent"""
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.requests = {}
+        self.thread = None
+
+def summary(capture):
+    """One log line for a slow request"""
+    stages = ', '.join(f"{name} {t['total']} ms x{t['count']}" for name, t in list(capture['timings_ms'].items())[:3])
+    return (f"Slow request {capture['method']} {capture['path']} {capture['status']} "
+            f"{capture['duration_ms']} ms{f' ({stages})' if stages else ''}: capture {capture['id']}")
+
+def init_app(app, service):
+    """Add the profiling endpoints and per-request hooks to a Flask app (only with PROFILING_ENABLED)"""
+    from flask import Response, g, jsonify, request
+
+    global SERVICE
+    SERVICE = service
+    if not PROFILING_ENABLED:
+        return app
+
+    watchdog = Watchdog(
+        PROFILING_INTERVAL_MS / 1000, PROFILING_SLOW_REQUEST_MS / 1000, PROFILING_KEEP,
+        os.path.join(PROFILING_DIR, 'captures') if PROFILING_DIR else None
+    )
+    server.after_fork(watchdog.reset)
+    session = {'sampler': None}
+    session_lock = threading.Lock()
+    shared = SharedProfile(PROFILING_DIR) if PROFILING_DIR else None
+    if shared is not None:
+        server.when_serving(shared.follow)
+        server.before_exit(shared.leave)
+
+    def authorized():
+        if PROFILING_TOKEN:
+            return hmac.compare_digest(request.headers.get(TOKEN_HEADER, ''), PROFILING_TOKEN)
+        return request.remote_addr in ('127.0.0.1', '::1')
+
+    @app.before_request
+    def watch_request():
+        if request.path in UNWATCHED_PATHS or request.path.startswith('/debug/profile'):
+            return
+        profile = request.headers.get(PROFILE_HEADER, '').strip().lower() in {'1', 'true', 'yes', 'on'}
+        if profile and not authorized():
+            profile = False
+        if not profile and not PROFILING_SLOW_REQUEST_MS:
+            return
+        g.profile_id = uuid.uuid4().hex[:16]
+        g.profile_timings_token = _timings.set(watchdog.watch(g.profile_id, profile).timings)
+
+    @app.after_request
+    def finish_request(response):
+        request_id = g.pop('profile_id', None)
+        if request_id is None:
+            return response
+        _timings.reset(g.pop('profile_timings_token'))
+        trace = g.get('trace_span')
+        capture = watchdog.finish(
+            request_id,
+            method=request.method,
+            path=request.path,
+            route=request.url_rule.rule if request.url_rule else None,
+            status=response.status_code,
+            trace_id=trace.context.trace_id if trace is not None else None,
+        )
+        if capture is not None:
+            response.headers['X-Profile-Id'] = request_id
+            if capture['kind'] == 'slow':
+                print(summary(capture))
+        return response
+
+    @app.teardown_request
+    def forget_request(error=None):
+        # Requests that never reached after_request
+        request_id = g.pop('profile_id', None)
+        if request_id is not None:
+            _timings.reset(g.pop('profile_timings_token'))
+            watchdog.finish(request_id, method=request.method, path=request.path, status=500, error=str(error))
+
+    def start_profile():
+        if not authorized():
+            return jsonify({'error': 'Profiling requires a valid X-Profiling-Token'}), 403
+        interval_ms = max(request.args.get('interval_ms', PROFILING_INTERVAL_MS, type=float), 1)
+        seconds = min(request.args.get('seconds', PROFILING_MAX_SECONDS, type=float), PROFILING_MAX_SECONDS)
+        started = {'service': SERVICE, 'interval_ms': interval_ms, 'max_seconds': seconds}
+        if shared is not None:
+            if not shared.start(interval_ms / 1000, seconds):
+                return jsonify({'error': 'A profile is already running'}), 409
+            return jsonify(dict(started, processes='all')), 202
+        with session_lock:
+            if session['sampler'] is not None:
+                return jsonify({'error': 'A profile is already running'}), 409
+            session['sampler'] = Sampler(interval_ms / 1000, seconds).start()
+        # Only this process is sampled, and only it can stop the profile
+        return jsonify(dict(started, processes='this', pid=os.getpid())), 202
+
+    def stop_profile():
+        if not authorized():
+            return jsonify({'error': 'Profiling requires a valid X-Profiling-Token'}), 403
+        if shared is not None:
+            profile = shared.stop()
+            if profile is None:
+                return jsonify({'error': 'No profile is running'}), 409
+            stacks, samples, processes, seconds = profile
+            return Response(folded(stacks), mimetype='text/plain', headers={
+                'X-Profile-Samples': str(samples),
+                'X-Profile-Seconds': str(round(seconds, 1)),
+                'X-Profile-Processes': str(processes),
+            })
+        with session_lock:
+            sampler, session['sampler'] = session['sampler'], None
+        if sampler is None:
+            return jsonify({'error': 'No profile is running'}), 409
+        stacks = sampler.stop()
+        return Response(folded(stacks), mimetype='text/plain', headers={
+            'X-Profile-Samples': str(sampler.samples),
+            'X-Profile-Seconds': str(round(time.monotonic() - sampler.started, 1)),
+            'X-Profile-Processes': '1',
+        })
+
+    def list_captures():
+        if not authorized():
+            return jsonify({'error': 'Profiling requires a valid X-Profiling-Token'}), 403
+        return jsonify({'captures': [
+            {key: value for key, value in capture.items() if key != 'stacks'} for capture in watchdog.recent()
+        ]}), 200
+
+    def get_capture(capture_id):
+        if not authorized():
+            return jsonify({'error': 'Profiling requires a valid X-Profiling-Token'}), 403
+        capture = watchdog.find(capture_id)
+        if capture is None:
+            return jsonify({'error': 'Capture not found'}), 404
+        if request.args.get('format') == 'folded':
+            return Response(capture['stacks'], mimetype='text/plain')
+        return jsonify(capture), 200
+
+    app.add_url_rule('/debug/profile/start', 'profile_start', start_profile, methods=['POST'])
+    app.add_url_rule('/debug/profile/stop', 'profile_stop', stop_profile, methods=['POST'])
+    app.add_url_rule('/debug/profile/captures', 'profile_captures', list_captures, methods=['GET'])
+    app.add_url_rule('/debug/profile/captures/<capture_id>', 'profile_capture', get_capture, methods=['GET'])
+    return app
@@ -0,0 +1,47 @@
+﻿"""
+Fast response encoding for large payloads.
+
+respond(payload) encodes with orjson, or with MessagePack when the client's Accept
+header prefers application/msgpack. Datetimes become ISO 8601 strings in both, the
+same as the to_dict() payloads, so clients see one shape whatever the format.
+"""
+import json
+from datetime import date, datetime
+
+from flask import Response, request
+
+try:
+    import orjson
+except ImportError:  # the standard library encoder still works, only slower
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+MSGPACK_TYPES = (MSGPACK, 'application/x-msgpack')
+
+def _default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not serializable')
+
+def negotiate():
+    """Response mimetype for the current request: MessagePack if Accept prefers it, else JSON"""
+    offered = [JSON, *MSGPACK_TYPES] if msgpack is not None else [JSON]
+    return request.accept_mimetypes.best_match(offered, default=JSON)
+
+def dumps(payload, mimetype=JSON):
+    if mimetype in MSGPACK_TYPES:
+        return msgpack.packb(payload, default=_default)
+    if orjson is not None:
+        return orjson.dumps(payload, default=_default)
+    return json.dumps(payload, default=_default, separators=(',', ':')).encode('utf-8')
+
+def respond(payload, status=200):
+    mimetype = negotiate()
+    response = Response(dumps(payload, mimetype), status=status, mimetype=mimetype)
+    response.vary.add('Accept')
+    return response
@@ -0,0 +1,42 @@
+﻿"""
+Process lifecycle hooks for production serving (gunicorn, see gunicorn_conf.py).
+
+With a preloaded app, gunicorn imports a service once in the master process and forks
+the workers from it. Anything that holds threads, sockets, locks or DB connections must
+be recreated in each worker. Modules register that with @after_fork. Work that should
+finish before a worker exits (recycling after max_requests, graceful reload or shutdown)
+is registered with @before_exit. Background threads that must run only in the process
+serving requests (not in a preloading master, nor in a spawned child that imports the
+module again) are registered with @when_serving; the development server runs them from
+its __main__ block with run_when_serving().
+"""
+_after_fork = []
+_before_exit = []
+_when_serving = []
+
+def after_fork(callback):
+    _after_fork.append(callback)
+    return callback
+
+def before_exit(callback):
+    _before_exit.append(callback)
+    return callback
+
+def when_serving(callback):
+    _when_serving.append(callback)
+    return callback
+
+def run_after_fork():
+    for callback in _after_fork:
+        callback()
+
+def run_when_serving():
+    for callback in _when_serving:
+        callback()
+
+def run_before_exit():
+    for callback in _before_exit:
+        try:
+            callback()
+        except Exception as e:
+            print(f"Error in exit hook {callback.__name__}: {str(e)}")
@@ -0,0 +1,111 @@
+﻿"""
+Startup-time profiling.
+
+Services call mark(name) after each boot step (app setup, database engine, manifest, ...);
+each mark records the time since the previous one, the first since this module was
+imported. With STARTUP_PROFILE=true a service prints its steps once it has booted.
+
+The CLI cold-starts a service module in a fresh interpreter without serving requests
+and breaks its boot time down by import (python -X importtime) and by step:
+
+    python -m common.startup metadata-service/app/metadata_service.py
+    python -m common.startup ../backend/run.py --top 30 --json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+PROFILE = os.getenv('STARTUP_PROFILE', 'false').strip().lower() in {'1', 'true', 'yes', 'on'}
+
+_last = time.perf_counter()
+steps = []
+
+def mark(name):
+    """Record the time since the previous mark (or since this module was imported) as step name"""
+    global _last
+    now = time.perf_counter()
+    steps.append({'step': name, 'ms': round((now - _last) * 1000, 1)})
+    _last = now
+
+def ready(service):
+    """Last mark of a service's boot; prints the breakdown when STARTUP_PROFILE is on"""
+    if PROFILE:
+        breakdown = ', '.join(f"{s['step']} {s['ms']}ms" for s in steps)
+        print(f'{service} startup steps: {breakdown}', file=sys.stderr)
+
+# Runs in the profiled interpreter: load the script as a module (its __main__ block, which
+# would start the server, is skipped) and print the steps it marked
+_BOOTSTRAP = """
+import json, os, runpy, sys, time
+script = sys.argv[1]
+sys.path[:0] = [os.path.dirname(script), sys.argv[2]]
+from common import startup
+started = time.perf_counter()
+runpy.run_path(script, run_name='startup_profile')
+print(json.dumps({'load_ms': round((time.perf_counter() - started) * 1000, 1), 'steps': startup.steps}))
+"""
+
+def parse_importtime(lines):
+    """Top-level imports from -X importtime output: [(module, self_ms, cumulative_ms)]"""
+    imports = []
+    for line in lines:
+        if not line.startswith('import time:') or line.rstrip().endswith('imported package'):
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|', 2)
+        # Nested imports are indented under the module that triggered them
+        if name[1:2] != ' ':
+            imports.append((name.strip(), int(self_us) / 1000, int(cumulative_us) / 1000))
+    return imports
+
+def profile(script, top=20):
+    """Cold-start script in a new interpreter and return its boot time breakdown"""
+    script = os.path.abspath(script)
+    common_parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    started = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', _BOOTSTRAP, script, common_parent],
+        cwd=os.path.dirname(script), capture_output=True, text=True
+    )
+    wall_ms = (time.perf_counter() - started) * 1000
+    if result.returncode != 0:
+        raise RuntimeError(f'{script} failed to start:\n{result.stderr[-2000:]}')
+    loaded = json.loads(result.stdout.strip().splitlines()[-1])
+    imports = parse_importtime(result.stderr.splitlines())
+    return {
+        'script': script,
+        'wall_ms': round(wall_ms, 1),
+        'load_ms': loaded['load_ms'],
+        'imports_ms': round(sum(cumulative for _, _, cumulative in imports), 1),
+        'top_imports': [
+            {'module': name, 'cumulative_ms': round(cumulative, 1), 'self_ms': round(own, 1)}
+            for name, own, cumulative in sorted(imports, key=lambda i: -i[2])[:top]
+        ],
+        'steps': loaded['steps'],
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Break down the cold start of a service')
+    parser.add_argument('script', help='service module, e.g. metadata-service/app/metadata_service.py')
+    parser.add_argument('--top', type=int, default=20, help='number of top-level imports to show')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args()
+    report = profile(args.script, args.top)
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    print(f"{report['script']}")
+    print(f"  interpreter start to ready: {report['wall_ms']:.0f} ms (module load {report['load_ms']:.0f} ms)")
+    print(f"  imports: {report['imports_ms']:.0f} ms")
+    for item in report['top_imports']:
+        print(f"    {item['cumulative_ms']:8.1f} ms  {item['module']}")
+    if report['steps']:
+        print('  steps (each includes the imports made since the previous step):')
+        for item in report['steps']:
+            print(f"    {item['ms']:8.1f} ms  {item['step']}")
+
+if __name__ == '__main__':
+    main()
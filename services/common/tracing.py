@@ -0,0 +1,470 @@
+﻿"""
+Distributed tracing with W3C Trace Context.
+
+init_app(app, service) continues the trace of each incoming request (the `traceparent`
+header) or starts a new one. Outgoing `requests` calls carry the current `traceparent`
+and `baggage`, so one import becomes a single trace across the gateway, import, worker,
+storage and metadata services. Services wrap their own work in span(). Baggage entries
+(job_id, file_id) travel with the trace and are copied onto every span below them.
+
+TRACING_EXPORTER selects where finished spans go:
+  none  tracing off (default)
+  file  one JSON object per line, appended to TRACING_FILE
+  otlp  OTLP/HTTP JSON posted to TRACING_OTLP_ENDPOINT (OpenTelemetry collector, Jaeger, Tempo)
+
+Summarise exported spans for one job (slowest files, and where their time went):
+
+    python -m common.tracing traces.jsonl --job-id <job_id>
+"""
+import argparse
+import atexit
+import contextvars
+import json
+import os
+import queue
+import random
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+from urllib.parse import quote, unquote, urlsplit
+
+from common import server
+
+TRACING_EXPORTER = os.getenv('TRACING_EXPORTER', 'none').strip().lower()
+TRACING_FILE = os.getenv('TRACING_FILE', 'traces.jsonl')
+TRACING_OTLP_ENDPOINT = os.getenv('TRACING_OTLP_ENDPOINT', 'http://localhost:4318/v1/traces')
+# Share of new traces recorded; continued traces follow the caller's sampled flag
+TRACING_SAMPLE_RATE = float(os.getenv('TRACING_SAMPLE_RATE', 1.0))
+TRACING_BATCH_SIZE = int(os.getenv('TRACING_BATCH_SIZE', 512))
+TRACING_FLUSH_INTERVAL = float(os.getenv('TRACING_FLUSH_INTERVAL', 2.0))
+# Spans waiting for export beyond this are dropped instead of held in memory
+TRACING_MAX_QUEUE = int(os.getenv('TRACING_MAX_QUEUE', 10000))
+
+ENABLED = TRACING_EXPORTER in ('file', 'otlp')
+SERVICE = os.getenv('SERVICE_NAME', 'unknown')
+UNTRACED_PATHS = {'/health', '/metrics'}
+MAX_BAGGAGE_LENGTH = 8192
+
+_current = contextvars.ContextVar('current_span', default=None)
+
+class SpanContext:
+    """What crosses process boundaries: ids, the sampled flag and baggage"""
+    def __init__(self, trace_id, span_id, sampled=True, baggage=None):
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.sampled = sampled
+        self.baggage = baggage or {}
+
+    def traceparent(self):
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+class Span:
+    def __init__(self, name, parent=None, kind='internal', attributes=None, baggage=None):
+        parent_context = parent.context if isinstance(parent, Span) else parent
+        span_id = os.urandom(8).hex()
+        if parent_context is not None:
+            self.parent_id = parent_context.span_id
+            self.context = SpanContext(
+                parent_context.trace_id, span_id, parent_context.sampled, dict(parent_context.baggage)
+            )
+        else:
+            self.parent_id = None
+            self.context = SpanContext(os.urandom(16).hex(), span_id, random.random() < TRACING_SAMPLE_RATE)
+        for key, value in (baggage or {}).items():
+            self.context.baggage[key] = str(value)
+        self.name = name
+        self.kind = kind
+        self.service = SERVICE
+        self.attributes = dict(self.context.baggage)
+        self.attributes.update(attributes or {})
+        self.error = None
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def set_baggage(self, key, value):
+        """An attribute that is also propagated to every span downstream of this one"""
+        self.context.baggage[key] = str(value)
+        self.attributes[key] = value
+
+    def record_error(self, error):
+        self.error = f'{type(error).__name__}: {error}' if isinstance(error, BaseException) else str(error)
+
+    def end(self):
+        if self.end_ns is None:
+            self.end_ns = time.time_ns()
+            if self.context.sampled:
+                _get_exporter().add(self)
+
+    def to_dict(self):
+        return {
+            'service': self.service,
+            'name': self.name,
+            'kind': self.kind,
+            'trace_id': self.context.trace_id,
+            'span_id': self.context.span_id,
+            'parent_id': self.parent_id,
+            'start': self.start_ns / 1e9,
+            'duration_ms': round((self.end_ns - self.start_ns) / 1e6, 3),
+            'attributes': self.attributes,
+            'error': self.error,
+        }
+
+class _NoopSpan:
+    """Returned while tracing is off, so call sites need no checks"""
+    context = None
+
+    def set_attribute(self, key, value):
+        pass
+
+    def set_baggage(self, key, value):
+        pass
+
+    def record_error(self, error):
+        pass
+
+    def end(self):
+        pass
+
+NOOP_SPAN = _NoopSpan()
+
+def current_span():
+    return _current.get()
+
+def set_attribute(key, value):
+    """Tag the current span (if any)"""
+    active = _current.get()
+    if active is not None:
+        active.set_attribute(key, value)
+
+def set_baggage(key, value):
+    """Tag the current span and everything downstream of it (if any)"""
+    active = _current.get()
+    if active is not None:
+        active.set_baggage(key, value)
+
+def start_span(name, parent=None, kind='internal', baggage=None, **attributes):
+    """
+    Start a span without making it current; end() it when done. For work that moves
+    between threads, e.g. a file passing through the worker's pipeline stages.
+    """
+    if not ENABLED:
+        return NOOP_SPAN
+    parent = parent if parent is not None else _current.get()
+    if parent is NOOP_SPAN:
+        parent = None
+    return Span(name, parent, kind, attributes, baggage)
+
+@contextmanager
+def use_span(active, end=False):
+    """Make a started span current for the block"""
+    if active is NOOP_SPAN or active is None:
+        yield active
+        return
+    token = _current.set(active)
+    try:
+        yield active
+    except Exception as e:
+        active.record_error(e)
+        raise
+    finally:
+        _current.reset(token)
+        if end:
+            active.end()
+
+def span(name, parent=None, kind='internal', baggage=None, **attributes):
+    """Run a block as a span (a child of parent, default the current span)"""
+    return use_span(start_span(name, parent, kind, baggage, **attributes), end=True)
+
+def inject(headers):
+    """Add traceparent and baggage for the current span to a headers mapping"""
+    active = _current.get()
+    if active is not None:
+        headers['traceparent'] = active.context.traceparent()
+        if active.context.baggage:
+            headers['baggage'] = ','.join(
+                f'{quote(key, safe="")}={quote(value, safe="")}' for key, value in active.context.baggage.items()
+            )
+    return headers
+
+def extract(headers):
+    """SpanContext from traceparent/baggage headers, or None when absent or malformed"""
+    parts = headers.get('traceparent', '').strip().lower().split('-')
+    if len(parts) < 4 or len(parts[0]) != 2 or parts[0] == 'ff' or (parts[0] == '00' and len(parts) != 4):
+        return None
+    version, trace_id, span_id, flags = parts[:4]
+    if len(trace_id) != 32 or len(span_id) != 16 or len(flags) != 2:
+        return None
+    try:
+        int(version + trace_id + span_id, 16)
+        sampled = bool(int(flags, 16) & 1)
+    except ValueError:
+        return None
+    if trace_id == '0' * 32 or span_id == '0' * 16:
+        return None
+
+    baggage = {}
+    header = headers.get('baggage', '')
+    if header and len(header) <= MAX_BAGGAGE_LENGTH:
+        for member in header.split(','):
+            key, sep, value = member.split(';')[0].partition('=')
+            if sep and key.strip():
+                baggage[unquote(key.strip())] = unquote(value.strip())
+    return SpanContext(trace_id, span_id, sampled, baggage)
+
+def instrument_requests():
+    """Record every `requests` call made inside a span as a client span and propagate the trace"""
+    import requests
+
+    if getattr(requests.Session.request, 'traced', False):
+        return
+    original = requests.Session.request
+
+    def request(session, method, url, *args, **kwargs):
+        if _current.get() is None:
+            return original(session, method, url, *args, **kwargs)
+        parsed = urlsplit(url)
+        # Never the query string: Drive URLs carry the API key there
+        with span(f'{method.upper()} {parsed.netloc}{parsed.path}', kind='client',
+                  **{'http.method': method.upper(), 'http.url': f'{parsed.scheme}://{parsed.netloc}{parsed.path}'}) as client:
+            kwargs['headers'] = inject(dict(kwargs.get('headers') or {}))
+            response = original(session, method, url, *args, **kwargs)
+            client.set_attribute('http.status_code', response.status_code)
+            if response.status_code >= 500:
+                client.record_error(f'HTTP {response.status_code}')
+            return response
+
+    request.traced = True
+    requests.Session.request = request
+
+def aiohttp_trace_config():
+    """aiohttp TraceConfig that adds the current trace headers to every request of a session"""
+    import aiohttp
+
+    async def on_request_start(session, trace_config_ctx, params):
+        inject(params.headers)
+
+    config = aiohttp.TraceConfig()
+    config.on_request_start.append(on_request_start)
+    return config
+
+def init_app(app, service):
+    """Trace every request of a Flask app and propagate the trace on outgoing requests calls"""
+    from flask import g, request
+
+    global SERVICE
+    SERVICE = service
+    if not ENABLED:
+        return app
+    instrument_requests()
+
+    @app.before_request
+    def start_request_span():
+        if request.path in UNTRACED_PATHS:
+            return
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        server = Span(f'{request.method} {route}', extract(request.headers), 'server',
+                      {'http.method': request.method, 'http.route': route})
+        g.trace_span = server
+        g.trace_token = _current.set(server)
+
+    @app.after_request
+    def tag_response(response):
+        server = g.get('trace_span')
+        if server is not None:
+            server.set_attribute('http.status_code', response.status_code)
+            if response.status_code >= 500:
+                server.record_error(f'HTTP {response.status_code}')
+            response.headers['X-Trace-Id'] = server.context.trace_id
+        return response
+
+    @app.teardown_request
+    def end_request_span(error=None):
+        server = g.pop('trace_span', None)
+        if server is None:
+            return
+        if error is not None:
+            server.record_error(error)
+        _current.reset(g.pop('trace_token'))
+        server.end()
+
+    return app
+
+def otlp_payload(spans):
+    """OTLP/HTTP JSON body (ids hex-encoded, as the JSON mapping requires)"""
+    def attribute(key, value):
+        if isinstance(value, bool):
+            encoded = {'boolValue': value}
+        elif isinstance(value, int):
+            encoded = {'intValue': str(value)}
+        elif isinstance(value, float):
+            encoded = {'doubleValue': value}
+        else:
+            encoded = {'stringValue': str(value)}
+        return {'key': key, 'value': encoded}
+
+    kinds = {'internal': 1, 'server': 2, 'client': 3}
+    by_service = {}
+    for s in spans:
+        encoded = {
+            'traceId': s.context.trace_id,
+            'spanId': s.context.span_id,
+            'name': s.name,
+            'kind': kinds.get(s.kind, 1),
+            'startTimeUnixNano': str(s.start_ns),
+            'endTimeUnixNano': str(s.end_ns),
+            'attributes': [attribute(k, v) for k, v in s.attributes.items()],
+            'status': {'code': 2, 'message': s.error} if s.error else {'code': 1},
+        }
+        if s.parent_id:
+            encoded['parentSpanId'] = s.parent_id
+        by_service.setdefault(s.service, []).append(encoded)
+    return {'resourceSpans': [
+        {
+            'resource': {'attributes': [attribute('service.name', service)]},
+            'scopeSpans': [{'scope': {'name': 'image-import'}, 'spans': encoded_spans}],
+        }
+        for service, encoded_spans in by_service.items()
+    ]}
+
+def export_file(spans):
+    lines = ''.join(json.dumps(s.to_dict(), default=str) + '\n' for s in spans)
+    # One append per batch keeps lines from several processes sharing the file intact
+    with open(TRACING_FILE, 'a', encoding='utf-8') as f:
+        f.write(lines)
+
+def export_otlp(spans):
+    # urllib rather than requests: the exporter must not trace its own calls
+    body = json.dumps(otlp_payload(spans)).encode('utf-8')
+    req = urllib.request.Request(
+        TRACING_OTLP_ENDPOINT, data=body, headers={'Content-Type': 'application/json'}, method='POST'
+    )
+    urllib.request.urlopen(req, timeout=10).read()
+
+class BatchExporter:
+    """Queues finished spans and exports them in batches from a background thread"""
+    def __init__(self, export):
+        self.export = export
+        self.queue = queue.Queue(maxsize=TRACING_MAX_QUEUE)
+        self.dropped = 0
+        self.lock = threading.Lock()
+        threading.Thread(target=self.run, name='trace-exporter', daemon=True).start()
+
+    def add(self, finished):
+        try:
+            self.queue.put_nowait(finished)
+        except queue.Full:
+            self.dropped += 1
+
+    def drain(self, first=None):
+        batch = [first] if first is not None else []
+        while len(batch) < TRACING_BATCH_SIZE:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def send(self, batch):
+        if not batch:
+            return
+        with self.lock:
+            try:
+                self.export(batch)
+            except Exception as e:
+                print(f"Error exporting {len(batch)} spans: {str(e)}")
+
+    def run(self):
+        while True:
+            try:
+                first = self.queue.get(timeout=TRACING_FLUSH_INTERVAL)
+            except queue.Empty:
+                continue
+            self.send(self.drain(first))
+
+    def flush(self):
+        while not self.queue.empty():
+            self.send(self.drain())
+
+_exporter = None
+_exporter_pid = None
+_exporter_lock = threading.Lock()
+
+def _get_exporter():
+    """The process's exporter, started on first use (and again in a forked child)"""
+    global _exporter, _exporter_pid
+    if _exporter_pid != os.getpid():
+        with _exporter_lock:
+            if _exporter_pid != os.getpid():
+                _exporter = BatchExporter(export_otlp if TRACING_EXPORTER == 'otlp' else export_file)
+                _exporter_pid = os.getpid()
+    return _exporter
+
+@server.before_exit
+@atexit.register
+def flush():
+    """Export everything still queued (call before a process exits)"""
+    if _exporter is not None and _exporter_pid == os.getpid():
+        _exporter.flush()
+
+def load_spans(paths):
+    spans = []
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            spans.extend(json.loads(line) for line in f if line.strip())
+    return spans
+
+def percentile(values, share):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))] if ordered else None
+
+def report(spans, job_id=None, trace_id=None, top=10):
+    """Slowest files and per-hop latency from exported spans"""
+    if job_id:
+        spans = [s for s in spans if s['attributes'].get('job_id') == job_id]
+    if trace_id:
+        spans = [s for s in spans if s['trace_id'] == trace_id]
+
+    hops = {}
+    for s in spans:
+        hops.setdefault((s['service'], s['name']), []).append(s['duration_ms'])
+    hop_rows = sorted(
+        ({'service': service, 'span': name, 'count': len(durations),
+          'p50_ms': percentile(durations, 0.5), 'p95_ms': percentile(durations, 0.95),
+          'max_ms': max(durations), 'total_ms': round(sum(durations), 1)}
+         for (service, name), durations in hops.items()),
+        key=lambda row: row['total_ms'], reverse=True
+    )
+
+    files = [s for s in spans if s['name'] == 'import_file']
+    slowest = []
+    for file_span in sorted(files, key=lambda s: s['duration_ms'], reverse=True)[:top]:
+        file_id = file_span['attributes'].get('file_id')
+        breakdown = {}
+        for s in spans:
+            if s['attributes'].get('file_id') == file_id and s['kind'] != 'client' and s is not file_span:
+                key = f"{s['service']}:{s['name']}"
+                breakdown[key] = round(breakdown.get(key, 0) + s['duration_ms'], 1)
+        slowest.append({
+            'file_id': file_id,
+            'trace_id': file_span['trace_id'],
+            'duration_ms': file_span['duration_ms'],
+            'error': file_span['error'],
+            'spans': dict(sorted(breakdown.items(), key=lambda item: item[1], reverse=True)),
+        })
+    return {'spans': len(spans), 'files': len(files), 'slowest_files': slowest, 'hops': hop_rows}
+
+def main():
+    parser = argparse.ArgumentParser(description='Summarise spans written by the file exporter')
+    parser.add_argument('paths', nargs='+', help='TRACING_FILE of each service (or one shared file)')
+    parser.add_argument('--job-id')
+    parser.add_argument('--trace-id')
+    parser.add_argument('--top', type=int, default=10, help='slowest files to list')
+    args = parser.parse_args()
+    print(json.dumps(report(load_spans(args.paths), args.job_id, args.trace_id, args.top), indent=2))
+
+if __name__ == '__main__':
+    main()
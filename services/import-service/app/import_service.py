@@ -1,31 +1,153 @@
-﻿from flask import Flask, request, jsonify
+﻿from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
-from celery import Celery
 import os
 import requests
 import uuid
 import json
 from dotenv import load_dotenv
-from googleapiclient.discovery import build
 import re
+import threading
+import time
+from collections import OrderedDict
+
+import job_manifest
+from job_manifest import JobManifest
+from workers import WORKER_HEARTBEAT_TIMEOUT, WorkerExpired, WorkerRegistry
 
 load_dotenv()
 
+from common import drive, instrumentation, profiling, server, startup, tracing
+
+startup.mark('imports')
 app = Flask(__name__)
 CORS(app)
+instrumentation.init_app(app, 'import-service')
+tracing.init_app(app, 'import-service')
+profiling.init_app(app, 'import-service')
+startup.mark('app')
 
 
 app.config['CELERY_BROKER_URL'] = os.getenv('REDIS_URL', 'redis://redis:6379/0')
 app.config['CELERY_RESULT_BACKEND'] = os.getenv('REDIS_URL', 'redis://redis:6379/0')
 
-celery = Celery(app.name, broker=app.config['CELERY_BROKER_URL'])
-celery.conf.update(app.config)
+_celery = None
+
+def get_celery():
+    """Celery client for the Redis broker, created on first use: importing celery is slow"""
+    global _celery
+    if _celery is None:
+        from celery import Celery
+        _celery = Celery(app.name, broker=app.config['CELERY_BROKER_URL'])
+        _celery.conf.update(app.config)
+    return _celery
 
 WORKER_SERVICE_URL = os.getenv('WORKER_SERVICE_URL', 'http://worker-service:5004')
 GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY')
+JOB_MANIFEST_PATH = os.getenv('JOB_MANIFEST_PATH', 'import_manifest.db')
+BATCH_SIZE = 100
+# A worker must have at least this many queued files above the fleet average to give some back
+REBALANCE_MIN_FILES = int(os.getenv('REBALANCE_MIN_FILES', 20))
 
+# Progress streams (/import/events/<job_id>)
+SSE_KEEPALIVE_SECONDS = float(os.getenv('SSE_KEEPALIVE_SECONDS', 15))
+SSE_MIN_INTERVAL = float(os.getenv('SSE_MIN_INTERVAL', 0.5))
+SSE_MAX_STREAM_SECONDS = float(os.getenv('SSE_MAX_STREAM_SECONDS', 300))
+SSE_RETRY_MS = int(os.getenv('SSE_RETRY_MS', 2000))
+# Each open stream holds a server thread; beyond SSE_MAX_STREAMS streams are refused (503)
+# so threads stay free for the workers' status updates and heartbeats
+SSE_MAX_STREAMS = int(os.getenv('SSE_MAX_STREAMS', 16))
+SSE_REFUSED_RETRY_AFTER = 10
+# Completed jobs kept in memory; older ones are read from the manifest when asked for
+COMPLETED_JOBS_CACHED = int(os.getenv('COMPLETED_JOBS_CACHED', 100))
 
+# Per-file manifest persisted to disk; job_statuses is the in-memory view served by
+# /import/status: every unfinished job and the last COMPLETED_JOBS_CACHED completed ones
+manifest = JobManifest(JOB_MANIFEST_PATH)
+server.after_fork(manifest.reset)
+startup.mark('job manifest')
 job_statuses = {}
+job_statuses_lock = threading.Lock()
+# Completed job ids in job_statuses, oldest first
+completed_jobs = OrderedDict()
+# Notified whenever a job's status changes; progress streams wait on it
+job_progress = threading.Condition(job_statuses_lock)
+
+def jobs_by_status():
+    with job_statuses_lock:
+        counts = {}
+        for status in job_statuses.values():
+            counts[status['status']] = counts.get(status['status'], 0) + 1
+        return counts
+
+instrumentation.register_gauge('import_jobs', 'Import jobs by status', jobs_by_status, label='status')
+
+sse_streams = 0
+sse_streams_lock = threading.Lock()
+
+def open_stream():
+    """Take one of the SSE_MAX_STREAMS stream slots; False when all are in use"""
+    global sse_streams
+    with sse_streams_lock:
+        if sse_streams >= SSE_MAX_STREAMS:
+            return False
+        sse_streams += 1
+        return True
+
+def close_stream():
+    global sse_streams
+    with sse_streams_lock:
+        sse_streams -= 1
+
+instrumentation.register_gauge('import_sse_streams', 'Open progress streams', lambda: sse_streams)
+
+# Workers that send heartbeats get batches by load (see workers.py); until one has
+# registered, every batch goes to WORKER_SERVICE_URL
+workers = WorkerRegistry()
+fleet_lock = threading.Lock()
+fleet_checked = 0.0
+# Gone workers whose files are being re-dispatched
+reclaiming = set()
+
+instrumentation.register_gauge('import_workers', 'Live registered workers', lambda: len(workers.live()))
+instrumentation.register_drive_limiter(drive.get_limiter)
+
+def manifest_job_status(job):
+    """A job's status as served by /import/status, rebuilt from the manifest"""
+    counts = manifest.state_counts(job['job_id'])
+    return {
+        'status': job['status'],
+        'total': job['total'],
+        'processed': counts.get(job_manifest.RECORDED, 0),
+        'failed': counts.get(job_manifest.FAILED, 0),
+        'imported': manifest.recorded_images(job['job_id'])
+    }
+
+def job_completed(job_id):
+    """Keep a completed job in memory, dropping the oldest beyond COMPLETED_JOBS_CACHED; call with job_statuses_lock held"""
+    completed_jobs[job_id] = None
+    completed_jobs.move_to_end(job_id)
+    while len(completed_jobs) > COMPLETED_JOBS_CACHED:
+        job_statuses.pop(completed_jobs.popitem(last=False)[0], None)
+
+def load_job_status(job_id):
+    """A job's status from memory, or from the manifest (then cached); None if unknown. Call with job_statuses_lock held"""
+    if job_id in job_statuses:
+        return job_statuses[job_id]
+    job = manifest.get_job(job_id)
+    if job is None:
+        return None
+    job_statuses[job_id] = manifest_job_status(job)
+    if job['status'] == 'completed':
+        job_completed(job_id)
+    return job_statuses[job_id]
+
+def restore_job_statuses():
+    """Rebuild the statuses of unfinished jobs after a restart; completed ones load on demand"""
+    with job_statuses_lock:
+        for job in manifest.list_jobs(statuses=('processing',)):
+            job_statuses[job['job_id']] = manifest_job_status(job)
+
+restore_job_statuses()
 
 def extract_folder_id(folder_url):
     """Extract folder ID from Google Drive URL"""
@@ -42,19 +164,159 @@ def extract_folder_id(folder_url):
 def list_images_in_folder(folder_id):
     """List all images in a Google Drive folder"""
     try:
-        service = build('drive', 'v3', developerKey=GOOGLE_API_KEY)
+        service = drive.build_drive_service(GOOGLE_API_KEY)
         query = f"'{folder_id}' in parents and (mimeType contains 'image/')"
         
-        results = service.files().list(
-            q=query,
-            pageSize=1000,  # Handle large folders
-            fields="files(id, name, size, mimeType)"
-        ).execute()
-        
-        return results.get('files', [])
+        files = []
+        page_token = None
+        with instrumentation.stage('drive_list'), tracing.span('drive_list', folder_id=folder_id):
+            while True:
+                results = drive.execute(service.files().list(
+                    q=query,
+                    pageSize=1000,  # Drive's maximum page size
+                    pageToken=page_token,
+                    fields="nextPageToken, files(id, name, size, mimeType)"
+                ))
+                files.extend(results.get('files', []))
+                page_token = results.get('nextPageToken')
+                if not page_token:
+                    return files
     except Exception as e:
         raise Exception(f"Error fetching files from Google Drive: {str(e)}")
 
+def positive_int(data, name, default=None):
+    """data[name] as an int >= 1; default when absent, ValueError when invalid"""
+    value = data.get(name)
+    if value is None:
+        return default
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        value = 0
+    if value < 1:
+        raise ValueError(f'{name} must be a positive integer')
+    return value
+
+def send_batch(job_id, batch, priority=1, max_concurrency=None):
+    """
+    Send one batch to the least-loaded registered worker, trying the next one if it fails,
+    or to WORKER_SERVICE_URL while none is registered. The manifest records where it went
+    and a new lease, which the worker reports back with every state change of these files.
+    The assignment is recorded before the POST: the worker may report before it returns.
+    """
+    tried = []
+    while True:
+        worker = workers.pick(batch, exclude=tried)
+        if worker is None and tried:
+            raise Exception(f'no registered worker accepted the batch ({len(tried)} tried)')
+        lease = uuid.uuid4().hex
+        manifest.assign_files(job_id, [file_data['id'] for file_data in batch], worker and worker.worker_id, lease)
+        try:
+            response = requests.post(
+                f"{worker.url if worker else WORKER_SERVICE_URL}/process-batch",
+                json={
+                    'job_id': job_id,
+                    'files': [dict(file_data, lease=lease) for file_data in batch],
+                    'priority': priority,
+                    'max_concurrency': max_concurrency
+                },
+                timeout=5
+            )
+            response.raise_for_status()
+            return
+        except Exception as e:
+            if worker is None:
+                raise
+            print(f"Error sending batch to worker {worker.url}: {str(e)}")
+            tried.append(worker.worker_id)
+
+def dispatch_files(job_id, files, priority=1, max_concurrency=None):
+    """
+    Send files to the worker service in batches. priority and max_concurrency travel
+    with every batch so the worker schedules this job's files fairly against other jobs.
+    """
+    for i in range(0, len(files), BATCH_SIZE):
+        batch = files[i:i+BATCH_SIZE]
+        
+        try:
+            with instrumentation.stage('dispatch_batch'):
+                send_batch(job_id, batch, priority, max_concurrency)
+        except Exception as e:
+            print(f"Error sending batch to worker: {str(e)}")
+            fail_undelivered(job_id, batch, str(e))
+
+def fail_undelivered(job_id, batch, error):
+    """
+    No worker took a batch. Its files would otherwise stay assigned to the last worker
+    tried, which is live, so check_fleet never reclaims them and the job never finishes.
+    They become failed and unassigned instead: the job can complete, and
+    /import/resume?retry_failed=true sends them again.
+    """
+    file_ids = [file_data['id'] for file_data in batch]
+    manifest.assign_files(job_id, file_ids, None)
+    failed = 0
+    for file_id in file_ids:
+        previous_state = manifest.set_file_state(job_id, file_id, job_manifest.FAILED, error=f'Not delivered: {error}')
+        failed += int(previous_state in job_manifest.UNFINISHED_STATES)
+    add_progress(job_id, 0, failed, [])
+
+def check_fleet(force=False):
+    """
+    Re-dispatch the unfinished files of workers that are gone: no heartbeat for
+    WORKER_HEARTBEAT_TIMEOUT, deregistered or restarted. Runs on heartbeats, at most every
+    half timeout unless forced, and only while some worker is live to take the files.
+    """
+    global fleet_checked
+    with fleet_lock:
+        now = time.monotonic()
+        if not force and now - fleet_checked < WORKER_HEARTBEAT_TIMEOUT / 2:
+            return
+        fleet_checked = now
+        live = {worker.worker_id for worker in workers.live()}
+        if not live or not workers.settled():
+            return
+        gone = manifest.assigned_workers() - live - reclaiming
+        reclaiming.update(gone)
+    for worker_id in gone:
+        threading.Thread(target=reclaim_files, args=(worker_id,), daemon=True).start()
+
+def reclaim_files(worker_id):
+    """Send a gone worker's unfinished files, with their checkpoints, to the live workers"""
+    try:
+        for job_id, files in manifest.assigned_files(worker_id).items():
+            job = manifest.get_job(job_id)
+            print(f"Reclaiming {len(files)} files of job {job_id} from worker {worker_id}")
+            dispatch_files(job_id, files, job['priority'], job['max_concurrency'])
+    finally:
+        with fleet_lock:
+            reclaiming.discard(worker_id)
+
+def rebalance():
+    """
+    A worker joined: workers with queued files well above the fleet average give the
+    surplus back, and it is dispatched again by load, mostly to the newcomer.
+    """
+    live = workers.live()
+    if len(live) < 2:
+        return
+    average = sum(worker.queued for worker in live) // len(live)
+    for worker in live:
+        surplus = worker.queued - average
+        if surplus < REBALANCE_MIN_FILES:
+            continue
+        try:
+            response = requests.post(f"{worker.url}/release-files", json={'max_files': surplus}, timeout=10)
+            response.raise_for_status()
+            released = response.json().get('released', [])
+        except Exception as e:
+            print(f"Error taking files back from worker {worker.url}: {str(e)}")
+            continue
+        workers.released(worker.worker_id, [file_data for batch in released for file_data in batch['files']])
+        for batch in released:
+            job = manifest.get_job(batch['job_id'])
+            if job:
+                dispatch_files(batch['job_id'], batch['files'], job['priority'], job['max_concurrency'])
+
 @app.route('/health', methods=['GET'])
 def health_check():
     return jsonify({'status': 'healthy', 'service': 'import-service'}), 200
@@ -64,6 +326,8 @@ def import_from_google_drive():
     """
     Initiate async import from Google Drive
     Returns job_id for status tracking
+    Optional: priority (share of worker capacity relative to other jobs, default 1) and
+    max_concurrency (files of this job in progress at once, default unlimited)
     """
     try:
         data = request.get_json()
@@ -71,6 +335,12 @@ def import_from_google_drive():
         if not data or 'folder_url' not in data:
             return jsonify({'error': 'folder_url is required'}), 400
         
+        try:
+            priority = positive_int(data, 'priority', default=1)
+            max_concurrency = positive_int(data, 'max_concurrency')
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
         folder_url = data['folder_url']
         folder_id = extract_folder_id(folder_url)
         
@@ -82,32 +352,21 @@ def import_from_google_drive():
         
         
         job_id = str(uuid.uuid4())
+        # Carried to every span of this import in the worker, storage and metadata services
+        tracing.set_baggage('job_id', job_id)
         
-        
-        job_statuses[job_id] = {
-            'status': 'processing',
-            'total': len(files),
-            'processed': 0,
-            'failed': 0,
-            'imported': []
-        }
+        manifest.create_job(job_id, folder_id, files, priority, max_concurrency)
+        with job_statuses_lock:
+            job_statuses[job_id] = {
+                'status': 'processing',
+                'total': len(files),
+                'processed': 0,
+                'failed': 0,
+                'imported': []
+            }
         
         # Send files to worker service for async processing
-        batch_size = 100  
-        for i in range(0, len(files), batch_size):
-            batch = files[i:i+batch_size]
-            
-            try:
-                requests.post(
-                    f"{WORKER_SERVICE_URL}/process-batch",
-                    json={
-                        'job_id': job_id,
-                        'files': batch
-                    },
-                    timeout=5  
-                )
-            except Exception as e:
-                print(f"Error sending batch to worker: {str(e)}")
+        dispatch_files(job_id, files, priority, max_concurrency)
         
         return jsonify({
             'job_id': job_id,
@@ -121,35 +380,220 @@ def import_from_google_drive():
 @app.route('/import/status/<job_id>', methods=['GET'])
 def get_import_status(job_id):
     """Get status of import job"""
-    if job_id not in job_statuses:
-        return jsonify({'error': 'Job not found'}), 404
+    with job_statuses_lock:
+        status = load_job_status(job_id)
+        if status is None:
+            return jsonify({'error': 'Job not found'}), 404
+        return jsonify(status), 200
+
+def progress_snapshot(job_id):
+    """(status, processed, failed, images imported) of a job, or None; call with job_statuses_lock held"""
+    status = job_statuses.get(job_id)
+    if status is None:
+        return None
+    return status['status'], status['processed'], status['failed'], len(status['imported'])
+
+def sse_event(event, data, event_id=None):
+    lines = [f'event: {event}']
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    lines.append(f"data: {json.dumps(data, separators=(',', ':'))}")
+    return '\n'.join(lines) + '\n\n'
+
+def progress_events(job_id, since):
+    """
+    Server-Sent Events for one job: a progress event whenever its counts change, carrying
+    only the images imported since the previous event, and a final completed event.
+    Changes within SSE_MIN_INTERVAL are coalesced into one event.
+    """
+    yield f'retry: {SSE_RETRY_MS}\n\n'
+    deadline = time.monotonic() + SSE_MAX_STREAM_SECONDS
+    sent = None
+    while time.monotonic() < deadline:
+        with job_progress:
+            job_progress.wait_for(lambda: progress_snapshot(job_id) != sent, timeout=SSE_KEEPALIVE_SECONDS)
+            snapshot = progress_snapshot(job_id)
+            status = job_statuses.get(job_id)
+            imported = status['imported'][since:] if status else []
+            total = status['total'] if status else 0
+        if snapshot is None:
+            yield sse_event('error', {'error': 'Job not found'})
+            return
+        if snapshot == sent:
+            yield ': keepalive\n\n'
+            continue
+        state, processed, failed, since = snapshot
+        event = 'completed' if state == 'completed' else 'progress'
+        yield sse_event(event, {
+            'status': state, 'total': total, 'processed': processed, 'failed': failed, 'imported': imported
+        }, event_id=since)
+        if event == 'completed':
+            return
+        sent = snapshot
+        time.sleep(SSE_MIN_INTERVAL)
+    # The client reconnects after SSE_RETRY_MS and resumes from the last event id
+
+@app.route('/import/events/<job_id>', methods=['GET'])
+def stream_import_events(job_id):
+    """
+    Stream a job's progress as Server-Sent Events instead of polling /import/status.
+    Event ids count the images sent so far: a reconnect with Last-Event-ID (or ?since=N)
+    gets the images imported after that point; a new stream starts from the current count.
+    """
+    with job_statuses_lock:
+        status = load_job_status(job_id)
+        if status is None:
+            return jsonify({'error': 'Job not found'}), 404
+        imported = len(status['imported'])
+    
+    since = request.headers.get('Last-Event-ID') or request.args.get('since')
+    try:
+        since = min(max(int(since), 0), imported) if since is not None else imported
+    except ValueError:
+        return jsonify({'error': 'Last-Event-ID and since must be integers'}), 400
+    
+    if not open_stream():
+        # A deliberate refusal, not a failure: the gateway neither retries it nor counts it
+        return jsonify({'error': 'Too many progress streams open, poll /import/status instead'}), 503, {
+            'Retry-After': str(SSE_REFUSED_RETRY_AFTER), 'X-Error-Source': 'capacity'
+        }
+    response = Response(
+        progress_events(job_id, since),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+    # Called when the stream ends or the client goes away
+    response.call_on_close(close_stream)
+    return response
+
+@app.route('/import/resume/<job_id>', methods=['POST'])
+def resume_import(job_id):
+    """
+    Re-dispatch the unfinished files of a job (pending, downloading or uploaded),
+    together with their last checkpoint so workers skip completed steps.
+    Pass retry_failed=true to also retry failed files.
+    """
+    try:
+        job = manifest.get_job(job_id)
+        if not job:
+            return jsonify({'error': 'Job not found'}), 404
+        
+        retry_failed = request.args.get('retry_failed', '').strip().lower() in {'1', 'true', 'yes', 'on'}
+        files = manifest.resumable_files(job_id, include_failed=retry_failed)
+        
+        if not files:
+            return jsonify({'job_id': job_id, 'message': 'Nothing to resume', 'resumed': 0}), 200
+        
+        tracing.set_baggage('job_id', job_id)
+        manifest.set_job_status(job_id, 'processing')
+        with job_statuses_lock:
+            load_job_status(job_id)['status'] = 'processing'
+            completed_jobs.pop(job_id, None)
+            job_progress.notify_all()
+        
+        dispatch_files(job_id, files, job['priority'], job['max_concurrency'])
+        
+        return jsonify({
+            'job_id': job_id,
+            'message': f'Resumed {len(files)} unfinished images',
+            'resumed': len(files)
+        }), 202
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/workers/heartbeat', methods=['POST'])
+def worker_heartbeat():
+    """Register a worker or refresh its load (sent by workers every WORKER_HEARTBEAT_SECONDS)"""
+    data = request.get_json(silent=True) or {}
+    if not data.get('worker_id') or not data.get('url'):
+        return jsonify({'error': 'worker_id and url are required'}), 400
     
-    return jsonify(job_statuses[job_id]), 200
+    try:
+        joined = workers.heartbeat(data)
+    except WorkerExpired:
+        # Its files are being sent elsewhere: it must drop them and register again under a new id
+        return jsonify({'error': 'Worker expired after missing heartbeats', 'expired': True}), 409
+    if joined:
+        print(f"Worker {data['worker_id']} joined at {data['url']}")
+        threading.Thread(target=rebalance, daemon=True).start()
+    check_fleet(force=joined)
+    return jsonify({'success': True}), 200
+
+@app.route('/workers/<worker_id>', methods=['DELETE'])
+def deregister_worker(worker_id):
+    """A worker is shutting down; anything it did not finish goes to the others"""
+    workers.remove(worker_id)
+    check_fleet(force=True)
+    return jsonify({'success': True}), 200
+
+@app.route('/workers', methods=['GET'])
+def list_workers():
+    """Live registered workers and their last reported load"""
+    return jsonify({'workers': workers.stats()}), 200
+
+def add_progress(job_id, processed, failed, imported):
+    """Count files of a job as processed or failed, completing it once every file is either"""
+    with job_statuses_lock:
+        if job_id in job_statuses:
+            job_statuses[job_id]['processed'] += processed
+            job_statuses[job_id]['failed'] += failed
+            job_statuses[job_id]['imported'].extend(imported)
+            
+            
+            total = job_statuses[job_id]['total']
+            processed = job_statuses[job_id]['processed']
+            failed = job_statuses[job_id]['failed']
+            
+            if processed + failed >= total and job_statuses[job_id]['status'] != 'completed':
+                job_statuses[job_id]['status'] = 'completed'
+                manifest.set_job_status(job_id, 'completed')
+                job_completed(job_id)
+            job_progress.notify_all()
 
 @app.route('/import/update-status', methods=['POST'])
 def update_job_status():
-    """Update job status (called by worker service)"""
+    """
+    Update job status (called by worker service).
+    Reports carrying file_id and state also checkpoint that file in the manifest. A report
+    for a file that was sent to another worker since, or that is already recorded, is
+    refused with 409 so the worker stops working on it.
+    """
     data = request.get_json()
     job_id = data.get('job_id')
+    file_id = data.get('file_id')
+    state = data.get('state')
     
-    if job_id in job_statuses:
-        if 'processed' in data:
-            job_statuses[job_id]['processed'] += data['processed']
-        if 'failed' in data:
-            job_statuses[job_id]['failed'] += data['failed']
-        if 'imported' in data:
-            job_statuses[job_id]['imported'].extend(data['imported'])
-        
-        
-        total = job_statuses[job_id]['total']
-        processed = job_statuses[job_id]['processed']
-        failed = job_statuses[job_id]['failed']
-        
-        if processed + failed >= total:
-            job_statuses[job_id]['status'] = 'completed'
+    processed = data.get('processed', 0)
+    failed = data.get('failed', 0)
+    imported = data.get('imported') or []
     
+    if file_id and state:
+        try:
+            previous_state = manifest.set_file_state(
+                job_id,
+                file_id,
+                state,
+                image=imported[0] if imported else None,
+                lease=data.get('lease'),
+                **{name: data.get(name) for name in job_manifest.CHECKPOINT_FIELDS}
+            )
+        except job_manifest.StaleLease:
+            return jsonify({'error': 'File was sent to another worker'}), 409
+        if previous_state == job_manifest.RECORDED and state != job_manifest.RECORDED:
+            return jsonify({'error': 'File is already recorded'}), 409
+        # Count each file once, even if a resumed job reports it again
+        processed = int(state == job_manifest.RECORDED and previous_state != job_manifest.RECORDED)
+        failed = int(state == job_manifest.FAILED) - int(previous_state == job_manifest.FAILED)
+        if previous_state == job_manifest.RECORDED:
+            failed = 0
+            imported = []
+    
+    add_progress(job_id, processed, failed, imported)
     return jsonify({'success': True}), 200
 
+startup.ready('import-service')
+
 if __name__ == '__main__':
     port = int(os.getenv('PORT', 5001))
     app.run(host='0.0.0.0', port=port, debug=False)
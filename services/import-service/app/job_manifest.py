@@ -0,0 +1,247 @@
+﻿"""
+Persistent per-file manifest of import jobs.
+
+Every file of a job has a row whose state moves pending -> downloading -> uploaded ->
+recorded (or failed). The manifest lives in SQLite so it survives restarts of the
+import-service, and /import/resume/<job_id> re-dispatches only unfinished files. Each
+file also records the registered worker it was last sent to, so the files of a worker
+that dies can be sent to another one, and the lease of that dispatch: a new token each
+time the file is sent out. Reports carrying an older lease come from a worker the file
+was taken from and are refused, so it cannot overwrite the new worker's checkpoints.
+"""
+import json
+import sqlite3
+import threading
+import time
+
+PENDING = 'pending'
+DOWNLOADING = 'downloading'
+UPLOADED = 'uploaded'
+RECORDED = 'recorded'
+FAILED = 'failed'
+
+UNFINISHED_STATES = (PENDING, DOWNLOADING, UPLOADED)
+
+class StaleLease(Exception):
+    """A report for a file from a dispatch it has since been taken from"""
+
+# Checkpoint fields a worker may report alongside a state change
+CHECKPOINT_FIELDS = ('storage_key', 'storage_url', 'storage_provider', 'upload_id', 'error')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    folder_id TEXT,
+    total INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 1,
+    max_concurrency INTEGER,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS job_files (
+    job_id TEXT NOT NULL,
+    file_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    mime_type TEXT NOT NULL,
+    size INTEGER,
+    state TEXT NOT NULL,
+    storage_key TEXT,
+    storage_url TEXT,
+    storage_provider TEXT,
+    upload_id TEXT,
+    error TEXT,
+    image_json TEXT,
+    worker_id TEXT,
+    lease TEXT,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (job_id, file_id)
+);
+CREATE INDEX IF NOT EXISTS ix_job_files_state ON job_files (job_id, state);
+"""
+
+# Columns added after the first release: table -> {name: definition for ALTER TABLE}
+ADDED_COLUMNS = {
+    'jobs': {
+        'priority': 'INTEGER NOT NULL DEFAULT 1',
+        'max_concurrency': 'INTEGER',
+    },
+    'job_files': {
+        'worker_id': 'TEXT',
+        'lease': 'TEXT',
+    },
+}
+
+# Indexes on added columns, created once the columns exist
+ADDED_INDEXES = """
+CREATE INDEX IF NOT EXISTS ix_job_files_worker ON job_files (state, worker_id);
+"""
+
+class JobManifest:
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+            for table, columns in ADDED_COLUMNS.items():
+                existing = {row['name'] for row in conn.execute(f'PRAGMA table_info({table})')}
+                for name, definition in columns.items():
+                    if name not in existing:
+                        conn.execute(f'ALTER TABLE {table} ADD COLUMN {name} {definition}')
+            conn.executescript(ADDED_INDEXES)
+
+    def reset(self):
+        """Forget this thread's connections (call in a forked child; SQLite handles must not cross a fork)"""
+        self._local = threading.local()
+
+    def _connect(self):
+        # One connection per thread; WAL lets status reads proceed during checkpoint writes
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def create_job(self, job_id, folder_id, files, priority=1, max_concurrency=None):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT INTO jobs (job_id, folder_id, total, status, priority, max_concurrency, '
+                'created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (job_id, folder_id, len(files), 'processing', priority, max_concurrency, now, now)
+            )
+            conn.executemany(
+                'INSERT OR IGNORE INTO job_files (job_id, file_id, name, mime_type, size, state, updated_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [
+                    (job_id, f['id'], f['name'], f['mimeType'], int(f.get('size', 0) or 0), PENDING, now)
+                    for f in files
+                ]
+            )
+
+    def set_job_status(self, job_id, status):
+        with self._connect() as conn:
+            conn.execute(
+                'UPDATE jobs SET status = ?, updated_at = ? WHERE job_id = ?',
+                (status, time.time(), job_id)
+            )
+
+    def set_file_state(self, job_id, file_id, state, image=None, lease=None, **checkpoint):
+        """
+        Record a file's new state; returns its previous state (None if the file is unknown).
+        Recorded is final: reports from a second run of the file (a worker that was taken
+        for dead, or a resume) leave a recorded file as it is. Raises StaleLease when lease
+        is not the file's current one (reports without a lease are not checked).
+        """
+        fields = {k: v for k, v in checkpoint.items() if k in CHECKPOINT_FIELDS and v is not None}
+        fields['state'] = state
+        fields['updated_at'] = time.time()
+        if image is not None:
+            fields['image_json'] = json.dumps(image)
+
+        assignments = ', '.join(f'{name} = ?' for name in fields)
+        with self._connect() as conn:
+            # Take the write lock before reading so concurrent reports for a file serialize
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute(
+                'SELECT state, lease FROM job_files WHERE job_id = ? AND file_id = ?',
+                (job_id, file_id)
+            ).fetchone()
+            if row is None:
+                return None
+            if lease is not None and row['lease'] is not None and lease != row['lease']:
+                raise StaleLease(f'{file_id} was sent out again after lease {lease}')
+            if row['state'] == RECORDED:
+                return RECORDED
+            conn.execute(
+                f'UPDATE job_files SET {assignments} WHERE job_id = ? AND file_id = ?',
+                (*fields.values(), job_id, file_id)
+            )
+            return row['state']
+
+    def get_job(self, job_id):
+        row = self._connect().execute('SELECT * FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def list_jobs(self, statuses=None):
+        query = 'SELECT * FROM jobs'
+        params = ()
+        if statuses:
+            query += f" WHERE status IN ({', '.join('?' for _ in statuses)})"
+            params = tuple(statuses)
+        return [dict(row) for row in self._connect().execute(query, params)]
+
+    def state_counts(self, job_id):
+        rows = self._connect().execute(
+            'SELECT state, COUNT(*) AS n FROM job_files WHERE job_id = ? GROUP BY state',
+            (job_id,)
+        )
+        return {row['state']: row['n'] for row in rows}
+
+    def recorded_images(self, job_id):
+        rows = self._connect().execute(
+            'SELECT image_json FROM job_files WHERE job_id = ? AND state = ? AND image_json IS NOT NULL',
+            (job_id, RECORDED)
+        )
+        return [json.loads(row['image_json']) for row in rows]
+
+    def resumable_files(self, job_id, include_failed=False):
+        """Files to re-dispatch, in the worker's file format plus their last checkpoint"""
+        states = UNFINISHED_STATES + ((FAILED,) if include_failed else ())
+        rows = self._connect().execute(
+            f"SELECT * FROM job_files WHERE job_id = ? AND state IN ({', '.join('?' for _ in states)})",
+            (job_id, *states)
+        )
+        return [dispatch_format(row) for row in rows]
+
+    def assign_files(self, job_id, file_ids, worker_id, lease=None):
+        """
+        Record the registered worker a batch was sent to (None: the static WORKER_SERVICE_URL)
+        and the batch's lease, which supersedes any earlier one of its files
+        """
+        with self._connect() as conn:
+            conn.executemany(
+                'UPDATE job_files SET worker_id = ?, lease = ? WHERE job_id = ? AND file_id = ?',
+                [(worker_id, lease, job_id, file_id) for file_id in file_ids]
+            )
+
+    def assigned_workers(self):
+        """Workers that hold unfinished files"""
+        rows = self._connect().execute(
+            f"SELECT DISTINCT worker_id FROM job_files WHERE state IN ({', '.join('?' for _ in UNFINISHED_STATES)}) "
+            'AND worker_id IS NOT NULL',
+            UNFINISHED_STATES
+        )
+        return {row['worker_id'] for row in rows}
+
+    def assigned_files(self, worker_id):
+        """Unfinished files last sent to worker_id, by job_id, in the worker's file format"""
+        rows = self._connect().execute(
+            f"SELECT * FROM job_files WHERE state IN ({', '.join('?' for _ in UNFINISHED_STATES)}) AND worker_id = ?",
+            (*UNFINISHED_STATES, worker_id)
+        )
+        files = {}
+        for row in rows:
+            files.setdefault(row['job_id'], []).append(dispatch_format(row))
+        return files
+
+def dispatch_format(row):
+    """A job_files row as a worker file, with its last checkpoint"""
+    file_data = {
+        'id': row['file_id'],
+        'name': row['name'],
+        'mimeType': row['mime_type'],
+        'size': row['size'],
+    }
+    checkpoint = {
+        name: row[name]
+        for name in ('state', 'storage_key', 'storage_url', 'storage_provider', 'upload_id')
+        if row[name] is not None
+    }
+    if checkpoint.get('state') == FAILED:
+        checkpoint['state'] = PENDING
+    file_data['checkpoint'] = checkpoint
+    return file_data
@@ -0,0 +1,135 @@
+﻿"""
+Registry of the worker fleet.
+
+Workers started with WORKER_ADVERTISE_URL register by heartbeat (POST /workers/heartbeat,
+see services/worker-service/fleet.py) and report their load with each one: files queued,
+files in progress and the bytes of everything accepted but not finished. pick() sends
+each batch to the live worker with the fewest outstanding bytes (then files), counting
+the batches sent since that worker's last heartbeat, so a burst of batches spreads over
+the fleet instead of piling onto whichever worker looked idle last.
+
+A worker is gone when it has not sent a heartbeat for WORKER_HEARTBEAT_TIMEOUT seconds,
+deregisters, or is replaced by a new worker_id at the same URL (a restart). The
+import-service then re-dispatches the unfinished files it had sent there. An expired
+worker_id stays gone: a late heartbeat under it raises WorkerExpired, and the worker
+drops what it holds and registers again under a new id.
+"""
+import os
+import threading
+import time
+
+WORKER_HEARTBEAT_TIMEOUT = float(os.getenv('WORKER_HEARTBEAT_TIMEOUT', 10))
+
+class WorkerExpired(Exception):
+    """A heartbeat from a worker that was already taken for dead"""
+
+def file_size(file_data):
+    # Drive lists sizes as strings
+    return int(file_data.get('size') or 0)
+
+class Worker:
+    def __init__(self, worker_id, url):
+        self.worker_id = worker_id
+        self.url = url.rstrip('/')
+        self.engine = None
+        self.queued = 0
+        self.in_flight = 0
+        self.in_flight_bytes = 0
+        # Sent since its last heartbeat, which therefore does not count them yet
+        self.sent_files = 0
+        self.sent_bytes = 0
+        self.last_seen = time.monotonic()
+
+    def update(self, report):
+        self.engine = report.get('engine')
+        self.queued = int(report.get('queued') or 0)
+        self.in_flight = int(report.get('in_flight') or 0)
+        self.in_flight_bytes = int(report.get('in_flight_bytes') or 0)
+        self.sent_files = 0
+        self.sent_bytes = 0
+        self.last_seen = time.monotonic()
+
+    def load(self):
+        """Outstanding bytes, then files; the least-loaded worker gets the next batch"""
+        return (self.in_flight_bytes + self.sent_bytes, self.queued + self.in_flight + self.sent_files)
+
+    def to_dict(self):
+        return {
+            'worker_id': self.worker_id,
+            'url': self.url,
+            'engine': self.engine,
+            'queued': self.queued,
+            'in_flight': self.in_flight,
+            'in_flight_bytes': self.in_flight_bytes,
+            'sent_since_heartbeat': self.sent_files,
+            'seconds_since_heartbeat': round(time.monotonic() - self.last_seen, 1)
+        }
+
+class WorkerRegistry:
+    def __init__(self, timeout=WORKER_HEARTBEAT_TIMEOUT):
+        self.timeout = timeout
+        self.workers = {}
+        # worker_ids that missed their heartbeats; their files may already be elsewhere
+        self.expired = set()
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+
+    def heartbeat(self, report):
+        """Record a worker's heartbeat; True when the worker is new, WorkerExpired when it had expired"""
+        with self.lock:
+            if report['worker_id'] in self.expired:
+                raise WorkerExpired(report['worker_id'])
+            worker = self.workers.get(report['worker_id'])
+            joined = worker is None
+            if joined:
+                url = report['url'].rstrip('/')
+                # A new worker_id at a known URL is that worker restarted
+                for other in [w for w in self.workers.values() if w.url == url]:
+                    del self.workers[other.worker_id]
+                worker = self.workers[report['worker_id']] = Worker(report['worker_id'], url)
+            worker.update(report)
+            return joined
+
+    def remove(self, worker_id):
+        with self.lock:
+            self.workers.pop(worker_id, None)
+
+    def _expire(self):
+        now = time.monotonic()
+        for worker in [w for w in self.workers.values() if now - w.last_seen > self.timeout]:
+            del self.workers[worker.worker_id]
+            self.expired.add(worker.worker_id)
+
+    def live(self):
+        with self.lock:
+            self._expire()
+            return list(self.workers.values())
+
+    def settled(self):
+        """Whether every worker alive before this process started has had time to register again"""
+        return time.monotonic() - self.started > self.timeout
+
+    def pick(self, files, exclude=()):
+        """Least-loaded live worker not in exclude, or None; files count towards its load until it reports them"""
+        with self.lock:
+            self._expire()
+            candidates = [w for w in self.workers.values() if w.worker_id not in exclude]
+            if not candidates:
+                return None
+            worker = min(candidates, key=Worker.load)
+            worker.sent_files += len(files)
+            worker.sent_bytes += sum(file_size(file_data) for file_data in files)
+            return worker
+
+    def released(self, worker_id, files):
+        """A worker gave files back: take them off its reported load"""
+        with self.lock:
+            worker = self.workers.get(worker_id)
+            if worker is not None:
+                worker.queued = max(worker.queued - len(files), 0)
+                worker.in_flight_bytes = max(worker.in_flight_bytes - sum(file_size(f) for f in files), 0)
+
+    def stats(self):
+        with self.lock:
+            self._expire()
+            return [worker.to_dict() for worker in self.workers.values()]
@@ -0,0 +1,124 @@
+﻿"""
+Compressed cold store for archived image rows.
+
+`flask --app metadata_service archive` moves rows created more than ARCHIVE_AFTER_DAYS
+ago out of the images table (whole months when it is partitioned) into segments. A
+segment holds up to ARCHIVE_SEGMENT_ROWS rows, ordered by id, as zlib-compressed JSON in
+a single row together with its id range. GET /images/<id> falls back to the cold store:
+it decompresses the one segment whose range holds the id, and keeps the last
+ARCHIVE_CACHE_SEGMENTS decoded segments in memory. A multi-get decodes each segment
+holding any of its ids once.
+
+Segments are written in their own transactions, before the archived rows leave the
+images table. A run that dies in between archives those rows again next time: writing a
+segment first takes its rows out of any segment already holding them, so every id is
+stored once.
+
+Deletes by id reach archived images too: remove() takes them out of their segments (the
+metadata-service also deletes their stored objects and keys). Deletes by filter only
+match images that are not archived yet: segments are not indexed by anything but id.
+"""
+import json
+import os
+import threading
+import zlib
+from collections import OrderedDict
+
+from sqlalchemy import delete, func, insert, select, update
+
+ARCHIVE_SEGMENT_ROWS = int(os.getenv('ARCHIVE_SEGMENT_ROWS', 5000))
+ARCHIVE_CACHE_SEGMENTS = int(os.getenv('ARCHIVE_CACHE_SEGMENTS', 16))
+
+def encode(rows):
+    return zlib.compress(json.dumps(rows, separators=(',', ':')).encode('utf-8'), 9)
+
+def decode(payload):
+    return json.loads(zlib.decompress(payload))
+
+class ColdStore:
+    """Reads and writes segments in table (id, min_id, max_id, row_count, payload, archived_at)"""
+    def __init__(self, table):
+        self.table = table
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def write(self, connection, rows, archived_at):
+        """Store rows (JSON-ready dicts with an id) as one segment, replacing stored copies of them"""
+        rows = sorted(rows, key=lambda row: row['id'])
+        self.remove(connection, [row['id'] for row in rows])
+        connection.execute(insert(self.table).values(
+            min_id=rows[0]['id'], max_id=rows[-1]['id'], row_count=len(rows),
+            payload=encode(rows), archived_at=archived_at
+        ))
+
+    def remove(self, connection, image_ids):
+        """Take rows out of the segments holding them, dropping emptied segments; returns the rows removed"""
+        image_ids = set(image_ids)
+        if not image_ids:
+            return []
+        segments = connection.execute(
+            select(self.table.c.id, self.table.c.payload)
+            .where(self.table.c.min_id <= max(image_ids), self.table.c.max_id >= min(image_ids))
+        ).all()
+        removed = []
+        for segment_id, payload in segments:
+            rows = decode(payload)
+            kept = [row for row in rows if row['id'] not in image_ids]
+            if len(kept) == len(rows):
+                continue
+            removed.extend(row for row in rows if row['id'] in image_ids)
+            if kept:
+                connection.execute(update(self.table).where(self.table.c.id == segment_id).values(
+                    min_id=kept[0]['id'], max_id=kept[-1]['id'], row_count=len(kept), payload=encode(kept)
+                ))
+            else:
+                connection.execute(delete(self.table).where(self.table.c.id == segment_id))
+            with self.lock:
+                self.cache.pop(segment_id, None)
+        return removed
+
+    def segment(self, connection, segment_id):
+        """Decoded rows of a segment by image id, cached"""
+        with self.lock:
+            if segment_id in self.cache:
+                self.cache.move_to_end(segment_id)
+                return self.cache[segment_id]
+        payload = connection.execute(
+            select(self.table.c.payload).where(self.table.c.id == segment_id)
+        ).scalar()
+        rows = {row['id']: row for row in decode(payload)}
+        with self.lock:
+            self.cache[segment_id] = rows
+            while len(self.cache) > ARCHIVE_CACHE_SEGMENTS:
+                self.cache.popitem(last=False)
+        return rows
+
+    def get(self, connection, image_id):
+        """An archived row by image id, or None"""
+        return self.get_many(connection, [image_id]).get(image_id)
+
+    def get_many(self, connection, image_ids):
+        """Archived rows by image id, for those of image_ids that are archived"""
+        if not image_ids:
+            return {}
+        # One query for every segment whose range can hold any of the ids, newest first
+        segments = connection.execute(
+            select(self.table.c.id, self.table.c.min_id, self.table.c.max_id)
+            .where(self.table.c.min_id <= max(image_ids), self.table.c.max_id >= min(image_ids))
+            .order_by(self.table.c.id.desc())
+        ).all()
+        found = {}
+        for segment_id, min_id, max_id in segments:
+            wanted = [i for i in image_ids if min_id <= i <= max_id and i not in found]
+            if wanted:
+                rows = self.segment(connection, segment_id)
+                found.update((i, rows[i]) for i in wanted if i in rows)
+        return found
+
+    def segments(self, connection):
+        """Decoded rows of every segment, oldest first, one at a time (for one-off scans; not cached)"""
+        for segment_id in connection.execute(select(self.table.c.id).order_by(self.table.c.id)).scalars().all():
+            yield decode(connection.execute(select(self.table.c.payload).where(self.table.c.id == segment_id)).scalar())
+
+    def count(self, connection):
+        return connection.execute(select(func.coalesce(func.sum(self.table.c.row_count), 0))).scalar()
@@ -1,15 +1,42 @@
-﻿from flask import Flask, request, jsonify
+﻿from flask import Flask, request, jsonify, g, has_app_context
 from flask_cors import CORS
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime
+from flask_sqlalchemy.session import Session
+from sqlalchemy import exc
+from sqlalchemy.dialects import mysql
+from datetime import datetime, timedelta
+import click
+import functools
 import os
+import random
+import requests
+import time
 from dotenv import load_dotenv
 from urllib.parse import quote_plus
 
 load_dotenv()
 
+from common import instrumentation, profiling, serialization, server, startup, tracing
+
+import archive
+import partitioning
+
+startup.mark('imports')
 app = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=['X-Last-Write'])
+instrumentation.init_app(app, 'metadata-service')
+tracing.init_app(app, 'metadata-service')
+profiling.init_app(app, 'metadata-service')
+startup.mark('app')
+
+STORAGE_SERVICE_URL = os.getenv('STORAGE_SERVICE_URL', 'http://storage-service:5003')
+
+# Rows are resolved and deleted in chunks to stay below driver bind-parameter limits
+BULK_DELETE_CHUNK_SIZE = 500
+# Number of object paths sent to the storage service per /delete-batch call
+STORAGE_DELETE_CHUNK_SIZE = 10000
+# Most ids one GET /images?ids= request may ask for
+MULTI_GET_MAX_IDS = int(os.getenv('MULTI_GET_MAX_IDS', 1000))
 
 
 # mysql (AWS RDS MySQL)
@@ -21,7 +48,10 @@ DB_USER = os.getenv('DB_USER')
 DB_PASSWORD = os.getenv('DB_PASSWORD')
 DB_DRIVER = os.getenv('DB_DRIVER', 'ODBC Driver 18 for SQL Server')
 
-if all([DB_SERVER, DB_NAME, DB_USER, DB_PASSWORD]):
+if os.getenv('DATABASE_URL'):
+    # Any SQLAlchemy URL, e.g. sqlite:////tmp/bench/images.db for benchmarks
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL')
+elif all([DB_SERVER, DB_NAME, DB_USER, DB_PASSWORD]):
     engine = DB_ENGINE or 'mysql'
 
     if engine == 'mysql':
@@ -51,7 +81,35 @@ if all([DB_SERVER, DB_NAME, DB_USER, DB_PASSWORD]):
 else:
     app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///images.db'
 
+# Schema changes are applied by `flask --app metadata_service migrate`, run once per
+# deploy, instead of create_all() reflecting a remote database on every boot. Local
+# SQLite files are still created on boot unless DB_AUTO_MIGRATE=false.
+DB_AUTO_MIGRATE = os.getenv(
+    'DB_AUTO_MIGRATE', str(app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'))
+).strip().lower() in {'1', 'true', 'yes', 'on'}
+
+# Read replicas (comma-separated SQLAlchemy URLs). Routes marked @replica_read are served
+# from one of them; writes, and reads within REPLICA_READ_AFTER_WRITE_SECONDS of the
+# client's own last write (the X-Last-Write token it got back), stay on the primary.
+DATABASE_REPLICA_URLS = [url.strip() for url in os.getenv('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+REPLICA_READ_AFTER_WRITE_SECONDS = float(os.getenv('REPLICA_READ_AFTER_WRITE_SECONDS', 5))
+REPLICA_BINDS = [f'replica_{i}' for i in range(len(DATABASE_REPLICA_URLS))]
+WRITE_TOKEN_HEADER = 'X-Last-Write'
+# Marks a 5xx caused by a dependency (the storage-service), so the gateway's circuit
+# breaker does not count it against this service
+ERROR_SOURCE_HEADER = 'X-Error-Source'
+
+# Cold store for images older than ARCHIVE_AFTER_DAYS (see archive.py); the primary
+# database unless ARCHIVE_DATABASE_URL names another one
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', 365))
+ARCHIVE_DATABASE_URL = os.getenv('ARCHIVE_DATABASE_URL')
+ARCHIVE_BIND = 'archive' if ARCHIVE_DATABASE_URL else None
+
+app.config['SQLALCHEMY_BINDS'] = dict(zip(REPLICA_BINDS, DATABASE_REPLICA_URLS))
+if ARCHIVE_DATABASE_URL:
+    app.config['SQLALCHEMY_BINDS'][ARCHIVE_BIND] = ARCHIVE_DATABASE_URL
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Applies to the primary and to every replica engine
 app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
     'pool_pre_ping': True,
     'pool_recycle': 300,
@@ -59,7 +117,46 @@ app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
     'max_overflow': 40
 }
 
-db = SQLAlchemy(app)
+class RoutingSession(Session):
+    """Sends the queries of a request routed to a replica there; flushes and all other requests use the primary"""
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        replica = g.get('db_replica') if has_app_context() else None
+        if replica and bind is None and not self._flushing:
+            return self._db.engines[replica]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
+
+def wrote_recently():
+    """Whether the client's last write (its X-Last-Write token) may not have reached the replicas yet"""
+    token = request.headers.get(WRITE_TOKEN_HEADER)
+    if not token:
+        return False
+    try:
+        return time.time() - float(token) < REPLICA_READ_AFTER_WRITE_SECONDS
+    except ValueError:
+        return True
+
+def replica_read(view):
+    """Serve a read-only route from a random replica, unless the client wrote recently"""
+    @functools.wraps(view)
+    def routed(*args, **kwargs):
+        if REPLICA_BINDS and not wrote_recently():
+            g.db_replica = random.choice(REPLICA_BINDS)
+        tracing.set_attribute('db.route', g.get('db_replica', 'primary'))
+        return view(*args, **kwargs)
+    return routed
+
+@app.after_request
+def issue_write_token(response):
+    """Successful writes return a token; clients echo it so their next reads see the write"""
+    if request.method in ('POST', 'PUT', 'PATCH', 'DELETE') and response.status_code < 400:
+        response.headers[WRITE_TOKEN_HEADER] = f'{time.time():.3f}'
+    return response
+
+def object_key(storage_key, storage_path):
+    """Stored object key, falling back to the flat layout used before keys were stored"""
+    return storage_key or storage_path.split('/')[-1]
 
 # Image Model
 class Image(db.Model):
@@ -71,6 +168,8 @@ class Image(db.Model):
     size = db.Column(db.BigInteger, nullable=False)
     mime_type = db.Column(db.String(100), nullable=False)
     storage_path = db.Column(db.String(500), nullable=False)
+    # Real object key in the bucket; NULL for rows written before keys were stored
+    storage_key = db.Column(db.String(1024), nullable=True)
     storage_provider = db.Column(db.String(20), nullable=False, index=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     
@@ -82,69 +181,414 @@ class Image(db.Model):
             'size': self.size,
             'mime_type': self.mime_type,
             'storage_path': self.storage_path,
+            'storage_key': self.storage_key,
             'storage_provider': self.storage_provider,
             'created_at': self.created_at.isoformat() if self.created_at else None
         }
 
-# Create tables
-with app.app_context():
+class ImageKey(db.Model):
+    """
+    One row per imported google_drive_id, with the id of its image, hot or archived. Ids
+    of new images come from here (see partitioning.py); the unique index refuses a second
+    import of a file, which neither partitions nor the cold store could.
+    """
+    __tablename__ = 'image_keys'
+    # Never reuse the id of a deleted image
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    id = db.Column(db.Integer, primary_key=True)
+    google_drive_id = db.Column(db.String(255), unique=True, nullable=False)
+
+# Listings select these columns as plain tuples (no ORM objects or identity map) and
+# serialization encodes them; the keys match to_dict()
+LISTING_COLUMNS = (
+    Image.id, Image.name, Image.google_drive_id, Image.size, Image.mime_type,
+    Image.storage_path, Image.storage_key, Image.storage_provider, Image.created_at,
+)
+LISTING_FIELDS = tuple(column.key for column in LISTING_COLUMNS)
+
+# Monthly partitions (or month tables) of images when IMAGES_PARTITIONING=monthly;
+# every query goes through layout.tables() so it reads only the partitions it needs
+layout = partitioning.layout_for(app.config['SQLALCHEMY_DATABASE_URI'], Image.__table__, ImageKey.__table__)
+
+class ArchiveSegment(db.Model):
+    """Compressed image rows moved out of images by the archive job"""
+    __tablename__ = 'image_archive'
+    __bind_key__ = ARCHIVE_BIND
+
+    id = db.Column(db.Integer, primary_key=True)
+    min_id = db.Column(db.BigInteger, nullable=False, index=True)
+    max_id = db.Column(db.BigInteger, nullable=False, index=True)
+    row_count = db.Column(db.Integer, nullable=False)
+    payload = db.Column(db.LargeBinary().with_variant(mysql.LONGBLOB(), 'mysql'), nullable=False)
+    archived_at = db.Column(db.DateTime, nullable=False)
+
+cold_store = archive.ColdStore(ArchiveSegment.__table__)
+
+def listing_rows(statement, fields=LISTING_FIELDS):
+    """Rows of a listing_select() of fields as dicts"""
+    return [dict(zip(fields, row)) for row in db.session.execute(statement)]
+
+def listing_select(table, *criteria, fields=LISTING_FIELDS):
+    """fields (default: all LISTING_COLUMNS) of table (images or one of its month tables)"""
+    return db.select(*(table.c[field] for field in fields)).where(*criteria)
+
+def image_dict(row):
+    """A listing row shaped like to_dict()"""
+    image = dict(row)
+    if 'created_at' in image:
+        image['created_at'] = image['created_at'].isoformat() if image['created_at'] else None
+    return image
+
+def archived_dict(row, fields):
+    """A cold store row projected to fields, marked archived"""
+    return dict({field: row.get(field) for field in fields}, archived=True)
+
+def parse_fields(value):
+    """
+    fields= projection (comma-separated column names) as a tuple of LISTING_FIELDS; every
+    field when absent. id is always included.
+    """
+    if not value:
+        return LISTING_FIELDS
+    requested = {field.strip() for field in value.split(',') if field.strip()}
+    unknown = requested.difference(LISTING_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+    return tuple(field for field in LISTING_FIELDS if field == 'id' or field in requested)
+
+def parse_ids(value):
+    """ids= (comma-separated) as a list of distinct ints, in request order"""
+    try:
+        ids = list(dict.fromkeys(int(part) for part in value.split(',') if part.strip()))
+    except ValueError:
+        raise ValueError('ids must be comma-separated integers') from None
+    if len(ids) > MULTI_GET_MAX_IDS:
+        raise ValueError(f'At most {MULTI_GET_MAX_IDS} ids per request')
+    return ids
+
+def image_criteria(table, storage_provider=None, created_after=None, created_before=None, name_contains=None):
+    criteria = []
+    if storage_provider:
+        criteria.append(table.c.storage_provider == storage_provider)
+    if created_after:
+        criteria.append(table.c.created_at >= created_after)
+    if created_before:
+        criteria.append(table.c.created_at < created_before)
+    if name_contains:
+        criteria.append(table.c.name.contains(name_contains))
+    return criteria
+
+def find_images(criteria, tables=None, fields=LISTING_FIELDS):
+    """Rows (as dicts of fields) matching criteria(table) in any of tables (default: every partition)"""
+    tables = layout.tables(db.session) if tables is None else tables
+    statements = [listing_select(table, *criteria(table), fields=fields) for table in tables]
+    if not statements:
+        return []
+    return listing_rows(statements[0] if len(statements) == 1 else db.union_all(*statements), fields)
+
+def delete_rows(ids):
+    """Delete hot rows by id, in chunks, from whichever partitions hold them, and free their keys"""
+    tables = [*layout.tables(db.session), ImageKey.__table__]
+    for i in range(0, len(ids), BULK_DELETE_CHUNK_SIZE):
+        chunk = ids[i:i + BULK_DELETE_CHUNK_SIZE]
+        for table in tables:
+            db.session.execute(table.delete().where(table.c.id.in_(chunk)))
+
+def find_archived(ids):
+    """Archived rows by id, for those of ids that are in the cold store"""
+    found = {}
+    with db.engines[ARCHIVE_BIND].connect() as connection:
+        for i in range(0, len(ids), BULK_DELETE_CHUNK_SIZE):
+            found.update(cold_store.get_many(connection, ids[i:i + BULK_DELETE_CHUNK_SIZE]))
+    return found
+
+def delete_archived_rows(ids):
+    """
+    Take archived rows out of the cold store, in chunks; delete_rows() frees their keys.
+    Commits on its own connection, so call it before writing with db.session.
+    """
+    with db.engines[ARCHIVE_BIND].begin() as connection:
+        for i in range(0, len(ids), BULK_DELETE_CHUNK_SIZE):
+            cold_store.remove(connection, ids[i:i + BULK_DELETE_CHUNK_SIZE])
+
+def existing_image(google_drive_id):
+    """The image imported from google_drive_id, from the hot table or the cold store, or None"""
+    rows = find_images(lambda table: [table.c.google_drive_id == google_drive_id])
+    if rows:
+        return image_dict(rows[0])
+    image_id = db.session.execute(
+        db.select(ImageKey.id).where(ImageKey.google_drive_id == google_drive_id)
+    ).scalar()
+    if image_id is None:
+        return None
+    with db.engines[ARCHIVE_BIND].connect() as connection:
+        archived = cold_store.get(connection, image_id)
+    return archived_dict(archived, LISTING_FIELDS) if archived else None
+
+def parse_time(value):
+    """ISO 8601 query value as a datetime, or None"""
+    return datetime.fromisoformat(value) if value else None
+
+def migrate():
+    """Create missing tables, add missing nullable columns and set up partitioning; safe to run again"""
+    new_keys = not db.inspect(db.engine).has_table(ImageKey.__tablename__)
     db.create_all()
+    with db.engine.connect() as connection:
+        tables = [Image.__table__, *layout.tables(connection)]
+    for table in tables:
+        columns = {column['name'] for column in db.inspect(db.engine).get_columns(table.name)}
+        for column in Image.__table__.columns:
+            if column.name not in columns and column.nullable:
+                column_type = column.type.compile(db.engine.dialect)
+                with db.engine.begin() as conn:
+                    conn.execute(db.text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type} NULL'))
+    layout.migrate(db.engine)
+    if new_keys:
+        fill_keys()
+
+def fill_keys():
+    """
+    Key rows for the images stored before image_keys existed, hot and archived. Of files
+    imported more than once, the lowest id keeps the key.
+    """
+    keys = ImageKey.__table__
+    with db.engine.begin() as connection:
+        for table in [Image.__table__, *layout.tables(connection)]:
+            connection.execute(keys.insert().from_select(
+                ['id', 'google_drive_id'],
+                db.select(db.func.min(table.c.id), table.c.google_drive_id)
+                .where(~db.exists().where(keys.c.google_drive_id == table.c.google_drive_id))
+                .group_by(table.c.google_drive_id)
+            ))
+    with db.engines[ARCHIVE_BIND].connect() as archive_connection:
+        for rows in cold_store.segments(archive_connection):
+            first = {}
+            for row in sorted(rows, key=lambda row: row['id']):
+                first.setdefault(row['google_drive_id'], row['id'])
+            with db.engine.begin() as connection:
+                taken = set(connection.execute(
+                    db.select(keys.c.google_drive_id).where(keys.c.google_drive_id.in_(list(first)))
+                ).scalars())
+                missing = [{'id': image_id, 'google_drive_id': drive_id}
+                           for drive_id, image_id in first.items() if drive_id not in taken]
+                if missing:
+                    connection.execute(keys.insert(), missing)
+
+def check_schema():
+    """
+    Fail at boot when the images table is behind the model (a deploy that skipped migrate)
+    instead of on every query. One LIMIT 0 query; the table is inspected only if it fails.
+    """
+    try:
+        with db.engine.connect() as connection:
+            connection.execute(Image.__table__.select().limit(0))
+            connection.execute(ImageKey.__table__.select().limit(0))
+        return
+    except exc.DBAPIError as e:
+        error = e
+    try:
+        inspector = db.inspect(db.engine)
+        columns = {column['name'] for column in inspector.get_columns(Image.__tablename__)}
+    except exc.NoSuchTableError:
+        columns = set()
+    except exc.DBAPIError:
+        # Database unreachable: not a schema problem, requests will retry the connection
+        print(f"Schema check skipped: {error.orig}")
+        return
+    missing = [column.name for column in Image.__table__.columns if column.name not in columns]
+    if missing:
+        raise RuntimeError(
+            f"{Image.__tablename__} table lacks {', '.join(missing)}: run `flask --app metadata_service migrate`"
+        )
+    if not inspector.has_table(ImageKey.__tablename__):
+        raise RuntimeError(f"{ImageKey.__tablename__} table is missing: run `flask --app metadata_service migrate`")
+
+def archive_images(older_than_days):
+    """
+    Move rows created more than older_than_days ago into the cold store, one segment at a
+    time, and return the number moved per partition. Partitions are dropped once they
+    are fully archived; without partitioning the archived rows are deleted.
+    """
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    archive_engine = db.engines[ARCHIVE_BIND]
+    with db.engine.connect() as connection:
+        units = layout.archive_units(connection, cutoff)
+
+    moved = {}
+    for unit in units:
+        last_id, count = 0, 0
+        while True:
+            with db.engine.connect() as connection:
+                statement = (listing_select(unit.table, *unit.criteria, unit.table.c.id > last_id)
+                             .order_by(unit.table.c.id).limit(archive.ARCHIVE_SEGMENT_ROWS))
+                rows = [dict(zip(LISTING_FIELDS, row)) for row in connection.execute(statement)]
+            if not rows:
+                break
+            with archive_engine.begin() as connection:
+                cold_store.write(connection, [image_dict(row) for row in rows], datetime.utcnow())
+            if not unit.droppable:
+                with db.engine.begin() as connection:
+                    connection.execute(unit.table.delete().where(unit.table.c.id.in_([row['id'] for row in rows])))
+            last_id, count = rows[-1]['id'], count + len(rows)
+        if unit.droppable:
+            with db.engine.begin() as connection:
+                layout.drop(connection, unit)
+        moved[unit.name] = count
+    return moved
+
+@app.cli.command('migrate')
+def migrate_command():
+    """Apply the schema to the configured database"""
+    migrate()
+    print(f"Schema is up to date ({db.engine.url.render_as_string(hide_password=True)})")
+
+@app.cli.command('archive')
+@click.option('--older-than-days', type=int, default=ARCHIVE_AFTER_DAYS, show_default=True)
+def archive_command(older_than_days):
+    """Move old images to the cold store (and add the coming months' partitions); run daily"""
+    layout.migrate(db.engine)
+    moved = archive_images(older_than_days)
+    for name, count in moved.items():
+        print(f'{name}: archived {count} images')
+    print(f'Archived {sum(moved.values())} images created more than {older_than_days} days ago')
+
+with app.app_context():
+    instrumentation.instrument_sqlalchemy(db.engine)
+    for bind in REPLICA_BINDS:
+        instrumentation.instrument_sqlalchemy(db.engines[bind], pool_gauge=False)
+    startup.mark('database engine')
+    if DB_AUTO_MIGRATE:
+        migrate()
+        startup.mark('migrate')
+    else:
+        check_schema()
+        startup.mark('schema check')
+
+@server.after_fork
+def dispose_pool():
+    """Pooled connections opened before the fork belong to the parent; open new ones per worker"""
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
 
 @app.route('/health', methods=['GET'])
 def health_check():
     return jsonify({'status': 'healthy', 'service': 'metadata-service'}), 200
 
 @app.route('/images', methods=['GET'])
+@replica_read
 def get_images():
-    """Get paginated images"""
+    """
+    Get paginated images, newest first. created_after/created_before (ISO 8601) limit the
+    listing to a time range; with partitioning only the months in range are read.
+    ids=1,2,3 fetches those images instead (see get_images_by_id). fields=name,size
+    returns only those columns, here and on the other image reads.
+    """
     try:
-        page = request.args.get('page', 1, type=int)
+        fields = parse_fields(request.args.get('fields'))
+        if 'ids' in request.args:
+            return get_images_by_id(parse_ids(request.args['ids']), fields)
+
+        page = max(request.args.get('page', 1, type=int), 1)
         per_page = request.args.get('per_page', 50, type=int)
-        storage_provider = request.args.get('storage_provider', None)
-        
-        query = Image.query
-        
-        if storage_provider:
-            query = query.filter_by(storage_provider=storage_provider)
-        
-        query = query.order_by(Image.created_at.desc())
-        pagination = query.paginate(page=page, per_page=per_page, error_out=False)
-        
-        images = [image.to_dict() for image in pagination.items]
-        
-        return jsonify({
+        per_page = per_page if per_page > 0 else 20
+        filters = {
+            'storage_provider': request.args.get('storage_provider', None),
+            'created_after': parse_time(request.args.get('created_after')),
+            'created_before': parse_time(request.args.get('created_before')),
+        }
+        tables = layout.tables(db.session, filters['created_after'], filters['created_before'])
+
+        # The count of every partition in range, in one statement
+        counts = [
+            db.select(db.func.count()).select_from(table).where(*image_criteria(table, **filters)).scalar_subquery()
+            for table in tables
+        ]
+        counts = list(db.session.execute(db.select(*counts)).one()) if counts else []
+        total = sum(counts)
+
+        # Partitions hold disjoint months, newest first: skip whole partitions before the page
+        images, offset = [], (page - 1) * per_page
+        for table, count in zip(tables, counts):
+            if offset >= count:
+                offset -= count
+                continue
+            statement = (listing_select(table, *image_criteria(table, **filters), fields=fields)
+                         .order_by(table.c.created_at.desc()).limit(per_page - len(images)).offset(offset))
+            images.extend(listing_rows(statement, fields))
+            offset = 0
+            if len(images) >= per_page:
+                break
+
+        return serialization.respond({
             'images': images,
-            'total': pagination.total,
+            'total': total,
             'page': page,
             'per_page': per_page,
-            'total_pages': pagination.pages
-        }), 200
+            'total_pages': -(-total // per_page)
+        })
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def get_images_by_id(ids, fields):
+    """
+    Multi-get: the images in ids, in that order, from one primary-key IN query over the
+    partitions; ids not in the hot table are looked up in the cold store together. Ids
+    found nowhere are listed under missing.
+    """
+    found = {}
+    if ids:
+        found = {row['id']: row for row in find_images(lambda table: [table.c.id.in_(ids)], fields=fields)}
+    cold_ids = [image_id for image_id in ids if image_id not in found]
+    if cold_ids:
+        with db.engines[ARCHIVE_BIND].connect() as connection:
+            for image_id, row in cold_store.get_many(connection, cold_ids).items():
+                found[image_id] = archived_dict(row, fields)
+    return serialization.respond({
+        'images': [found[image_id] for image_id in ids if image_id in found],
+        'missing': [image_id for image_id in ids if image_id not in found],
+    })
+
 @app.route('/images/all', methods=['GET'])
+@replica_read
 def get_all_images():
     """Get all images without pagination"""
     try:
-        images = Image.query.order_by(Image.created_at.desc()).all()
-        images_list = [image.to_dict() for image in images]
-        
-        return jsonify({
+        fields = parse_fields(request.args.get('fields'))
+        images_list = []
+        for table in layout.tables(db.session):
+            statement = listing_select(table, fields=fields).order_by(table.c.created_at.desc())
+            images_list.extend(listing_rows(statement, fields))
+
+        return serialization.respond({
             'success': True,
             'total': len(images_list),
             'images': images_list
-        }), 200
+        })
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/images/<int:image_id>', methods=['GET'])
+@replica_read
 def get_image(image_id):
-    """Get specific image"""
+    """Get specific image; archived images come from the cold store, marked archived"""
     try:
-        image = Image.query.get(image_id)
-        if not image:
+        fields = parse_fields(request.args.get('fields'))
+        rows = find_images(lambda table: [table.c.id == image_id], fields=fields)
+        if rows:
+            return jsonify(image_dict(rows[0])), 200
+        with db.engines[ARCHIVE_BIND].connect() as connection:
+            archived = cold_store.get(connection, image_id)
+        if not archived:
             return jsonify({'error': 'Image not found'}), 404
-        return jsonify(image.to_dict()), 200
+        return jsonify(archived_dict(archived, fields)), 200
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -153,61 +597,196 @@ def create_image():
     """Create new image metadata (called by worker service)"""
     try:
         data = request.get_json()
-        
-    
-        existing = Image.query.filter_by(google_drive_id=data['google_drive_id']).first()
-        if existing:
-            return jsonify({'error': 'Image already exists', 'image': existing.to_dict()}), 409
-        
-        image = Image(
-            name=data['name'],
-            google_drive_id=data['google_drive_id'],
-            size=data['size'],
-            mime_type=data['mime_type'],
-            storage_path=data['storage_path'],
-            storage_provider=data['storage_provider']
-        )
-        
-        db.session.add(image)
+        image = {
+            'name': data['name'],
+            'google_drive_id': data['google_drive_id'],
+            'size': data['size'],
+            'mime_type': data['mime_type'],
+            'storage_path': data['storage_path'],
+            'storage_key': data.get('storage_key'),
+            'storage_provider': data['storage_provider'],
+            'created_at': datetime.utcnow()
+        }
+
+        try:
+            with instrumentation.stage('db_write'), tracing.span('db_write', google_drive_id=data['google_drive_id']):
+                table = layout.table_for(db.session, image['created_at'])
+                # Fails on the unique key of a file imported before, even concurrently or since archived
+                image['id'] = layout.next_id(db.session, data['google_drive_id'])
+                db.session.execute(table.insert().values(**image))
+                db.session.commit()
+        except exc.IntegrityError:
+            db.session.rollback()
+            return jsonify({'error': 'Image already exists', 'image': existing_image(data['google_drive_id'])}), 409
+
+        return jsonify(image_dict(image)), 201
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
+def delete_stored_files(rows):
+    """
+    Delete the stored objects for (id, storage_key, storage_path, storage_provider) rows via
+    the Storage Service. Returns a dict of image id -> error for objects that were not deleted.
+    """
+    keys_by_provider = {}
+    for image_id, storage_key, storage_path, storage_provider in rows:
+        key = object_key(storage_key, storage_path)
+        keys_by_provider.setdefault(storage_provider, {}).setdefault(key, []).append(image_id)
+
+    errors = {}
+    for provider, ids_by_key in keys_by_provider.items():
+        keys = list(ids_by_key)
+        for i in range(0, len(keys), STORAGE_DELETE_CHUNK_SIZE):
+            chunk = keys[i:i + STORAGE_DELETE_CHUNK_SIZE]
+            try:
+                with instrumentation.stage('storage_delete'):
+                    response = requests.post(
+                        f"{STORAGE_SERVICE_URL}/delete-batch",
+                        json={'keys': chunk, 'provider': provider},
+                        timeout=300
+                    )
+                if response.status_code != 200:
+                    raise Exception(f"Storage delete failed: {response.text}")
+                failed = {item['key']: item['error'] for item in response.json().get('errors', [])}
+            except Exception as e:
+                failed = {key: str(e) for key in chunk}
+
+            for key, error in failed.items():
+                for image_id in ids_by_key.get(key, []):
+                    errors[image_id] = error
+
+    return errors
+
+def stored_file(row):
+    return row['id'], row['storage_key'], row['storage_path'], row['storage_provider']
+
+def parse_bulk_delete_filter(filters):
+    """Keyword arguments of image_criteria for a bulk delete filter"""
+    criteria = {
+        'storage_provider': filters.get('storage_provider'),
+        'created_before': parse_time(filters.get('created_before')),
+        'created_after': parse_time(filters.get('created_after')),
+        'name_contains': filters.get('name_contains'),
+    }
+    return {name: value for name, value in criteria.items() if value}
+
+@app.route('/images/bulk-delete', methods=['POST'])
+def bulk_delete_images():
+    """
+    Delete many images by id or by filter.
+    Stored objects are removed first via the Storage Service (batched DeleteObjects),
+    then the metadata rows whose objects are gone are deleted in one transaction.
+    Deletes by id also cover archived images; filters only match images not yet archived.
+    """
+    try:
+        data = request.get_json() or {}
+        ids = data.get('ids')
+        filters = data.get('filter')
+
+        if ids:
+            ids = list(dict.fromkeys(int(image_id) for image_id in ids))
+            tables = layout.tables(db.session)
+            rows = []
+            for i in range(0, len(ids), BULK_DELETE_CHUNK_SIZE):
+                chunk = ids[i:i + BULK_DELETE_CHUNK_SIZE]
+                rows.extend(stored_file(row) for row in find_images(lambda table: [table.c.id.in_(chunk)], tables))
+            archived = find_archived(list(set(ids) - {row[0] for row in rows}))
+            rows.extend(stored_file(row) for row in archived.values())
+        elif filters:
+            criteria = parse_bulk_delete_filter(filters)
+            if not criteria:
+                return jsonify({'error': 'filter must contain at least one supported field'}), 400
+            tables = layout.tables(db.session, criteria.get('created_after'), criteria.get('created_before'))
+            rows = [stored_file(row) for row in find_images(lambda table: image_criteria(table, **criteria), tables)]
+            ids = [row[0] for row in rows]
+            archived = {}
+        else:
+            return jsonify({'error': 'ids or filter is required'}), 400
+
+        storage_errors = delete_stored_files(rows)
+
+        found_ids = {row[0] for row in rows}
+        deletable_ids = [image_id for image_id in found_ids if image_id not in storage_errors]
+
+        delete_archived_rows([image_id for image_id in deletable_ids if image_id in archived])
+        delete_rows(deletable_ids)
         db.session.commit()
-        
-        return jsonify(image.to_dict()), 201
+
+        results = []
+        for image_id in ids:
+            if image_id not in found_ids:
+                results.append({'id': image_id, 'success': False, 'error': 'Image not found'})
+            elif image_id in storage_errors:
+                results.append({'id': image_id, 'success': False, 'error': storage_errors[image_id]})
+            else:
+                results.append({'id': image_id, 'success': True})
+
+        failed = len(results) - len(deletable_ids)
+        return jsonify({
+            'success': failed == 0,
+            'deleted': len(deletable_ids),
+            'failed': failed,
+            'results': results
+        }), 200 if failed == 0 else 207
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
 @app.route('/images/<int:image_id>', methods=['DELETE'])
 def delete_image(image_id):
-    """Delete image metadata"""
+    """Delete image metadata and its stored object; archived images are taken out of the cold store"""
     try:
-        image = Image.query.get(image_id)
-        if not image:
+        rows = find_images(lambda table: [table.c.id == image_id])
+        archived = {} if rows else find_archived([image_id])
+        row = rows[0] if rows else archived.get(image_id)
+        if row is None:
             return jsonify({'error': 'Image not found'}), 404
-        
-        db.session.delete(image)
+
+        storage_errors = delete_stored_files([stored_file(row)])
+        if storage_errors:
+            return jsonify({'error': storage_errors[image_id]}), 502, {ERROR_SOURCE_HEADER: 'dependency'}
+
+        if archived:
+            delete_archived_rows([image_id])
+        delete_rows([image_id])
         db.session.commit()
-        
+
         return jsonify({'message': 'Image deleted successfully'}), 200
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
 @app.route('/stats', methods=['GET'])
+@replica_read
 def get_stats():
     """Get statistics"""
     try:
-        total_images = Image.query.count()
-        total_size = db.session.query(db.func.sum(Image.size)).scalar() or 0
-        aws_count = Image.query.filter_by(storage_provider='aws').count()
+        total_images = total_size = aws_count = 0
+        for table in layout.tables(db.session):
+            count, size, aws = db.session.execute(db.select(
+                db.func.count(),
+                db.func.sum(table.c.size),
+                db.func.sum(db.case((table.c.storage_provider == 'aws', 1), else_=0))
+            ).select_from(table)).one()
+            total_images, total_size, aws_count = total_images + count, total_size + (size or 0), aws_count + int(aws or 0)
+        with db.engines[ARCHIVE_BIND].connect() as connection:
+            archived_images = cold_store.count(connection)
         return jsonify({
             'total_images': total_images,
             'total_size_bytes': total_size,
             'total_size_mb': round(total_size / (1024 * 1024), 2),
             'aws_images': aws_count,
+            'archived_images': archived_images,
         }), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+startup.ready('metadata-service')
+
 if __name__ == '__main__':
     port = int(os.getenv('PORT', 5002))
     app.run(host='0.0.0.0', port=port, debug=False)
@@ -0,0 +1,248 @@
+﻿"""
+Time partitioning of the images table by created_at month.
+
+IMAGES_PARTITIONING=monthly (default none) splits images into one partition per month:
+
+  MySQL   native RANGE COLUMNS(created_at) partitions of the images table (p202610, ...,
+          and pmax for anything later). MySQL requires every unique key of a partitioned
+          table to contain created_at, so the primary key becomes (id, created_at) and
+          google_drive_id is no longer unique in the images table.
+  SQLite  one table per month (images_202610, ...), created by the first insert of the
+          month.
+
+In every layout ids come from the keys table (image_keys): next_id() inserts the new
+image's google_drive_id there, in the insert's transaction, and its autoincrement id
+becomes the image's. Its unique index keeps google_drive_id unique across partitions
+and month tables, and archived images keep their key rows, so a file cannot be imported
+twice however the images are split or moved.
+
+Reads that name a created_at range only touch the months it covers: MySQL prunes the
+partitions itself, and for SQLite tables() returns only the overlapping month tables.
+Old months are archived whole (see archive.py) by dropping the partition or table,
+instead of deleting their rows one by one.
+
+migrate() converts an existing table (MySQL) or moves its rows into month tables
+(SQLite), and adds the partitions for the next PARTITION_MONTHS_AHEAD months. Other
+databases need IMAGES_PARTITIONING=none.
+"""
+import os
+import re
+import threading
+from collections import namedtuple
+from datetime import datetime
+
+from sqlalchemy import MetaData, func, select, text
+
+PARTITIONING = os.getenv('IMAGES_PARTITIONING', 'none').strip().lower()
+PARTITION_MONTHS_AHEAD = int(os.getenv('PARTITION_MONTHS_AHEAD', 3))
+
+# A part of the images table the archive job moves at once: rows of table matching
+# criteria; droppable units (partitions, month tables) are removed whole afterwards with drop()
+Unit = namedtuple('Unit', 'name table criteria droppable')
+
+def month_start(moment):
+    return datetime(moment.year, moment.month, 1)
+
+def add_months(moment, months):
+    index = moment.year * 12 + moment.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+def overlaps(start, end, created_after, created_before):
+    """Whether the month [start, end) can hold rows in [created_after, created_before)"""
+    return (created_after is None or end is None or end > created_after) and \
+        (created_before is None or start is None or start < created_before)
+
+class Single:
+    """The one images table (IMAGES_PARTITIONING=none)"""
+    def __init__(self, table, keys):
+        self.table = table
+        self.keys = keys
+
+    def tables(self, session, created_after=None, created_before=None):
+        """Tables holding rows created in the range, newest first"""
+        return [self.table]
+
+    def table_for(self, session, created_at):
+        """Table a row created at created_at is inserted into"""
+        return self.table
+
+    def next_id(self, session, google_drive_id):
+        """Id for a new row of google_drive_id; IntegrityError when that file already has one"""
+        return session.execute(self.keys.insert().values(google_drive_id=google_drive_id)).inserted_primary_key[0]
+
+    def migrate(self, engine):
+        pass
+
+    def archive_units(self, connection, cutoff):
+        return [Unit(self.table.name, self.table, [self.table.c.created_at < cutoff], False)]
+
+class MySQLPartitions(Single):
+    """Native monthly partitions of the images table; MySQL routes and prunes rows itself"""
+    def bounds(self, connection):
+        """[(partition name, exclusive upper bound)] in order; pmax's bound is None"""
+        rows = connection.execute(text(
+            'SELECT PARTITION_NAME, PARTITION_DESCRIPTION FROM information_schema.PARTITIONS '
+            'WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table AND PARTITION_NAME IS NOT NULL '
+            'ORDER BY PARTITION_ORDINAL_POSITION'
+        ), {'table': self.table.name})
+        return [
+            (name, None if description == 'MAXVALUE' else datetime.fromisoformat(description.strip("'")))
+            for name, description in rows
+        ]
+
+    @staticmethod
+    def partition_clauses(first, last):
+        """PARTITION definitions for the months from first up to and including last"""
+        clauses, month = [], first
+        while month <= last:
+            clauses.append(f"PARTITION p{month:%Y%m} VALUES LESS THAN ('{add_months(month, 1):%Y-%m-%d}')")
+            month = add_months(month, 1)
+        return clauses
+
+    def migrate(self, engine):
+        name = self.table.name
+        last = add_months(month_start(datetime.utcnow()), PARTITION_MONTHS_AHEAD)
+        with engine.begin() as connection:
+            bounds = self.bounds(connection)
+            if not bounds:
+                # One-time conversion; ALTER ... PARTITION BY rebuilds the table
+                oldest = connection.execute(text(f'SELECT MIN(created_at) FROM {name}')).scalar()
+                connection.execute(text(f'UPDATE {name} SET created_at = UTC_TIMESTAMP() WHERE created_at IS NULL'))
+                connection.execute(text(
+                    f'ALTER TABLE {name} MODIFY created_at DATETIME NOT NULL, '
+                    f'DROP PRIMARY KEY, ADD PRIMARY KEY (id, created_at), '
+                    f'DROP INDEX ix_{name}_google_drive_id, ADD INDEX ix_{name}_google_drive_id (google_drive_id)'
+                ))
+                # The first partition also takes every older row
+                clauses = self.partition_clauses(month_start(oldest or datetime.utcnow()), last)
+                connection.execute(text(
+                    f"ALTER TABLE {name} PARTITION BY RANGE COLUMNS(created_at) "
+                    f"({', '.join(clauses)}, PARTITION pmax VALUES LESS THAN (MAXVALUE))"
+                ))
+                return
+            ends = [end for _, end in bounds if end is not None]
+            if ends and ends[-1] <= last:
+                # pmax stays empty while the months ahead exist, so splitting it is cheap
+                clauses = self.partition_clauses(ends[-1], last)
+                connection.execute(text(
+                    f"ALTER TABLE {name} REORGANIZE PARTITION pmax INTO "
+                    f"({', '.join(clauses)}, PARTITION pmax VALUES LESS THAN (MAXVALUE))"
+                ))
+
+    def archive_units(self, connection, cutoff):
+        units, start = [], None
+        for name, end in self.bounds(connection):
+            if end is None or end > cutoff:
+                break
+            criteria = [self.table.c.created_at < end]
+            if start is not None:
+                criteria.append(self.table.c.created_at >= start)
+            units.append(Unit(name, self.table, criteria, True))
+            start = end
+        return units
+
+    def drop(self, connection, unit):
+        connection.execute(text(f'ALTER TABLE {self.table.name} DROP PARTITION {unit.name}'))
+
+class SQLiteShards(Single):
+    """One table per month; the images table itself stays empty once migrated"""
+    # Where ids came from before the keys table
+    LEGACY_SEQUENCE = 'image_id_sequence'
+
+    def __init__(self, table, keys):
+        super().__init__(table, keys)
+        self.pattern = re.compile(rf'^{re.escape(table.name)}_(\d{{4}})(\d{{2}})$')
+        self.metadata = MetaData()
+        self.shards = {}
+        self.created = set()
+        self.lock = threading.Lock()
+
+    def shard(self, name):
+        with self.lock:
+            if name not in self.shards:
+                # Same columns; the indexes are named after the new table
+                self.shards[name] = self.table.to_metadata(self.metadata, name=name)
+            return self.shards[name]
+
+    def month(self, name):
+        """(start, end) of a month table"""
+        year, month = self.pattern.match(name).groups()
+        start = datetime(int(year), int(month), 1)
+        return start, add_months(start, 1)
+
+    @staticmethod
+    def has_table(connection, name):
+        return connection.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"), {'name': name}
+        ).first() is not None
+
+    def names(self, session):
+        """Existing month tables, newest first"""
+        rows = session.execute(text("SELECT name FROM sqlite_master WHERE type = 'table'"))
+        return sorted((name for name, in rows if self.pattern.match(name)), reverse=True)
+
+    def tables(self, session, created_after=None, created_before=None):
+        return [
+            self.shard(name) for name in self.names(session)
+            if overlaps(*self.month(name), created_after, created_before)
+        ]
+
+    def table_for(self, session, created_at):
+        name = f'{self.table.name}_{created_at:%Y%m}'
+        shard = self.shard(name)
+        if name not in self.created:
+            shard.create(session.connection(), checkfirst=True)
+            self.created.add(name)
+        return shard
+
+    def migrate(self, engine):
+        legacy = self.table
+        with engine.begin() as connection:
+            if self.has_table(connection, self.LEGACY_SEQUENCE):
+                # The keys table continues above the old sequence, ids of deleted rows included:
+                # AUTOINCREMENT never hands out an id twice
+                top = connection.execute(
+                    text('SELECT seq FROM sqlite_sequence WHERE name = :name'), {'name': self.LEGACY_SEQUENCE}
+                ).scalar()
+                if top and (connection.execute(select(func.max(self.keys.c.id))).scalar() or 0) < top:
+                    connection.execute(self.keys.insert().values(id=top, google_drive_id=''))
+                    connection.execute(self.keys.delete().where(self.keys.c.id == top))
+                connection.execute(text(f'DROP TABLE {self.LEGACY_SEQUENCE}'))
+
+            # Rows written before sharding move into their month tables
+            connection.execute(legacy.update().where(legacy.c.created_at.is_(None)).values(created_at=datetime.utcnow()))
+            month = func.strftime('%Y%m', legacy.c.created_at)
+            for key, in connection.execute(select(month).distinct()).all():
+                shard = self.shard(f'{legacy.name}_{key}')
+                shard.create(connection, checkfirst=True)
+                columns = [column.name for column in legacy.columns]
+                connection.execute(shard.insert().from_select(columns, select(*legacy.columns).where(month == key)))
+                connection.execute(legacy.delete().where(month == key))
+
+            # The coming months' tables exist before their first insert
+            month = month_start(datetime.utcnow())
+            for _ in range(PARTITION_MONTHS_AHEAD + 1):
+                self.shard(f'{legacy.name}_{month:%Y%m}').create(connection, checkfirst=True)
+                month = add_months(month, 1)
+
+    def archive_units(self, connection, cutoff):
+        return [
+            Unit(name, self.shard(name), [], True) for name in reversed(self.names(connection))
+            if self.month(name)[1] <= cutoff
+        ]
+
+    def drop(self, connection, unit):
+        unit.table.drop(connection)
+        self.created.discard(unit.name)
+
+def layout_for(database_uri, table, keys):
+    """Partitioning layout of table, with ids from keys, for the configured database"""
+    if PARTITIONING == 'none':
+        return Single(table, keys)
+    if PARTITIONING != 'monthly':
+        raise ValueError(f'Unsupported IMAGES_PARTITIONING: {PARTITIONING}')
+    if database_uri.startswith('mysql'):
+        return MySQLPartitions(table, keys)
+    if database_uri.startswith('sqlite'):
+        return SQLiteShards(table, keys)
+    raise ValueError('IMAGES_PARTITIONING=monthly needs MySQL or SQLite')
@@ -0,0 +1,495 @@
+﻿"""
+Storage backends for the Storage Service.
+
+A backend stores objects under keys built by the service and knows how to delete,
+sign and serve them. Backends register themselves by provider name with
+@register_backend; out-of-tree backends can be loaded with STORAGE_BACKEND_PLUGINS
+(comma-separated module names that register backends on import).
+"""
+from flask import Response, request, send_file, jsonify
+import os
+import io
+import hmac
+import shutil
+import hashlib
+import tempfile
+import threading
+import mimetypes
+import importlib
+import time
+import uuid
+import concurrent.futures
+from datetime import datetime, timezone
+from urllib.parse import urlencode
+
+# Object keys embed a uuid and are never overwritten, so their content can be cached forever
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+OBJECT_STREAM_CHUNK_SIZE = 256 * 1024
+
+# Signs object URLs for backends without native presigning (local, memory). Every
+# storage-service process and replica needs the same key, and it must survive restarts,
+# or outstanding URLs stop verifying; see check_signing_key().
+STORAGE_SIGNING_KEY = os.getenv('STORAGE_SIGNING_KEY', '').encode('utf-8')
+
+BACKENDS = {}
+_instances = {}
+_instances_lock = threading.Lock()
+
+def register_backend(name):
+    """Class decorator registering a StorageBackend under a provider name"""
+    def decorator(cls):
+        cls.name = name
+        BACKENDS[name] = cls
+        return cls
+    return decorator
+
+def get_backend(name):
+    """Return the shared backend instance for a provider, or None if it is unknown"""
+    if name not in BACKENDS:
+        return None
+    with _instances_lock:
+        if name not in _instances:
+            _instances[name] = BACKENDS[name]()
+        return _instances[name]
+
+def reset_backends():
+    """Drop backend instances (e.g. after fork) so clients and handles are recreated"""
+    with _instances_lock:
+        _instances.clear()
+
+def load_backend_plugins(modules):
+    """Import plugin modules; each registers its backends with @register_backend"""
+    for module in [m.strip() for m in (modules or '').split(',') if m.strip()]:
+        importlib.import_module(module)
+
+def check_signing_key(provider):
+    """
+    Fail at boot when provider signs its own URLs and STORAGE_SIGNING_KEY is unset. The
+    memory backend (tests, benchmarks) gets a key for this process instead.
+    """
+    global STORAGE_SIGNING_KEY
+    backend = BACKENDS.get(provider)
+    if STORAGE_SIGNING_KEY or backend is None or backend.native_presign:
+        return
+    if provider != 'memory':
+        raise RuntimeError(f"STORAGE_SIGNING_KEY must be set for the {provider} storage backend")
+    print("STORAGE_SIGNING_KEY is not set: memory object URLs are signed with a key of this process only")
+    STORAGE_SIGNING_KEY = os.urandom(32).hex().encode('utf-8')
+
+def sign_object_url(base_url, key, ttl):
+    """Build a signed, expiring URL for an object served by the Storage Service"""
+    if not STORAGE_SIGNING_KEY:
+        raise RuntimeError('STORAGE_SIGNING_KEY is not set')
+    expires = int(time.time()) + ttl
+    signature = hmac.new(STORAGE_SIGNING_KEY, f"{key}:{expires}".encode('utf-8'), hashlib.sha256).hexdigest()
+    return f"{base_url.rstrip('/')}/{key}?{urlencode({'expires': expires, 'signature': signature})}"
+
+def verify_object_signature(key, expires, signature):
+    """Check a signature produced by sign_object_url"""
+    if not STORAGE_SIGNING_KEY:
+        return False
+    try:
+        if int(expires) < time.time():
+            return False
+    except (TypeError, ValueError):
+        return False
+    expected = hmac.new(STORAGE_SIGNING_KEY, f"{key}:{expires}".encode('utf-8'), hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature or '')
+
+class StorageBackend:
+    """Interface every storage backend implements"""
+    name = None
+    # Whether presign() returns URLs pointing straight at the store (S3) rather than at /objects
+    native_presign = False
+
+    def upload(self, file_buffer, key, mime_type):
+        """Store the buffer under key and return the object's URL"""
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def delete_many(self, keys):
+        """Delete many keys; returns a dict of key -> error for keys that were not deleted"""
+        errors = {}
+        for key in keys:
+            try:
+                self.delete(key)
+            except Exception as e:
+                errors[key] = str(e)
+        return errors
+
+    def presign(self, key, ttl):
+        """Return a URL granting read access to key for ttl seconds"""
+        raise NotImplementedError
+
+    def serve(self, key):
+        """Return a Flask response serving key, honouring Range and conditional headers"""
+        raise NotImplementedError
+
+    # Resumable multipart uploads: parts survive worker restarts until completed or aborted
+
+    def create_multipart(self, key, mime_type):
+        """Start a multipart upload and return its upload id"""
+        raise NotImplementedError
+
+    def upload_part(self, key, upload_id, part_number, data):
+        """Store one part (1-based part_number) and return its etag"""
+        raise NotImplementedError
+
+    def list_parts(self, key, upload_id):
+        """Return the parts stored so far as [{'part_number', 'etag', 'size'}] in order"""
+        raise NotImplementedError
+
+    def complete_multipart(self, key, upload_id):
+        """Assemble the stored parts into the object and return its URL"""
+        raise NotImplementedError
+
+    def abort_multipart(self, key, upload_id):
+        raise NotImplementedError
+
+@register_backend('aws')
+class S3Backend(StorageBackend):
+    native_presign = True
+    # S3 DeleteObjects accepts at most 1000 keys per request
+    delete_batch_size = 1000
+
+    def __init__(self):
+        import boto3
+
+        self.bucket_name = os.getenv('AWS_BUCKET_NAME')
+        self.region = os.getenv('AWS_REGION', 'us-east-1')
+        # Objects stay private and are read through presigned URLs; true restores public-read
+        # uploads for deployments whose clients still load the plain bucket URLs
+        self.public_read = os.getenv('S3_PUBLIC_READ', 'false').strip().lower() in {'1', 'true', 'yes', 'on'}
+        self.delete_concurrency = int(os.getenv('DELETE_CONCURRENCY', 8))
+
+        access_key_id = os.getenv('AWS_ACCESS_KEY_ID')
+        secret_access_key = os.getenv('AWS_SECRET_ACCESS_KEY')
+        # boto3 clients are thread-safe; one client is shared by every request
+        if access_key_id and secret_access_key:
+            self.client = boto3.client(
+                's3',
+                aws_access_key_id=access_key_id,
+                aws_secret_access_key=secret_access_key,
+                region_name=self.region
+            )
+        else:
+            self.client = boto3.client('s3', region_name=self.region)
+
+    def upload(self, file_buffer, key, mime_type):
+        extra_args = {'ContentType': mime_type}
+        if self.public_read:
+            extra_args['ACL'] = 'public-read'
+
+        self.client.upload_fileobj(file_buffer, self.bucket_name, key, ExtraArgs=extra_args)
+        return f"https://{self.bucket_name}.s3.{self.region}.amazonaws.com/{key}"
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket_name, Key=key)
+
+    def _delete_key_batch(self, keys):
+        """Delete up to 1000 keys with a single DeleteObjects call"""
+        from botocore.exceptions import ClientError
+
+        try:
+            response = self.client.delete_objects(
+                Bucket=self.bucket_name,
+                Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True}
+            )
+        except ClientError as e:
+            return {key: str(e) for key in keys}
+
+        # In quiet mode S3 only reports the keys it failed to delete
+        return {
+            error['Key']: f"{error.get('Code')}: {error.get('Message')}"
+            for error in response.get('Errors', [])
+        }
+
+    def delete_many(self, keys):
+        batches = [
+            keys[i:i + self.delete_batch_size]
+            for i in range(0, len(keys), self.delete_batch_size)
+        ]
+
+        errors = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.delete_concurrency) as pool:
+            for batch_errors in pool.map(self._delete_key_batch, batches):
+                errors.update(batch_errors)
+        return errors
+
+    def create_multipart(self, key, mime_type):
+        extra_args = {'ContentType': mime_type}
+        if self.public_read:
+            extra_args['ACL'] = 'public-read'
+        response = self.client.create_multipart_upload(Bucket=self.bucket_name, Key=key, **extra_args)
+        return response['UploadId']
+
+    def upload_part(self, key, upload_id, part_number, data):
+        response = self.client.upload_part(
+            Bucket=self.bucket_name,
+            Key=key,
+            UploadId=upload_id,
+            PartNumber=part_number,
+            Body=data
+        )
+        return response['ETag']
+
+    def list_parts(self, key, upload_id):
+        parts = []
+        paginator = self.client.get_paginator('list_parts')
+        for page in paginator.paginate(Bucket=self.bucket_name, Key=key, UploadId=upload_id):
+            parts.extend(
+                {'part_number': part['PartNumber'], 'etag': part['ETag'], 'size': part['Size']}
+                for part in page.get('Parts', [])
+            )
+        return parts
+
+    def complete_multipart(self, key, upload_id):
+        parts = self.list_parts(key, upload_id)
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket_name,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={
+                'Parts': [{'PartNumber': part['part_number'], 'ETag': part['etag']} for part in parts]
+            }
+        )
+        return f"https://{self.bucket_name}.s3.{self.region}.amazonaws.com/{key}"
+
+    def abort_multipart(self, key, upload_id):
+        self.client.abort_multipart_upload(Bucket=self.bucket_name, Key=key, UploadId=upload_id)
+
+    def presign(self, key, ttl):
+        # Presigning is a local HMAC computation, no request is sent to S3
+        return self.client.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': self.bucket_name, 'Key': key},
+            ExpiresIn=ttl
+        )
+
+    def serve(self, key):
+        from botocore.exceptions import ClientError
+
+        params = {'Bucket': self.bucket_name, 'Key': key}
+        if request.headers.get('Range'):
+            params['Range'] = request.headers['Range']
+        if request.headers.get('If-None-Match'):
+            params['IfNoneMatch'] = request.headers['If-None-Match']
+
+        try:
+            obj = self.client.get_object(**params)
+        except ClientError as e:
+            status = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 500)
+            if status == 304:
+                response = Response(status=304)
+                response.headers['ETag'] = request.headers.get('If-None-Match')
+                response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+                return response
+            if status in (404, 416):
+                return jsonify({'error': e.response.get('Error', {}).get('Message', str(e))}), status
+            raise
+
+        body = obj['Body']
+        response = Response(
+            body.iter_chunks(chunk_size=OBJECT_STREAM_CHUNK_SIZE),
+            status=206 if obj.get('ContentRange') else 200,
+            mimetype=obj.get('ContentType', 'application/octet-stream'),
+            direct_passthrough=True
+        )
+        response.headers['Content-Length'] = str(obj['ContentLength'])
+        response.headers['Accept-Ranges'] = 'bytes'
+        response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+        if obj.get('ContentRange'):
+            response.headers['Content-Range'] = obj['ContentRange']
+        if obj.get('ETag'):
+            response.headers['ETag'] = obj['ETag']
+        if obj.get('LastModified'):
+            response.last_modified = obj['LastModified']
+        response.call_on_close(body.close)
+        return response
+
+@register_backend('local')
+class LocalBackend(StorageBackend):
+    """
+    Stores objects on local disk under LOCAL_STORAGE_ROOT.
+    Keys are spread over two levels of hash-sharded directories, writes go to a temp
+    file that is atomically renamed into place, and reads are served with send_file so
+    WSGI servers that support wsgi.file_wrapper use sendfile() (zero-copy).
+    """
+
+    def __init__(self):
+        self.root = os.path.abspath(os.getenv('LOCAL_STORAGE_ROOT', '/data/objects'))
+        self.public_url = os.getenv('LOCAL_STORAGE_PUBLIC_URL', 'http://localhost:5003/objects')
+        self.fsync = os.getenv('LOCAL_STORAGE_FSYNC', 'false').strip().lower() in {'1', 'true', 'yes', 'on'}
+        os.makedirs(self.root, exist_ok=True)
+
+    def path_for(self, key):
+        parts = key.split('/')
+        if not key or key.startswith('/') or any(part in ('', '.', '..') for part in parts):
+            raise ValueError(f"Invalid object key: {key}")
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.root, digest[:2], digest[2:4], *parts)
+
+    def _write_atomic(self, path, sources):
+        """Write the concatenated file objects to path via a temp file and an atomic rename"""
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+
+        # Readers never see partial objects: write a temp file in the target directory, then rename
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.upload-')
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file:
+                for source in sources:
+                    shutil.copyfileobj(source, tmp_file, OBJECT_STREAM_CHUNK_SIZE)
+                if self.fsync:
+                    tmp_file.flush()
+                    os.fsync(tmp_file.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+    def upload(self, file_buffer, key, mime_type):
+        self._write_atomic(self.path_for(key), [file_buffer])
+        return f"{self.public_url.rstrip('/')}/{key}"
+
+    def _multipart_dir(self, upload_id):
+        if not upload_id or not all(c in '0123456789abcdef' for c in upload_id):
+            raise ValueError(f"Invalid upload id: {upload_id}")
+        return os.path.join(self.root, '.multipart', upload_id)
+
+    def create_multipart(self, key, mime_type):
+        self.path_for(key)
+        upload_id = uuid.uuid4().hex
+        os.makedirs(self._multipart_dir(upload_id))
+        return upload_id
+
+    def upload_part(self, key, upload_id, part_number, data):
+        directory = self._multipart_dir(upload_id)
+        if not os.path.isdir(directory):
+            raise ValueError(f"Unknown upload id: {upload_id}")
+        path = os.path.join(directory, f'{part_number:05d}')
+        self._write_atomic(path, [io.BytesIO(data)])
+        return hashlib.md5(data).hexdigest()
+
+    def list_parts(self, key, upload_id):
+        directory = self._multipart_dir(upload_id)
+        if not os.path.isdir(directory):
+            raise ValueError(f"Unknown upload id: {upload_id}")
+        parts = []
+        for name in sorted(n for n in os.listdir(directory) if n.isdigit()):
+            path = os.path.join(directory, name)
+            with open(path, 'rb') as part_file:
+                etag = hashlib.md5(part_file.read()).hexdigest()
+            parts.append({'part_number': int(name), 'etag': etag, 'size': os.path.getsize(path)})
+        return parts
+
+    def complete_multipart(self, key, upload_id):
+        directory = self._multipart_dir(upload_id)
+        names = sorted(n for n in os.listdir(directory) if n.isdigit())
+        part_files = [open(os.path.join(directory, name), 'rb') for name in names]
+        try:
+            self._write_atomic(self.path_for(key), part_files)
+        finally:
+            for part_file in part_files:
+                part_file.close()
+        shutil.rmtree(directory, ignore_errors=True)
+        return f"{self.public_url.rstrip('/')}/{key}"
+
+    def abort_multipart(self, key, upload_id):
+        shutil.rmtree(self._multipart_dir(upload_id), ignore_errors=True)
+
+    def delete(self, key):
+        try:
+            os.unlink(self.path_for(key))
+        except FileNotFoundError:
+            pass
+
+    def presign(self, key, ttl):
+        return sign_object_url(self.public_url, key, ttl)
+
+    def serve(self, key):
+        path = self.path_for(key)
+        if not os.path.isfile(path):
+            return jsonify({'error': 'Object not found'}), 404
+
+        response = send_file(
+            path,
+            mimetype=mimetypes.guess_type(key)[0] or 'application/octet-stream',
+            conditional=True,
+            etag=True
+        )
+        response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+        return response
+
+@register_backend('memory')
+class MemoryBackend(StorageBackend):
+    """Keeps objects in process memory; for tests and local benchmarks"""
+
+    def __init__(self):
+        self.public_url = os.getenv('MEMORY_STORAGE_PUBLIC_URL', 'http://localhost:5003/objects')
+        self.objects = {}
+        self.multipart = {}
+        self._lock = threading.Lock()
+
+    def upload(self, file_buffer, key, mime_type):
+        data = file_buffer.read()
+        etag = hashlib.md5(data).hexdigest()
+        with self._lock:
+            self.objects[key] = (data, mime_type, etag, datetime.now(timezone.utc))
+        return f"{self.public_url.rstrip('/')}/{key}"
+
+    def delete(self, key):
+        with self._lock:
+            self.objects.pop(key, None)
+
+    def create_multipart(self, key, mime_type):
+        upload_id = uuid.uuid4().hex
+        with self._lock:
+            self.multipart[upload_id] = (mime_type, {})
+        return upload_id
+
+    def upload_part(self, key, upload_id, part_number, data):
+        with self._lock:
+            if upload_id not in self.multipart:
+                raise ValueError(f"Unknown upload id: {upload_id}")
+            self.multipart[upload_id][1][part_number] = data
+        return hashlib.md5(data).hexdigest()
+
+    def list_parts(self, key, upload_id):
+        with self._lock:
+            if upload_id not in self.multipart:
+                raise ValueError(f"Unknown upload id: {upload_id}")
+            parts = dict(self.multipart[upload_id][1])
+        return [
+            {'part_number': n, 'etag': hashlib.md5(parts[n]).hexdigest(), 'size': len(parts[n])}
+            for n in sorted(parts)
+        ]
+
+    def complete_multipart(self, key, upload_id):
+        with self._lock:
+            mime_type, parts = self.multipart.pop(upload_id)
+        data = b''.join(parts[n] for n in sorted(parts))
+        return self.upload(io.BytesIO(data), key, mime_type)
+
+    def abort_multipart(self, key, upload_id):
+        with self._lock:
+            self.multipart.pop(upload_id, None)
+
+    def presign(self, key, ttl):
+        return sign_object_url(self.public_url, key, ttl)
+
+    def serve(self, key):
+        with self._lock:
+            stored = self.objects.get(key)
+        if stored is None:
+            return jsonify({'error': 'Object not found'}), 404
+
+        data, mime_type, etag, last_modified = stored
+        response = Response(data, mimetype=mime_type)
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+        return response.make_conditional(request, accept_ranges=True, complete_length=len(data))
@@ -1,70 +1,176 @@
-﻿from flask import Flask, request, jsonify
+﻿from flask import Flask, request, jsonify, redirect
 from flask_cors import CORS
 import os
 import uuid
+import hashlib
+from datetime import datetime
+from urllib.parse import urlparse
 from dotenv import load_dotenv
-import boto3
-from botocore.exceptions import ClientError
 import base64
 import io
+import threading
+import time
+from collections import OrderedDict
 
 load_dotenv()
 
+from backends import (
+    BACKENDS, check_signing_key, get_backend, load_backend_plugins, reset_backends, verify_object_signature
+)
+from common import instrumentation, profiling, server, startup, tracing
+
+startup.mark('imports')
 app = Flask(__name__)
 CORS(app)
+instrumentation.init_app(app, 'storage-service')
+tracing.init_app(app, 'storage-service')
+profiling.init_app(app, 'storage-service')
+# boto3 clients and file handles are created again in each forked worker
+server.after_fork(reset_backends)
+startup.mark('app')
 
 # Configuration
+# Backends: aws (S3), local (filesystem under LOCAL_STORAGE_ROOT), memory (tests);
+# more can be registered by modules listed in STORAGE_BACKEND_PLUGINS
 STORAGE_PROVIDER = os.getenv('STORAGE_PROVIDER', 'aws')
-AWS_ACCESS_KEY_ID = os.getenv('AWS_ACCESS_KEY_ID')
-AWS_SECRET_ACCESS_KEY = os.getenv('AWS_SECRET_ACCESS_KEY')
-AWS_REGION = os.getenv('AWS_REGION', 'us-east-1')
-AWS_BUCKET_NAME = os.getenv('AWS_BUCKET_NAME')
+load_backend_plugins(os.getenv('STORAGE_BACKEND_PLUGINS'))
+check_signing_key(STORAGE_PROVIDER)
+startup.mark('backend plugins')
 
-class StorageService:
-    @staticmethod
-    def _s3_client():
-        
-        if AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY:
-            return boto3.client(
-                's3',
-                aws_access_key_id=AWS_ACCESS_KEY_ID,
-                aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-                region_name=AWS_REGION
-            )
-        return boto3.client('s3', region_name=AWS_REGION)
+# Object key layout: flat (uuid_filename at the bucket root), hashed (ab/cd/uuid_filename)
+# or date (YYYY/MM/DD/<job_id>/uuid_filename)
+STORAGE_KEY_LAYOUT = os.getenv('STORAGE_KEY_LAYOUT', 'flat').strip().lower()
+STORAGE_KEY_PREFIX = os.getenv('STORAGE_KEY_PREFIX', '').strip().strip('/')
+
+# Presigned GET URLs are cached until PRESIGNED_URL_REFRESH_MARGIN seconds before they expire
+PRESIGNED_URL_TTL = int(os.getenv('PRESIGNED_URL_TTL', 3600))
+PRESIGNED_URL_REFRESH_MARGIN = int(os.getenv('PRESIGNED_URL_REFRESH_MARGIN', 300))
+PRESIGNED_URL_CACHE_SIZE = int(os.getenv('PRESIGNED_URL_CACHE_SIZE', 100000))
+# Most keys that may be signed in a single /urls call
+PRESIGN_BATCH_LIMIT = 1000
+
+# How /objects/<key> serves S3 content: redirect (302 to a presigned URL) or proxy (stream through).
+# Local and memory objects are always served directly.
+OBJECT_SERVE_MODE = os.getenv('OBJECT_SERVE_MODE', 'redirect').strip().lower()
+# Require a valid signature on /objects requests for backends without native presigning
+# (local, memory). With false, unsigned requests are served and signatures are checked when present.
+STORAGE_REQUIRE_SIGNED_URLS = os.getenv('STORAGE_REQUIRE_SIGNED_URLS', 'true').strip().lower() in {'1', 'true', 'yes', 'on'}
+
+def build_object_key(filename, job_id=None):
+    """Build the object key for a new upload according to STORAGE_KEY_LAYOUT"""
+    unique_filename = f"{uuid.uuid4()}_{filename}"
+
+    if STORAGE_KEY_LAYOUT == 'flat':
+        parts = []
+    elif STORAGE_KEY_LAYOUT == 'hashed':
+        # Two levels of hex prefixes spread keys evenly across S3 partitions
+        digest = hashlib.md5(unique_filename.encode('utf-8')).hexdigest()
+        parts = [digest[:2], digest[2:4]]
+    elif STORAGE_KEY_LAYOUT == 'date':
+        parts = [datetime.utcnow().strftime('%Y/%m/%d'), job_id or 'adhoc']
+    else:
+        raise ValueError(f"Unsupported STORAGE_KEY_LAYOUT: {STORAGE_KEY_LAYOUT}")
+
+    if STORAGE_KEY_PREFIX:
+        parts.insert(0, STORAGE_KEY_PREFIX)
+    return '/'.join(parts + [unique_filename])
+
+def key_from_url(file_path):
+    """Derive the object key from a stored URL (only for rows written before keys were stored)"""
+    return urlparse(file_path).path.lstrip('/')
+
+class PresignedUrlCache:
+    """LRU cache of presigned URLs, dropping entries shortly before they expire"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] - PRESIGNED_URL_REFRESH_MARGIN <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, url, expires_at):
+        with self._lock:
+            self._entries[key] = (url, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
 
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+presigned_url_cache = PresignedUrlCache(PRESIGNED_URL_CACHE_SIZE)
+instrumentation.register_gauge(
+    'presigned_url_cache_entries', 'Presigned URLs held in the cache', lambda: len(presigned_url_cache._entries)
+)
+
+class StorageService:
     @staticmethod
-    def upload_to_s3(file_buffer, filename, mime_type):
-        """Upload file to AWS S3"""
+    def upload(provider, file_buffer, filename, mime_type, job_id=None):
+        """Upload file to the given storage backend"""
         try:
-            s3_client = StorageService._s3_client()
-            
-            unique_filename = f"{uuid.uuid4()}_{filename}"
-            
-            s3_client.upload_fileobj(
-                file_buffer,
-                AWS_BUCKET_NAME,
-                unique_filename,
-                ExtraArgs={'ContentType': mime_type, 'ACL': 'public-read'}
-            )
-            
-            url = f"https://{AWS_BUCKET_NAME}.s3.{AWS_REGION}.amazonaws.com/{unique_filename}"
-            return {'success': True, 'url': url, 'provider': 'aws'}
-        except ClientError as e:
+            key = build_object_key(filename, job_id)
+            # Measured first: boto3's upload_fileobj closes the buffer
+            size = file_buffer.getbuffer().nbytes
+            with instrumentation.stage(f'{provider}_upload'), tracing.span(f'{provider}_upload', key=key, size=size):
+                url = get_backend(provider).upload(file_buffer, key, mime_type)
+            instrumentation.record_bytes('upload', size)
+            return {'success': True, 'url': url, 'key': key, 'provider': provider}
+        except Exception as e:
             return {'success': False, 'error': str(e)}
     
     @staticmethod
-    def delete_from_s3(file_path):
-        """Delete file from AWS S3"""
+    def delete(provider, key):
+        """Delete file from the given storage backend"""
         try:
-            s3_client = StorageService._s3_client()
-            
-            filename = file_path.split('/')[-1]
-            s3_client.delete_object(Bucket=AWS_BUCKET_NAME, Key=filename)
+            get_backend(provider).delete(key)
+            presigned_url_cache.discard((provider, key))
             return {'success': True}
-        except ClientError as e:
+        except Exception as e:
             return {'success': False, 'error': str(e)}
 
+    @staticmethod
+    def delete_many(provider, keys):
+        """Delete many files from the given storage backend (batched where the backend supports it)"""
+        keys = list(dict.fromkeys(keys))
+        with instrumentation.stage(f'{provider}_delete_many'):
+            errors_by_key = get_backend(provider).delete_many(keys)
+
+        deleted = [key for key in keys if key not in errors_by_key]
+        for key in deleted:
+            presigned_url_cache.discard((provider, key))
+        errors = [{'key': key, 'error': error} for key, error in errors_by_key.items()]
+
+        return {'success': not errors, 'deleted': deleted, 'errors': errors}
+
+    @staticmethod
+    def presign(provider, key):
+        """Return a (url, expires_at) presigned GET for a key, reusing cached URLs"""
+        cached = presigned_url_cache.get((provider, key))
+        if cached:
+            return cached
+
+        expires_at = int(time.time()) + PRESIGNED_URL_TTL
+        with instrumentation.stage(f'{provider}_presign'):
+            url = get_backend(provider).presign(key, PRESIGNED_URL_TTL)
+        presigned_url_cache.set((provider, key), url, expires_at)
+        return url, expires_at
+
+def presigned_cache_control(expires_at):
+    """Cache-Control for a response carrying a presigned URL: valid until it is refreshed"""
+    max_age = max(0, int(expires_at - time.time()) - PRESIGNED_URL_REFRESH_MARGIN)
+    return f'private, max-age={max_age}'
+
 @app.route('/health', methods=['GET'])
 def health_check():
     return jsonify({'status': 'healthy', 'service': 'storage-service'}), 200
@@ -77,16 +183,17 @@ def upload_file():
         file_data_base64 = data.get('file_data')
         filename = data.get('filename')
         mime_type = data.get('mime_type')
+        job_id = data.get('job_id')
         provider = data.get('provider', STORAGE_PROVIDER)
         
         
         file_bytes = base64.b64decode(file_data_base64)
         file_buffer = io.BytesIO(file_bytes)
         
-        if provider != 'aws':
+        if provider not in BACKENDS:
             return jsonify({'error': 'Invalid storage provider'}), 400
 
-        result = StorageService.upload_to_s3(file_buffer, filename, mime_type)
+        result = StorageService.upload(provider, file_buffer, filename, mime_type, job_id)
         
         if result['success']:
             return jsonify(result), 200
@@ -101,13 +208,16 @@ def delete_file():
     """Delete file from cloud storage"""
     try:
         data = request.get_json()
-        file_path = data.get('file_path')
+        key = data.get('key') or key_from_url(data.get('file_path') or '')
         provider = data.get('provider', STORAGE_PROVIDER)
         
-        if provider != 'aws':
+        if provider not in BACKENDS:
             return jsonify({'error': 'Invalid storage provider'}), 400
 
-        result = StorageService.delete_from_s3(file_path)
+        if not key:
+            return jsonify({'error': 'key is required'}), 400
+
+        result = StorageService.delete(provider, key)
         
         if result['success']:
             return jsonify(result), 200
@@ -117,6 +227,200 @@ def delete_file():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/delete-batch', methods=['POST'])
+def delete_files():
+    """Delete many files from cloud storage, reporting failures per file"""
+    try:
+        data = request.get_json()
+        keys = data.get('keys') or []
+        provider = data.get('provider', STORAGE_PROVIDER)
+
+        if provider not in BACKENDS:
+            return jsonify({'error': 'Invalid storage provider'}), 400
+
+        if not keys:
+            return jsonify({'success': True, 'deleted': [], 'errors': []}), 200
+
+        result = StorageService.delete_many(provider, keys)
+
+        # Partial failures are reported per key, not as a failed request
+        return jsonify(result), 200
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/multipart', methods=['POST'])
+def create_multipart_upload():
+    """Start a resumable multipart upload; parts are sent as raw bytes to /multipart/<id>/parts/<n>"""
+    try:
+        data = request.get_json()
+        filename = data.get('filename')
+        mime_type = data.get('mime_type')
+        job_id = data.get('job_id')
+        provider = data.get('provider', STORAGE_PROVIDER)
+
+        if provider not in BACKENDS:
+            return jsonify({'error': 'Invalid storage provider'}), 400
+
+        key = build_object_key(filename, job_id)
+        upload_id = get_backend(provider).create_multipart(key, mime_type)
+
+        return jsonify({'upload_id': upload_id, 'key': key, 'provider': provider}), 201
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/multipart/<upload_id>/parts/<int:part_number>', methods=['PUT'])
+def upload_multipart_part(upload_id, part_number):
+    """Store one part of a multipart upload (request body is the raw part)"""
+    try:
+        key = request.args.get('key')
+        provider = request.args.get('provider', STORAGE_PROVIDER)
+
+        if provider not in BACKENDS:
+            return jsonify({'error': 'Invalid storage provider'}), 400
+
+        if not key:
+            return jsonify({'error': 'key is required'}), 400
+
+        part = request.get_data()
+        with instrumentation.stage(f'{provider}_upload_part'), \
+                tracing.span(f'{provider}_upload_part', key=key, part_number=part_number, size=len(part)):
+            etag = get_backend(provider).upload_part(key, upload_id, part_number, part)
+        instrumentation.record_bytes('upload', len(part))
+        return jsonify({'part_number': part_number, 'etag': etag}), 200
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 404
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/multipart/<upload_id>', methods=['GET'])
+def list_multipart_parts(upload_id):
+    """List the parts already stored, so an interrupted upload can continue where it stopped"""
+    try:
+        key = request.args.get('key')
+        provider = request.args.get('provider', STORAGE_PROVIDER)
+
+        if provider not in BACKENDS:
+            return jsonify({'error': 'Invalid storage provider'}), 400
+
+        parts = get_backend(provider).list_parts(key, upload_id)
+        return jsonify({'upload_id': upload_id, 'key': key, 'parts': parts}), 200
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 404
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/multipart/<upload_id>/complete', methods=['POST'])
+def complete_multipart_upload(upload_id):
+    """Assemble the stored parts into the final object"""
+    try:
+        data = request.get_json()
+        key = data.get('key')
+        provider = data.get('provider', STORAGE_PROVIDER)
+
+        if provider not in BACKENDS:
+            return jsonify({'error': 'Invalid storage provider'}), 400
+
+        url = get_backend(provider).complete_multipart(key, upload_id)
+        return jsonify({'success': True, 'url': url, 'key': key, 'provider': provider}), 200
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/multipart/<upload_id>', methods=['DELETE'])
+def abort_multipart_upload(upload_id):
+    """Abort a multipart upload and discard its parts"""
+    try:
+        key = request.args.get('key')
+        provider = request.args.get('provider', STORAGE_PROVIDER)
+
+        if provider not in BACKENDS:
+            return jsonify({'error': 'Invalid storage provider'}), 400
+
+        get_backend(provider).abort_multipart(key, upload_id)
+        return jsonify({'success': True}), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/url', methods=['GET'])
+def get_presigned_url():
+    """Issue a short-lived presigned GET URL for one object"""
+    try:
+        key = request.args.get('key')
+        provider = request.args.get('provider', STORAGE_PROVIDER)
+        if not key:
+            return jsonify({'error': 'key is required'}), 400
+
+        if provider not in BACKENDS:
+            return jsonify({'error': 'Invalid storage provider'}), 400
+
+        url, expires_at = StorageService.presign(provider, key)
+
+        response = jsonify({'key': key, 'url': url, 'expires_at': expires_at})
+        response.headers['Cache-Control'] = presigned_cache_control(expires_at)
+        return response, 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/urls', methods=['POST'])
+def get_presigned_urls():
+    """Issue presigned GET URLs for many objects (e.g. a whole gallery page) in one call"""
+    try:
+        data = request.get_json() or {}
+        keys = [key for key in dict.fromkeys(data.get('keys') or []) if key]
+        provider = data.get('provider', STORAGE_PROVIDER)
+
+        if provider not in BACKENDS:
+            return jsonify({'error': 'Invalid storage provider'}), 400
+
+        if len(keys) > PRESIGN_BATCH_LIMIT:
+            return jsonify({'error': f'At most {PRESIGN_BATCH_LIMIT} keys per request'}), 400
+
+        urls = {}
+        expires_at = int(time.time()) + PRESIGNED_URL_TTL
+        for key in keys:
+            url, key_expires_at = StorageService.presign(provider, key)
+            urls[key] = url
+            expires_at = min(expires_at, key_expires_at)
+
+        response = jsonify({'urls': urls, 'expires_at': expires_at})
+        response.headers['Cache-Control'] = presigned_cache_control(expires_at)
+        return response, 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/objects/<path:key>', methods=['GET'])
+def serve_object(key):
+    """
+    CDN-friendly read path for an object. For S3 in redirect mode the client is sent to
+    a presigned URL (S3 handles Range itself); otherwise the backend serves the object
+    with Range support and immutable cache headers.
+    """
+    try:
+        provider = request.args.get('provider', STORAGE_PROVIDER)
+        mode = request.args.get('mode', OBJECT_SERVE_MODE)
+        backend = get_backend(provider)
+
+        if backend is None:
+            return jsonify({'error': 'Invalid storage provider'}), 400
+
+        if backend.native_presign and mode == 'redirect':
+            url, expires_at = StorageService.presign(provider, key)
+            response = redirect(url, code=302)
+            response.headers['Cache-Control'] = presigned_cache_control(expires_at)
+            return response
+
+        if not backend.native_presign and (STORAGE_REQUIRE_SIGNED_URLS or 'signature' in request.args):
+            if not verify_object_signature(key, request.args.get('expires'), request.args.get('signature')):
+                return jsonify({'error': 'Invalid or expired signature'}), 403
+
+        return backend.serve(key)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+startup.ready('storage-service')
+
 if __name__ == '__main__':
     port = int(os.getenv('PORT', 5003))
     app.run(host='0.0.0.0', port=port, debug=False)
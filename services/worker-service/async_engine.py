@@ -0,0 +1,370 @@
+﻿"""
+asyncio worker engine (WORKER_ENGINE=async).
+
+Files from /process-batch go onto a multiprocessing queue consumed by one child process
+per core. Each child runs a single event loop in which every file is a task moving
+through three async stages (Drive download, storage upload, metadata record). Each stage
+is bounded by its own semaphore, so thousands of transfers can be in flight without a
+thread per transfer. Checkpoint reporting and multipart resume match process_single_image.
+
+The parent decides the order: files wait in its job-aware scheduler and are fed to the
+children through a short queue, and the children report every finished file back so
+per-job concurrency caps hold across all processes.
+"""
+import asyncio
+import base64
+import multiprocessing
+import os
+import threading
+
+from common import drive, instrumentation, tracing
+from fleet import FileReassigned
+from scheduler import FairScheduler
+
+WORKER_ASYNC_PROCESSES = int(os.getenv('WORKER_ASYNC_PROCESSES', 0)) or os.cpu_count() or 1
+# Files each event loop holds at once, and per-stage limits within that
+WORKER_ASYNC_MAX_IN_FLIGHT = int(os.getenv('WORKER_ASYNC_MAX_IN_FLIGHT', 1000))
+WORKER_ASYNC_DOWNLOAD_CONCURRENCY = int(os.getenv('WORKER_ASYNC_DOWNLOAD_CONCURRENCY', 200))
+WORKER_ASYNC_UPLOAD_CONCURRENCY = int(os.getenv('WORKER_ASYNC_UPLOAD_CONCURRENCY', 200))
+WORKER_ASYNC_RECORD_CONCURRENCY = int(os.getenv('WORKER_ASYNC_RECORD_CONCURRENCY', 100))
+
+# Per-process counters, shared with the parent through one multiprocessing.Array
+COUNTERS = ('in_flight', 'downloading', 'uploading', 'recording', 'completed', 'failed')
+
+class ServiceError(Exception):
+    pass
+
+class AsyncFileProcessor:
+    """Runs the download -> upload -> record stages for files on one event loop"""
+    def __init__(self, settings, session, limiter, counters):
+        self.settings = settings
+        self.session = session
+        self.limiter = limiter
+        self.counters = counters
+        self.download_slots = asyncio.Semaphore(WORKER_ASYNC_DOWNLOAD_CONCURRENCY)
+        self.upload_slots = asyncio.Semaphore(WORKER_ASYNC_UPLOAD_CONCURRENCY)
+        self.record_slots = asyncio.Semaphore(WORKER_ASYNC_RECORD_CONCURRENCY)
+
+    def add(self, name, amount=1):
+        self.counters[COUNTERS.index(name)] += amount
+
+    async def request_json(self, method, url, expected, **kwargs):
+        async with self.session.request(method, url, **kwargs) as response:
+            if response.status not in expected:
+                raise ServiceError(f"{method} {url} failed: {await response.text()}")
+            return response.status, await response.json()
+
+    async def update_job_status(self, job_id, processed=0, failed=0, imported=None, file_id=None, state=None, **checkpoint):
+        payload = {'job_id': job_id, 'processed': processed, 'failed': failed, 'imported': imported or []}
+        if file_id and state:
+            payload.update(checkpoint, file_id=file_id, state=state)
+        try:
+            status, body = await self.request_json(
+                'POST', f"{self.settings['IMPORT_SERVICE_URL']}/import/update-status", (200, 409), json=payload
+            )
+        except Exception as e:
+            print(f"Error updating job status: {str(e)}")
+            return
+        if status == 409:
+            # Sent to another worker since, or already recorded
+            raise FileReassigned(body.get('error'))
+
+    async def upload(self, file_buffer, filename, mime_type, job_id):
+        # Encoding a large file would stall every other transfer on this loop
+        file_data = await asyncio.to_thread(lambda: base64.b64encode(file_buffer.getbuffer()).decode('utf-8'))
+        _, body = await self.request_json(
+            'POST', f"{self.settings['STORAGE_SERVICE_URL']}/upload", (200,),
+            json={
+                'file_data': file_data,
+                'filename': filename,
+                'mime_type': mime_type,
+                'job_id': job_id,
+                'provider': self.settings['STORAGE_PROVIDER']
+            }
+        )
+        return body
+
+    async def upload_multipart(self, file_buffer, filename, mime_type, job_id, file_id, checkpoint, lease=None):
+        storage_url = self.settings['STORAGE_SERVICE_URL']
+        part_size = self.settings['MULTIPART_PART_SIZE']
+        provider = checkpoint.get('storage_provider') or self.settings['STORAGE_PROVIDER']
+        upload_id = checkpoint.get('upload_id')
+        key = checkpoint.get('storage_key')
+        data = file_buffer.getbuffer()
+        total_size = data.nbytes
+
+        stored_parts = set()
+        if upload_id and key:
+            try:
+                _, body = await self.request_json(
+                    'GET', f"{storage_url}/multipart/{upload_id}", (200,), params={'key': key, 'provider': provider}
+                )
+                for part in body.get('parts', []):
+                    offset = (part['part_number'] - 1) * part_size
+                    if part['size'] == min(part_size, total_size - offset):
+                        stored_parts.add(part['part_number'])
+            except ServiceError:
+                upload_id = None
+
+        if not upload_id or not key:
+            _, body = await self.request_json(
+                'POST', f"{storage_url}/multipart", (201,),
+                json={'filename': filename, 'mime_type': mime_type, 'job_id': job_id, 'provider': provider}
+            )
+            upload_id, key = body['upload_id'], body['key']
+            await self.update_job_status(
+                job_id, file_id=file_id, state='downloading', lease=lease,
+                upload_id=upload_id, storage_key=key, storage_provider=provider
+            )
+
+        for part_number, offset in enumerate(range(0, total_size, part_size), start=1):
+            if part_number in stored_parts:
+                continue
+            await self.request_json(
+                'PUT', f"{storage_url}/multipart/{upload_id}/parts/{part_number}", (200,),
+                params={'key': key, 'provider': provider},
+                data=bytes(data[offset:offset + part_size]),
+                headers={'Content-Type': 'application/octet-stream'}
+            )
+
+        _, body = await self.request_json(
+            'POST', f"{storage_url}/multipart/{upload_id}/complete", (200,), json={'key': key, 'provider': provider}
+        )
+        return body
+
+    async def save_metadata(self, metadata):
+        _, body = await self.request_json(
+            'POST', f"{self.settings['METADATA_SERVICE_URL']}/images", (201, 409), json=metadata
+        )
+        return body
+
+    async def process(self, job_id, file_data, trace_headers=None):
+        file_id = file_data['id']
+        with tracing.span(
+            'import_file', parent=tracing.extract(trace_headers or {}),
+            baggage={'job_id': job_id, 'file_id': file_id},
+            file_name=file_data['name'], size=int(file_data.get('size', 0))
+        ) as file_span:
+            await self.process_file(job_id, file_data, file_span)
+
+    async def process_file(self, job_id, file_data, file_span):
+        file_id = file_data['id']
+        checkpoint = file_data.get('checkpoint') or {}
+        lease = file_data.get('lease')
+        self.add('in_flight')
+        try:
+            if checkpoint.get('state') == 'uploaded' and checkpoint.get('storage_url'):
+                storage_result = {
+                    'url': checkpoint['storage_url'],
+                    'key': checkpoint.get('storage_key'),
+                    'provider': checkpoint.get('storage_provider') or self.settings['STORAGE_PROVIDER']
+                }
+            else:
+                await self.update_job_status(job_id, file_id=file_id, state='downloading', lease=lease)
+
+                async with self.download_slots:
+                    self.add('downloading')
+                    try:
+                        with instrumentation.stage('drive_download'), tracing.span('drive_download'):
+                            file_buffer = await drive.download_media_async(
+                                self.session, self.limiter, file_id, self.settings['GOOGLE_API_KEY'], file_data.get('size')
+                            )
+                        instrumentation.record_bytes('drive_download', file_buffer.getbuffer().nbytes)
+                    except Exception as e:
+                        raise Exception(f"Error downloading from Google Drive: {str(e)}")
+                    finally:
+                        self.add('downloading', -1)
+
+                async with self.upload_slots:
+                    self.add('uploading')
+                    try:
+                        size = file_buffer.getbuffer().nbytes
+                        with instrumentation.stage('storage_upload'), \
+                                tracing.span('storage_upload', multipart=size >= self.settings['MULTIPART_THRESHOLD']):
+                            if size >= self.settings['MULTIPART_THRESHOLD']:
+                                storage_result = await self.upload_multipart(
+                                    file_buffer, file_data['name'], file_data['mimeType'], job_id, file_id, checkpoint, lease
+                                )
+                            else:
+                                storage_result = await self.upload(
+                                    file_buffer, file_data['name'], file_data['mimeType'], job_id
+                                )
+                        instrumentation.record_bytes('storage_upload', size)
+                    finally:
+                        self.add('uploading', -1)
+                del file_buffer
+
+                await self.update_job_status(
+                    job_id, file_id=file_id, state='uploaded', lease=lease,
+                    storage_url=storage_result['url'],
+                    storage_key=storage_result.get('key'),
+                    storage_provider=storage_result['provider']
+                )
+
+            async with self.record_slots:
+                self.add('recording')
+                try:
+                    with instrumentation.stage('metadata_save'), tracing.span('metadata_save'):
+                        saved_metadata = await self.save_metadata({
+                            'name': file_data['name'],
+                            'google_drive_id': file_data['id'],
+                            'size': int(file_data.get('size', 0)),
+                            'mime_type': file_data['mimeType'],
+                            'storage_path': storage_result['url'],
+                            'storage_key': storage_result.get('key'),
+                            'storage_provider': storage_result['provider']
+                        })
+                finally:
+                    self.add('recording', -1)
+
+            await self.update_job_status(
+                job_id, processed=1, imported=[saved_metadata], file_id=file_id, state='recorded', lease=lease
+            )
+            self.add('completed')
+        except FileReassigned as e:
+            print(f"Dropped {file_data['name']}: {str(e)}")
+        except Exception as e:
+            print(f"Failed to process {file_data['name']}: {str(e)}")
+            file_span.record_error(e)
+            try:
+                await self.update_job_status(job_id, failed=1, file_id=file_id, state='failed', lease=lease, error=str(e))
+            except FileReassigned:
+                pass
+            self.add('failed')
+        finally:
+            self.add('in_flight', -1)
+
+async def run_event_loop(queue, done, counters, settings):
+    """
+    Pull files off the queue and process them, keeping at most WORKER_ASYNC_MAX_IN_FLIGHT
+    at once; (job_id, size) of every finished file goes onto done
+    """
+    import aiohttp
+
+    loop = asyncio.get_running_loop()
+    in_flight = asyncio.Semaphore(WORKER_ASYNC_MAX_IN_FLIGHT)
+    tasks = set()
+    connector = aiohttp.TCPConnector(limit=0, ttl_dns_cache=300)
+    timeout = aiohttp.ClientTimeout(total=None, connect=10, sock_read=300)
+
+    trace_configs = [tracing.aiohttp_trace_config()] if tracing.ENABLED else []
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout, trace_configs=trace_configs) as session:
+        processor = AsyncFileProcessor(settings, session, drive.AsyncDriveRateLimiter(), counters)
+
+        def finished(task, job_id, size):
+            tasks.discard(task)
+            in_flight.release()
+            done.put((job_id, size))
+
+        while True:
+            await in_flight.acquire()
+            item = await loop.run_in_executor(None, queue.get)
+            if item is None:
+                break
+            task = asyncio.create_task(processor.process(*item))
+            tasks.add(task)
+            task.add_done_callback(
+                lambda task, job_id=item[0], size=int(item[1].get('size') or 0): finished(task, job_id, size)
+            )
+
+        if tasks:
+            await asyncio.gather(*tasks)
+
+class _CounterSlice:
+    """This process's counters inside the shared array (only this process writes them)"""
+    def __init__(self, array, offset):
+        self.array = array
+        self.offset = offset
+
+    def __getitem__(self, i):
+        return self.array[self.offset + i]
+
+    def __setitem__(self, i, value):
+        self.array[self.offset + i] = value
+
+def child_main(index, queue, done, counters, settings):
+    """Entry point of one event-loop process"""
+    # Stage timings reach /metrics only when PROMETHEUS_MULTIPROC_DIR is shared with the parent
+    instrumentation.SERVICE = tracing.SERVICE = 'worker-service'
+    asyncio.run(run_event_loop(queue, done, _CounterSlice(counters, index * len(COUNTERS)), settings))
+    tracing.flush()
+
+class AsyncWorkerEngine:
+    """Parent-side handle: owns the queue and the event-loop processes"""
+    def __init__(self, settings, processes=WORKER_ASYNC_PROCESSES, on_finished=None):
+        # spawn: the Flask parent already runs threads, which fork would copy mid-state
+        self.context = multiprocessing.get_context('spawn')
+        self.settings = settings
+        self.processes = processes
+        # on_finished(size) for every file a child finished
+        self.on_finished = on_finished
+        self.scheduler = FairScheduler()
+        # Kept short so the scheduler, not this queue, decides which file starts next
+        self.queue = self.context.Queue(maxsize=processes)
+        self.done = self.context.Queue()
+        self.counters = self.context.Array('q', processes * len(COUNTERS), lock=False)
+        self.children = []
+
+    def start(self):
+        for index in range(self.processes):
+            child = self.context.Process(
+                target=child_main, args=(index, self.queue, self.done, self.counters, self.settings), daemon=True
+            )
+            child.start()
+            self.children.append(child)
+        threading.Thread(target=self.feed, name='async-engine-feed', daemon=True).start()
+        threading.Thread(target=self.collect, name='async-engine-collect', daemon=True).start()
+        return self
+
+    def feed(self):
+        """Move files from the scheduler to the children, in the scheduler's order"""
+        while True:
+            item = self.scheduler.get()
+            self.queue.put((item['job_id'], item['file_data'], item['trace_headers']))
+            self.scheduler.task_done()
+
+    def collect(self):
+        """Release each finished file's job slot"""
+        while True:
+            job_id, size = self.done.get()
+            self.scheduler.release(job_id)
+            if self.on_finished:
+                self.on_finished(size)
+
+    def submit(self, job_id, files, trace_headers=None, priority=1, max_concurrency=None):
+        """trace_headers (traceparent/baggage) make each file's span a child of the dispatching request"""
+        for file_data in files:
+            self.scheduler.put({
+                'job_id': job_id, 'priority': priority, 'max_concurrency': max_concurrency,
+                'file_data': file_data, 'trace_headers': trace_headers
+            })
+
+    def take(self, count):
+        """Up to count files not yet handed to a child, removed from the engine"""
+        return self.scheduler.take(count)
+
+    def stop(self, timeout=None):
+        """Let the children finish everything queued, then exit"""
+        self.scheduler.join()
+        for _ in self.children:
+            self.queue.put(None)
+        for child in self.children:
+            child.join(timeout)
+
+    def stats(self):
+        totals = {name: 0 for name in COUNTERS}
+        for index in range(self.processes):
+            for i, name in enumerate(COUNTERS):
+                totals[name] += self.counters[index * len(COUNTERS) + i]
+        try:
+            queued = self.scheduler.qsize() + self.queue.qsize()
+        except NotImplementedError:
+            queued = self.scheduler.qsize()
+        return {
+            'engine': 'async',
+            'processes': self.processes,
+            'alive': sum(1 for child in self.children if child.is_alive()),
+            'queued': queued,
+            **totals,
+            'jobs': self.scheduler.stats()
+        }
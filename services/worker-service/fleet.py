@@ -0,0 +1,111 @@
+﻿"""
+Membership of this worker in the import-service's worker fleet.
+
+With WORKER_ADVERTISE_URL set (the URL the import-service reaches this worker at), the
+worker registers itself by posting a heartbeat to IMPORT_SERVICE_URL/workers/heartbeat
+every WORKER_HEARTBEAT_SECONDS. A heartbeat carries the worker_id (new every time the
+process starts) and its load: files queued but not started, files in progress, and the
+bytes of all files accepted but not finished. The import-service sends each batch to the
+least-loaded worker, re-dispatches the unfinished files of workers whose heartbeats
+stop, and asks busy workers for queued files back (POST /release-files) when a worker
+joins. On a graceful exit the worker deregisters after draining.
+
+Every file arrives with a lease, which the worker sends back with each status report. A
+file the import-service has since sent to another worker (this one missed its heartbeats,
+or the job was resumed) has a newer lease; its reports are refused with 409, and the
+worker drops the file (FileReassigned) instead of downloading or uploading it again. A
+worker told by a heartbeat reply that it expired registers again under a new worker_id
+and drops, at their next stage, the files it accepted under the old one.
+
+Without WORKER_ADVERTISE_URL nothing is sent and the import-service keeps sending every
+batch to its WORKER_SERVICE_URL.
+"""
+import os
+import threading
+import uuid
+
+import requests
+
+WORKER_ADVERTISE_URL = os.getenv('WORKER_ADVERTISE_URL', '').strip().rstrip('/')
+WORKER_HEARTBEAT_SECONDS = float(os.getenv('WORKER_HEARTBEAT_SECONDS', 2))
+
+class FileReassigned(Exception):
+    """The import-service has taken this file from this worker and sent it elsewhere"""
+
+def file_size(file_data):
+    # Drive lists sizes as strings
+    return int(file_data.get('size') or 0)
+
+class Load:
+    """Files and bytes this worker has accepted and not finished (recorded, failed or given back)"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files = 0
+        self.bytes = 0
+
+    def add(self, files):
+        with self.lock:
+            self.files += len(files)
+            self.bytes += sum(file_size(file_data) for file_data in files)
+
+    def finish(self, size):
+        with self.lock:
+            self.files = max(self.files - 1, 0)
+            self.bytes = max(self.bytes - size, 0)
+
+    def snapshot(self):
+        with self.lock:
+            return self.files, self.bytes
+
+class Heartbeat:
+    """Background thread reporting report() to the import-service"""
+    def __init__(self, import_service_url, report, advertise_url=WORKER_ADVERTISE_URL):
+        self.import_service_url = import_service_url
+        self.report = report
+        self.advertise_url = advertise_url
+        self.worker_id = None
+        self.stopped = threading.Event()
+        self.healthy = True
+
+    def start(self):
+        if not self.advertise_url:
+            return
+        self.worker_id = uuid.uuid4().hex
+        self.stopped = threading.Event()
+        threading.Thread(target=self.run, name='fleet-heartbeat', daemon=True).start()
+
+    def run(self):
+        while True:
+            self.beat()
+            if self.stopped.wait(WORKER_HEARTBEAT_SECONDS):
+                return
+
+    def beat(self):
+        try:
+            response = requests.post(
+                f"{self.import_service_url}/workers/heartbeat",
+                json=dict(self.report(), worker_id=self.worker_id, url=self.advertise_url),
+                timeout=5
+            )
+            if response.status_code == 409 and response.json().get('expired'):
+                # Our files are being sent to other workers; join again as a new worker
+                expired, self.worker_id = self.worker_id, uuid.uuid4().hex
+                print(f"Worker {expired} expired after missing heartbeats; registering as {self.worker_id}")
+                return self.beat()
+            response.raise_for_status()
+            self.healthy = True
+        except Exception as e:
+            # Once per outage, not every interval
+            if self.healthy:
+                print(f"Error sending heartbeat: {str(e)}")
+            self.healthy = False
+
+    def leave(self):
+        """Stop the heartbeats and deregister, so the import-service stops sending batches at once"""
+        if self.worker_id is None:
+            return
+        self.stopped.set()
+        try:
+            requests.delete(f"{self.import_service_url}/workers/{self.worker_id}", timeout=5)
+        except Exception as e:
+            print(f"Error deregistering worker: {str(e)}")
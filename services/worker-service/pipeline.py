@@ -0,0 +1,120 @@
+﻿"""
+Staged thread pipeline for the worker (WORKER_ENGINE=pipeline).
+
+Each stage owns a queue and its own pool of threads. An item that a stage handler
+returns goes onto the next stage's queue. The queues between stages are bounded, so a
+slow stage makes the stages before it wait instead of piling buffers up in memory.
+Stages overlap, and each can be sized for its own bottleneck (Drive, storage or the
+metadata DB). Queue depths and per-stage timings are exposed through stats().
+The first stage may take its items from another queue-like object, e.g. the job-aware
+scheduler, which then decides the order in which files enter the pipeline.
+"""
+import queue
+import threading
+import time
+
+class Stage:
+    def __init__(self, name, handler, workers, queue_size=0, work_queue=None):
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.queue = work_queue if work_queue is not None else queue.Queue(maxsize=queue_size)
+        self.next = None
+        self.on_error = None
+        self.on_finished = None
+        self.lock = threading.Lock()
+        self.busy = 0
+        self.processed = 0
+        self.failed = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.blocked_seconds = 0.0
+
+    def start(self):
+        for i in range(self.workers):
+            threading.Thread(target=self.run, name=f'pipeline-{self.name}-{i}', daemon=True).start()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            with self.lock:
+                self.busy += 1
+            started = time.perf_counter()
+            try:
+                result = self.handler(item)
+                ok = True
+            except Exception as e:
+                ok = False
+                if self.on_error:
+                    self.on_error(self.name, item, e)
+            elapsed = time.perf_counter() - started
+            with self.lock:
+                self.busy -= 1
+                self.total_seconds += elapsed
+                self.max_seconds = max(self.max_seconds, elapsed)
+                if ok:
+                    self.processed += 1
+                else:
+                    self.failed += 1
+
+            if ok and result is not None and self.next is not None:
+                # Blocks while the next stage is full: backpressure instead of unbounded buffering
+                waited = time.perf_counter()
+                self.next.queue.put(result)
+                with self.lock:
+                    self.blocked_seconds += time.perf_counter() - waited
+            elif ok and result is not None and self.on_finished:
+                self.on_finished(result)
+            self.queue.task_done()
+
+    def stats(self):
+        with self.lock:
+            done = self.processed + self.failed
+            return {
+                'name': self.name,
+                'workers': self.workers,
+                'busy': self.busy,
+                'queue_depth': self.queue.qsize(),
+                'queue_size': self.queue.maxsize or None,
+                'processed': self.processed,
+                'failed': self.failed,
+                'avg_seconds': round(self.total_seconds / done, 4) if done else None,
+                'max_seconds': round(self.max_seconds, 4),
+                'blocked_on_next_seconds': round(self.blocked_seconds, 2),
+            }
+
+class Pipeline:
+    """
+    Stages chained in order; on_error(stage_name, item, exc) is called for failed items and
+    on_finished(item) for items that leave the last stage
+    """
+    def __init__(self, stages, on_error=None, on_finished=None):
+        self.stages = stages
+        for stage, next_stage in zip(stages, stages[1:] + [None]):
+            stage.next = next_stage
+            stage.on_error = on_error
+        stages[-1].on_finished = on_finished
+        self.started_at = None
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+        self.started_at = time.time()
+        return self
+
+    def submit(self, item):
+        self.stages[0].queue.put(item)
+
+    def join(self):
+        """Wait until every submitted item has left the pipeline"""
+        for stage in self.stages:
+            stage.queue.join()
+
+    def stats(self):
+        stages = [stage.stats() for stage in self.stages]
+        return {
+            'engine': 'pipeline',
+            'uptime_seconds': round(time.time() - self.started_at, 1) if self.started_at else 0,
+            'in_pipeline': sum(s['queue_depth'] + s['busy'] for s in stages),
+            'stages': stages,
+        }
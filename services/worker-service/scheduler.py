@@ -0,0 +1,146 @@
+﻿"""
+Job-aware scheduling for the worker engines.
+
+Files wait in one queue per job_id and are handed out by weighted round robin across
+jobs: on its turn a job may start up to `priority` files, then the next job gets its
+turn. A 10-file import that arrives behind a 100k-file one therefore starts at once and
+finishes in seconds, while the big import keeps going with the remaining capacity.
+
+A job may also cap how many of its files are in progress at once (`max_concurrency`).
+A job at its cap is skipped until release() reports one of its files finished.
+
+FairScheduler has the put/get/task_done/join/qsize interface of queue.Queue, so it can
+stand in for the first queue of the pipeline. take() removes queued items again when the
+import-service moves them to another worker. Items are dicts carrying job_id and,
+optionally, priority and max_concurrency (the latest values seen for a job apply).
+"""
+import collections
+import threading
+
+class _Job:
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.priority = 1
+        self.max_concurrency = None
+        self.queued = collections.deque()
+        self.running = 0
+        # Files the job may still start in its current turn
+        self.credit = 0
+
+    def at_cap(self):
+        return self.max_concurrency is not None and self.running >= self.max_concurrency
+
+class FairScheduler:
+    maxsize = 0
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.all_done = threading.Condition(self.lock)
+        self.jobs = {}
+        # Jobs with queued files, in turn order
+        self.turns = collections.deque()
+        self.unfinished = 0
+
+    def put(self, item):
+        with self.lock:
+            job = self.jobs.get(item['job_id'])
+            if job is None:
+                job = self.jobs[item['job_id']] = _Job(item['job_id'])
+            job.priority = max(int(item.get('priority') or 1), 1)
+            job.max_concurrency = item.get('max_concurrency') or None
+            if not job.queued:
+                self.turns.append(job.job_id)
+            job.queued.append(item)
+            self.unfinished += 1
+            self.ready.notify()
+
+    def get(self):
+        """Next item by weighted round robin; blocks while nothing is queued or every job is at its cap"""
+        with self.lock:
+            while True:
+                item = self._next()
+                if item is not None:
+                    return item
+                self.ready.wait()
+
+    def _next(self):
+        for _ in range(len(self.turns)):
+            job = self.jobs[self.turns[0]]
+            if job.at_cap():
+                self.turns.rotate(-1)
+                continue
+            if job.credit <= 0:
+                job.credit = job.priority
+            job.credit -= 1
+            job.running += 1
+            item = job.queued.popleft()
+            if not job.queued:
+                self.turns.popleft()
+                job.credit = 0
+            elif job.credit <= 0:
+                self.turns.rotate(-1)
+            return item
+        return None
+
+    def release(self, job_id):
+        """A file handed out by get() has finished (recorded or failed)"""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return
+            job.running = max(job.running - 1, 0)
+            if not job.queued and not job.running:
+                del self.jobs[job_id]
+            self.ready.notify()
+
+    def take(self, count):
+        """
+        Remove up to count queued items, newest first from the jobs with the most queued,
+        to hand them to another worker. They count as done for join().
+        """
+        with self.lock:
+            taken = []
+            while len(taken) < count:
+                waiting = [job for job in self.jobs.values() if job.queued]
+                if not waiting:
+                    break
+                job = max(waiting, key=lambda job: len(job.queued))
+                taken.append(job.queued.pop())
+                if not job.queued:
+                    self.turns.remove(job.job_id)
+                    job.credit = 0
+                    if not job.running:
+                        del self.jobs[job.job_id]
+            self.unfinished -= len(taken)
+            if self.unfinished <= 0:
+                self.all_done.notify_all()
+            return taken
+
+    def task_done(self):
+        with self.lock:
+            self.unfinished -= 1
+            if self.unfinished <= 0:
+                self.all_done.notify_all()
+
+    def join(self):
+        """Wait until every item put has been taken and marked done"""
+        with self.lock:
+            while self.unfinished > 0:
+                self.all_done.wait()
+
+    def qsize(self):
+        with self.lock:
+            return sum(len(job.queued) for job in self.jobs.values())
+
+    def stats(self):
+        with self.lock:
+            return {
+                job.job_id: {
+                    'queued': len(job.queued),
+                    'running': job.running,
+                    'priority': job.priority,
+                    'max_concurrency': job.max_concurrency,
+                }
+                for job in self.jobs.values()
+            }
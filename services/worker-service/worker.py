@@ -2,17 +2,27 @@
 from flask_cors import CORS
 import os
 import requests
-import io
 from dotenv import load_dotenv
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload
 import concurrent.futures
+import contextvars
+import functools
+import threading
 import time
 
 load_dotenv()
 
+from common import drive, instrumentation, profiling, server, startup, tracing
+from scheduler import FairScheduler
+
+import fleet
+
+startup.mark('imports')
 app = Flask(__name__)
 CORS(app)
+instrumentation.init_app(app, 'worker-service')
+tracing.init_app(app, 'worker-service')
+profiling.init_app(app, 'worker-service')
+startup.mark('app')
 
 # Service URLs
 STORAGE_SERVICE_URL = os.getenv('STORAGE_SERVICE_URL', 'http://storage-service:5003')
@@ -21,27 +31,130 @@ IMPORT_SERVICE_URL = os.getenv('IMPORT_SERVICE_URL', 'http://import-service:5001
 GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY')
 STORAGE_PROVIDER = os.getenv('STORAGE_PROVIDER', 'aws')
 
+# Files at least this large are uploaded as resumable multipart uploads
+MULTIPART_THRESHOLD = int(os.getenv('MULTIPART_THRESHOLD', 16 * 1024 * 1024))
+# S3 requires parts of at least 5 MiB (except the last one)
+MULTIPART_PART_SIZE = max(int(os.getenv('MULTIPART_PART_SIZE', 8 * 1024 * 1024)), 5 * 1024 * 1024)
+
+# pipeline: staged download/upload/record thread pools (default);
+# async: asyncio event loops, one process per core; threads: one 50-thread pool running whole files
+WORKER_ENGINE = os.getenv('WORKER_ENGINE', 'pipeline').strip().lower()
+
+# Pipeline stage sizes; queues between stages are bounded so a slow stage applies backpressure
+PIPELINE_DOWNLOAD_WORKERS = int(os.getenv('PIPELINE_DOWNLOAD_WORKERS', 32))
+PIPELINE_UPLOAD_WORKERS = int(os.getenv('PIPELINE_UPLOAD_WORKERS', 16))
+PIPELINE_RECORD_WORKERS = int(os.getenv('PIPELINE_RECORD_WORKERS', 8))
+PIPELINE_QUEUE_SIZE = int(os.getenv('PIPELINE_QUEUE_SIZE', 64))
+
 
 executor = concurrent.futures.ThreadPoolExecutor(max_workers=50)
+# Order in which files of concurrent jobs start (pipeline and threads engines)
+scheduler = FairScheduler()
+pipeline = None
+async_engine = None
+engine_lock = threading.Lock()
+# Files and bytes accepted and not finished, reported with every fleet heartbeat
+load = fleet.Load()
+
+@server.after_fork
+def reset_executor():
+    """Pool threads do not survive a fork; each worker process gets its own pool"""
+    global executor
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=50)
+
+@server.before_exit
+def drain_engine():
+    """Finish the files already accepted before this process exits (bounded by the server's graceful timeout)"""
+    if pipeline is not None:
+        pipeline.join()
+    if async_engine is not None:
+        async_engine.stop()
+    executor.shutdown(wait=True)
+
+def get_pipeline():
+    """Start the staged pipeline's threads on first use"""
+    global pipeline
+    with engine_lock:
+        if pipeline is None:
+            from pipeline import Pipeline, Stage
+            pipeline = Pipeline([
+                Stage('download', download_stage, PIPELINE_DOWNLOAD_WORKERS, work_queue=scheduler),
+                Stage('upload', upload_stage, PIPELINE_UPLOAD_WORKERS, PIPELINE_QUEUE_SIZE),
+                Stage('record', record_stage, PIPELINE_RECORD_WORKERS, PIPELINE_QUEUE_SIZE),
+            ], on_error=fail_scheduled_item, on_finished=release_item).start()
+        return pipeline
+
+def get_async_engine():
+    """Start the async engine's processes on first use (never at import: spawned children import this module)"""
+    global async_engine
+    with engine_lock:
+        if async_engine is None:
+            from async_engine import AsyncWorkerEngine
+            async_engine = AsyncWorkerEngine({
+                'STORAGE_SERVICE_URL': STORAGE_SERVICE_URL,
+                'METADATA_SERVICE_URL': METADATA_SERVICE_URL,
+                'IMPORT_SERVICE_URL': IMPORT_SERVICE_URL,
+                'GOOGLE_API_KEY': GOOGLE_API_KEY,
+                'STORAGE_PROVIDER': STORAGE_PROVIDER,
+                'MULTIPART_THRESHOLD': MULTIPART_THRESHOLD,
+                'MULTIPART_PART_SIZE': MULTIPART_PART_SIZE,
+            }, on_finished=load.finish).start()
+        return async_engine
+
+def queue_depths():
+    """Files waiting in the active engine's queues"""
+    if pipeline is not None:
+        return {stage.name: stage.queue.qsize() for stage in pipeline.stages}
+    if async_engine is not None:
+        return {'async': async_engine.stats()['queued']}
+    return {'executor': scheduler.qsize()}
+
+def queued_files():
+    """Files accepted but not started yet"""
+    if async_engine is not None:
+        return async_engine.stats()['queued']
+    return scheduler.qsize()
+
+def fleet_report():
+    """Load sent with every heartbeat; the import-service routes batches by it"""
+    files, in_flight_bytes = load.snapshot()
+    queued = queued_files()
+    return {
+        'engine': WORKER_ENGINE,
+        'queued': queued,
+        'in_flight': max(files - queued, 0),
+        'in_flight_bytes': in_flight_bytes
+    }
 
-def download_from_google_drive(file_id):
-    """Download file from Google Drive"""
+# Started in the serving process only; deregisters after drain_engine has run
+heartbeat = fleet.Heartbeat(IMPORT_SERVICE_URL, fleet_report)
+server.when_serving(heartbeat.start)
+server.before_exit(heartbeat.leave)
+
+def active_files():
+    """Files being worked on, by stage"""
+    if pipeline is not None:
+        return {stage.name: stage.busy for stage in pipeline.stages}
+    if async_engine is not None:
+        stats = async_engine.stats()
+        return {name: stats[name] for name in ('downloading', 'uploading', 'recording')}
+    return {}
+
+instrumentation.register_gauge('worker_queue_depth', 'Files queued per engine queue', queue_depths, label='queue')
+instrumentation.register_gauge('worker_active_files', 'Files in progress per stage', active_files, label='stage')
+instrumentation.register_drive_limiter(drive.get_limiter)
+
+def download_from_google_drive(file_id, size=None):
+    """
+    Download file from Google Drive (rate limited and retried by the shared Drive limiter).
+    Files at least DRIVE_RANGED_THRESHOLD bytes are fetched as parallel byte ranges.
+    """
     try:
-        service = build('drive', 'v3', developerKey=GOOGLE_API_KEY)
-        request_obj = service.files().get_media(fileId=file_id)
-        file_buffer = io.BytesIO()
-        downloader = MediaIoBaseDownload(file_buffer, request_obj)
-        
-        done = False
-        while not done:
-            status, done = downloader.next_chunk()
-        
-        file_buffer.seek(0)
-        return file_buffer
+        return drive.download_media(file_id, GOOGLE_API_KEY, size=size)
     except Exception as e:
         raise Exception(f"Error downloading from Google Drive: {str(e)}")
 
-def upload_to_storage(file_buffer, filename, mime_type):
+def upload_to_storage(file_buffer, filename, mime_type, job_id=None):
     """Upload file to cloud storage via Storage Service"""
     import base64
     
@@ -55,6 +168,7 @@ def upload_to_storage(file_buffer, filename, mime_type):
             'file_data': file_data,
             'filename': filename,
             'mime_type': mime_type,
+            'job_id': job_id,
             'provider': STORAGE_PROVIDER
         },
         timeout=300  
@@ -65,6 +179,72 @@ def upload_to_storage(file_buffer, filename, mime_type):
     else:
         raise Exception(f"Storage upload failed: {response.text}")
 
+def upload_multipart_to_storage(file_buffer, filename, mime_type, job_id, file_id, checkpoint, lease=None):
+    """
+    Upload a large file in parts via the Storage Service. A multipart upload recorded in
+    the checkpoint is continued: parts the storage already holds are not sent again.
+    """
+    provider = checkpoint.get('storage_provider') or STORAGE_PROVIDER
+    upload_id = checkpoint.get('upload_id')
+    key = checkpoint.get('storage_key')
+    data = file_buffer.getbuffer()
+    total_size = data.nbytes
+    
+    stored_parts = set()
+    if upload_id and key:
+        response = requests.get(
+            f"{STORAGE_SERVICE_URL}/multipart/{upload_id}",
+            params={'key': key, 'provider': provider},
+            timeout=30
+        )
+        if response.status_code == 200:
+            for part in response.json().get('parts', []):
+                offset = (part['part_number'] - 1) * MULTIPART_PART_SIZE
+                # Only reuse parts that match the current part layout
+                if part['size'] == min(MULTIPART_PART_SIZE, total_size - offset):
+                    stored_parts.add(part['part_number'])
+        else:
+            upload_id = None
+    
+    if not upload_id or not key:
+        response = requests.post(
+            f"{STORAGE_SERVICE_URL}/multipart",
+            json={'filename': filename, 'mime_type': mime_type, 'job_id': job_id, 'provider': provider},
+            timeout=30
+        )
+        if response.status_code != 201:
+            raise Exception(f"Storage multipart start failed: {response.text}")
+        upload_id = response.json()['upload_id']
+        key = response.json()['key']
+        # Checkpoint the upload so a restarted job continues it instead of starting over
+        update_job_status(
+            job_id, file_id=file_id, state='downloading', lease=lease,
+            upload_id=upload_id, storage_key=key, storage_provider=provider
+        )
+    
+    for part_number, offset in enumerate(range(0, total_size, MULTIPART_PART_SIZE), start=1):
+        if part_number in stored_parts:
+            continue
+        response = requests.put(
+            f"{STORAGE_SERVICE_URL}/multipart/{upload_id}/parts/{part_number}",
+            params={'key': key, 'provider': provider},
+            data=bytes(data[offset:offset + MULTIPART_PART_SIZE]),
+            headers={'Content-Type': 'application/octet-stream'},
+            timeout=300
+        )
+        if response.status_code != 200:
+            raise Exception(f"Storage part upload failed: {response.text}")
+    
+    response = requests.post(
+        f"{STORAGE_SERVICE_URL}/multipart/{upload_id}/complete",
+        json={'key': key, 'provider': provider},
+        timeout=300
+    )
+    if response.status_code == 200:
+        return response.json()
+    else:
+        raise Exception(f"Storage multipart complete failed: {response.text}")
+
 def save_metadata(image_data):
     """Save image metadata via Metadata Service"""
     response = requests.post(
@@ -78,60 +258,235 @@ def save_metadata(image_data):
     else:
         raise Exception(f"Metadata save failed: {response.text}")
 
-def update_job_status(job_id, processed=0, failed=0, imported=None):
-    """Update job status in Import Service"""
+def update_job_status(job_id, processed=0, failed=0, imported=None, file_id=None, state=None, **checkpoint):
+    """
+    Update job status in Import Service, checkpointing the file's state when given.
+    Raises FileReassigned when the Import Service refuses the report (409): the file was
+    sent to another worker since, or is already recorded.
+    """
+    payload = {
+        'job_id': job_id,
+        'processed': processed,
+        'failed': failed,
+        'imported': imported or []
+    }
+    if file_id and state:
+        payload.update(checkpoint, file_id=file_id, state=state)
+    
     try:
-        requests.post(
-            f"{IMPORT_SERVICE_URL}/import/update-status",
-            json={
-                'job_id': job_id,
-                'processed': processed,
-                'failed': failed,
-                'imported': imported or []
-            },
-            timeout=10
-        )
+        with instrumentation.stage('status_update'):
+            response = requests.post(
+                f"{IMPORT_SERVICE_URL}/import/update-status",
+                json=payload,
+                timeout=10
+            )
     except Exception as e:
         print(f"Error updating job status: {str(e)}")
+        return
+    if response.status_code == 409:
+        raise fleet.FileReassigned(response.json().get('error'))
 
-def process_single_image(file_data, job_id):
-    """Process a single image: download, upload to storage, save metadata"""
-    try:
-        # Download from Google Drive
-        file_buffer = download_from_google_drive(file_data['id'])
-        
-        # Upload to cloud storage
-        storage_result = upload_to_storage(
-            file_buffer,
-            file_data['name'],
-            file_data['mimeType']
+def new_item(file_data, job_id, priority=1, max_concurrency=None):
+    """Work item passed between the pipeline stages"""
+    return {
+        'job_id': job_id,
+        'priority': priority,
+        'max_concurrency': max_concurrency,
+        'file_data': file_data,
+        'checkpoint': file_data.get('checkpoint') or {},
+        # The fleet id the file was accepted under; it is dropped if this worker expires
+        'worker_id': heartbeat.worker_id,
+        # One span per file from dispatch to recorded/failed; stages run as its children
+        'span': tracing.start_span(
+            'import_file', baggage={'job_id': job_id, 'file_id': file_data['id']},
+            file_name=file_data['name'], size=int(file_data.get('size', 0))
         )
-        
-        # Save metadata
-        metadata = {
-            'name': file_data['name'],
-            'google_drive_id': file_data['id'],
-            'size': int(file_data.get('size', 0)),
-            'mime_type': file_data['mimeType'],
-            'storage_path': storage_result['url'],
-            'storage_provider': storage_result['provider']
+    }
+
+def traced_stage(handler):
+    """
+    Run a stage inside its file's span, whichever thread picks the item up. Files accepted
+    before this worker expired are dropped here: the import-service sends them elsewhere.
+    """
+    @functools.wraps(handler)
+    def run(item):
+        if item['worker_id'] != heartbeat.worker_id:
+            raise fleet.FileReassigned(f"accepted as worker {item['worker_id']}, which expired")
+        with tracing.use_span(item['span']):
+            return handler(item)
+    return run
+
+@traced_stage
+def download_stage(item):
+    """
+    Stage 1: download from Google Drive. Files whose checkpoint says they are already
+    uploaded (re-dispatched by /import/resume) skip straight to the record stage.
+    """
+    file_data = item['file_data']
+    checkpoint = item['checkpoint']
+    if checkpoint.get('state') == 'uploaded' and checkpoint.get('storage_url'):
+        item['storage_result'] = {
+            'url': checkpoint['storage_url'],
+            'key': checkpoint.get('storage_key'),
+            'provider': checkpoint.get('storage_provider') or STORAGE_PROVIDER
         }
-        
+        return item
+    
+    update_job_status(item['job_id'], file_id=file_data['id'], state='downloading', lease=file_data.get('lease'))
+    with instrumentation.stage('drive_download'), tracing.span('drive_download'):
+        item['file_buffer'] = download_from_google_drive(file_data['id'], file_data.get('size'))
+    instrumentation.record_bytes('drive_download', item['file_buffer'].getbuffer().nbytes)
+    return item
+
+@traced_stage
+def upload_stage(item):
+    """Stage 2: upload to cloud storage (multipart for large files) and checkpoint the result"""
+    if 'storage_result' in item:
+        return item
+    
+    file_data = item['file_data']
+    file_buffer = item.pop('file_buffer')
+    size = file_buffer.getbuffer().nbytes
+    with instrumentation.stage('storage_upload'), tracing.span('storage_upload', multipart=size >= MULTIPART_THRESHOLD):
+        if size >= MULTIPART_THRESHOLD:
+            storage_result = upload_multipart_to_storage(
+                file_buffer,
+                file_data['name'],
+                file_data['mimeType'],
+                item['job_id'],
+                file_data['id'],
+                item['checkpoint'],
+                file_data.get('lease')
+            )
+        else:
+            storage_result = upload_to_storage(
+                file_buffer,
+                file_data['name'],
+                file_data['mimeType'],
+                item['job_id']
+            )
+    instrumentation.record_bytes('storage_upload', size)
+    
+    update_job_status(
+        item['job_id'], file_id=file_data['id'], state='uploaded', lease=file_data.get('lease'),
+        storage_url=storage_result['url'],
+        storage_key=storage_result.get('key'),
+        storage_provider=storage_result['provider']
+    )
+    item['storage_result'] = storage_result
+    return item
+
+@traced_stage
+def record_stage(item):
+    """Stage 3: save metadata and mark the file recorded"""
+    file_data = item['file_data']
+    storage_result = item['storage_result']
+    metadata = {
+        'name': file_data['name'],
+        'google_drive_id': file_data['id'],
+        'size': int(file_data.get('size', 0)),
+        'mime_type': file_data['mimeType'],
+        'storage_path': storage_result['url'],
+        'storage_key': storage_result.get('key'),
+        'storage_provider': storage_result['provider']
+    }
+    
+    with instrumentation.stage('metadata_save'), tracing.span('metadata_save'):
         saved_metadata = save_metadata(metadata)
-        
-        update_job_status(job_id, processed=1, imported=[saved_metadata])
-        
-        return {'success': True, 'image': saved_metadata}
+    
+    update_job_status(
+        item['job_id'], processed=1, imported=[saved_metadata],
+        file_id=file_data['id'], state='recorded', lease=file_data.get('lease')
+    )
+    item['image'] = saved_metadata
+    item['span'].end()
+    return item
+
+def fail_item(stage, item, error):
+    """Report a file that failed in any stage; a reassigned file is dropped without a report"""
+    file_data = item['file_data']
+    if isinstance(error, fleet.FileReassigned):
+        print(f"Dropped {file_data['name']}: {str(error)}")
+        item['span'].end()
+        return
+    print(f"Failed to process {file_data['name']}: {str(error)}")
+    item['span'].record_error(error)
+    with tracing.use_span(item['span'], end=True):
+        try:
+            update_job_status(
+                item['job_id'], failed=1, file_id=file_data['id'], state='failed',
+                lease=file_data.get('lease'), error=str(error)
+            )
+        except fleet.FileReassigned:
+            pass
+
+def release_item(item):
+    """A scheduled file left the engine (recorded or failed): its job may start another"""
+    scheduler.release(item['job_id'])
+    load.finish(fleet.file_size(item['file_data']))
+
+def fail_scheduled_item(stage, item, error):
+    fail_item(stage, item, error)
+    release_item(item)
+
+def process_next():
+    """
+    Threads engine: process the file the scheduler picks next. That is not necessarily the
+    file submitted with this call, so each file carries its own request context.
+    """
+    item = scheduler.get()
+    try:
+        item['context'].run(process_single_image, item['file_data'], item['job_id'])
+    finally:
+        release_item(item)
+        scheduler.task_done()
+
+def process_single_image(file_data, job_id):
+    """
+    Process a single image: download, upload to storage, save metadata.
+    Each step is checkpointed in the Import Service manifest; a file re-dispatched by
+    /import/resume carries its last checkpoint and skips the steps already done.
+    """
+    item = new_item(file_data, job_id)
+    try:
+        for stage in (download_stage, upload_stage, record_stage):
+            item = stage(item)
+        return {'success': True, 'image': item['image']}
         
     except Exception as e:
-        print(f"Failed to process {file_data['name']}: {str(e)}")
-        update_job_status(job_id, failed=1)
+        fail_item(None, item, e)
         return {'success': False, 'error': str(e), 'file': file_data['name']}
 
 @app.route('/health', methods=['GET'])
 def health_check():
     return jsonify({'status': 'healthy', 'service': 'worker-service'}), 200
 
+@app.route('/drive/stats', methods=['GET'])
+def drive_stats():
+    """Current Drive rate limit, concurrency limit and retry counters"""
+    return jsonify(drive.get_limiter().stats()), 200
+
+@app.route('/engine/stats', methods=['GET'])
+def engine_stats():
+    """Queue and in-flight counts of the active worker engine"""
+    if WORKER_ENGINE == 'pipeline':
+        return jsonify(dict(get_pipeline().stats(), jobs=scheduler.stats())), 200
+    if WORKER_ENGINE == 'async':
+        return jsonify(get_async_engine().stats()), 200
+    return jsonify({
+        'engine': 'threads',
+        'threads': executor._max_workers,
+        'queued': scheduler.qsize(),
+        'jobs': scheduler.stats()
+    }), 200
+
+@app.route('/pipeline/stats', methods=['GET'])
+def pipeline_stats():
+    """Per-stage queue depth, busy workers and timings, to see where files pile up"""
+    if WORKER_ENGINE != 'pipeline':
+        return jsonify({'error': f'Worker engine is {WORKER_ENGINE}, not pipeline'}), 404
+    return jsonify(get_pipeline().stats()), 200
+
 @app.route('/process-batch', methods=['POST'])
 def process_batch():
     """
@@ -142,15 +497,28 @@ def process_batch():
         data = request.get_json()
         job_id = data.get('job_id')
         files = data.get('files', [])
+        # Set per job at import time; files of concurrent jobs are interleaved by priority
+        priority = max(int(data.get('priority') or 1), 1)
+        max_concurrency = int(data.get('max_concurrency') or 0) or None
         
         if not files:
             return jsonify({'error': 'No files to process'}), 400
         
-        
-        futures = []
-        for file_data in files:
-            future = executor.submit(process_single_image, file_data, job_id)
-            futures.append(future)
+        load.add(files)
+        if WORKER_ENGINE == 'pipeline':
+            active_pipeline = get_pipeline()
+            for file_data in files:
+                active_pipeline.submit(new_item(file_data, job_id, priority, max_concurrency))
+        elif WORKER_ENGINE == 'async':
+            get_async_engine().submit(job_id, files, tracing.inject({}), priority, max_concurrency)
+        else:
+            for file_data in files:
+                # The context carries the request's trace into whichever pool thread runs the file
+                scheduler.put({
+                    'job_id': job_id, 'priority': priority, 'max_concurrency': max_concurrency,
+                    'file_data': file_data, 'context': contextvars.copy_context()
+                })
+                executor.submit(process_next)
         
         
         return jsonify({
@@ -162,6 +530,37 @@ def process_batch():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/release-files', methods=['POST'])
+def release_files():
+    """
+    Give back up to max_files queued files that have not started, grouped by job, so the
+    import-service can send them to a less loaded worker. The threads engine keeps its
+    files: each one already holds a pool task.
+    """
+    try:
+        max_files = int((request.get_json(silent=True) or {}).get('max_files') or 0)
+        if WORKER_ENGINE == 'pipeline':
+            items = scheduler.take(max_files)
+        elif WORKER_ENGINE == 'async' and async_engine is not None:
+            items = async_engine.take(max_files)
+        else:
+            items = []
+        
+        released = {}
+        for item in items:
+            load.finish(fleet.file_size(item['file_data']))
+            if 'span' in item:
+                item['span'].end()
+            released.setdefault(item['job_id'], []).append(item['file_data'])
+        
+        return jsonify({
+            'released': [{'job_id': job_id, 'files': files} for job_id, files in released.items()],
+            'count': len(items)
+        }), 200
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/process-single', methods=['POST'])
 def process_single():
     """Process a single image (for retry or individual processing)"""
@@ -180,6 +579,9 @@ def process_single():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+startup.ready('worker-service')
+
 if __name__ == '__main__':
     port = int(os.getenv('PORT', 5004))
+    server.run_when_serving()
     app.run(host='0.0.0.0', port=port, debug=False, threaded=True)
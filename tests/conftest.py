@@ -0,0 +1,30 @@
+﻿"""Tests import the services' shared modules and the benchmarks' fakes the way the services do (PYTHONPATH=services)"""
+import importlib
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'services'))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+# The monolith's package (app) for its Drive client
+sys.path.insert(0, os.path.join(ROOT, 'backend'))
+
+METADATA_APP_DIR = os.path.join(ROOT, 'services', 'metadata-service', 'app')
+
+@pytest.fixture(scope='session')
+def metadata_service(tmp_path_factory):
+    """The metadata-service on primary.db, with replica.db as its only read replica (imported once: it registers metrics)"""
+    directory = tmp_path_factory.mktemp('metadata')
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setenv('DATABASE_URL', f"sqlite:///{directory / 'primary.db'}")
+        patch.setenv('DATABASE_REPLICA_URLS', f"sqlite:///{directory / 'replica.db'}")
+        patch.setenv('REPLICA_READ_AFTER_WRITE_SECONDS', '5')
+        patch.setenv('DB_AUTO_MIGRATE', 'true')
+        patch.syspath_prepend(METADATA_APP_DIR)
+        module = importlib.import_module('metadata_service')
+    yield module, directory
+    with module.app.app_context():
+        for engine in module.db.engines.values():
+            engine.dispose()
@@ -0,0 +1,67 @@
+﻿"""The monolith's /api/objects: local and memory files are served only from signed URLs"""
+import io
+
+import pytest
+
+@pytest.fixture(scope='module')
+def monolith(tmp_path_factory):
+    """The monolith on a temporary SQLite file (its Config is read once per process)"""
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setenv('DATABASE_URL', f"sqlite:///{tmp_path_factory.mktemp('backend') / 'images.db'}")
+        from app import create_app
+        app = create_app()
+    yield app
+    from app import db
+    with app.app_context():
+        db.engine.dispose()
+
+@pytest.fixture
+def backend(monolith):
+    """The monolith storing files in memory, with no images"""
+    from app import db
+    from app.models.image import Image
+
+    monolith.config.update(STORAGE_PROVIDER='memory', STORAGE_SIGNING_KEY='test-key', STORAGE_REQUIRE_SIGNED_URLS=True)
+    with monolith.app_context():
+        db.session.query(Image).delete()
+        db.session.commit()
+    return monolith
+
+def store(app, content=b'image bytes'):
+    """A stored memory file and its image row; returns the image id"""
+    from app import db
+    from app.models.image import Image
+    from app.services.memory_storage_service import MemoryStorageService
+
+    with app.app_context():
+        stored = MemoryStorageService().upload_file(io.BytesIO(content), 'photo.jpg', 'image/jpeg')
+        image = Image(
+            name='photo.jpg', google_drive_id=stored['key'], size=len(content), mime_type='image/jpeg',
+            storage_path=stored['url'], storage_key=stored['key'], storage_provider='memory'
+        )
+        db.session.add(image)
+        db.session.commit()
+        return image.id, stored['url']
+
+def test_unsigned_reads_are_refused(backend):
+    _, url = store(backend)
+
+    assert backend.test_client().get(url).status_code == 403
+    assert backend.test_client().get(f'{url}?expires=9999999999&signature=forged').status_code == 403
+
+def test_image_responses_carry_a_signed_url(backend):
+    image_id, url = store(backend)
+    client = backend.test_client()
+
+    signed = client.get(f'/api/images/{image_id}').json['storage_path']
+
+    assert signed.startswith(f'{url}?expires=')
+    response = client.get(signed)
+    assert response.status_code == 200
+    assert response.data == b'image bytes'
+
+def test_unsigned_reads_can_be_allowed(backend):
+    _, url = store(backend)
+    backend.config['STORAGE_REQUIRE_SIGNED_URLS'] = False
+
+    assert backend.test_client().get(url).status_code == 200
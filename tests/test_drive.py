@@ -0,0 +1,207 @@
+﻿"""DriveRateLimiter and ranged downloads against the fake Drive server (benchmarks/fake_drive.py)"""
+import asyncio
+import logging
+import time
+
+import pytest
+from googleapiclient.errors import HttpError
+
+import fake_drive
+from common import drive
+
+FILE_ID = 'fake-000000'
+
+@pytest.fixture(autouse=True)
+def quiet_server_logs():
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+@pytest.fixture
+def fake(monkeypatch):
+    """Start a fake Drive with create_app options and point the Drive client at it; returns its stats"""
+    servers = []
+
+    def start(**options):
+        app = fake_drive.create_app(**options)
+        server, base_url = fake_drive.serve_in_thread(app)
+        servers.append(server)
+        monkeypatch.setattr(drive, 'GOOGLE_DRIVE_API_ENDPOINT', f'{base_url}/drive/v3/')
+        return app.config['FAKE_DRIVE_STATS']
+
+    yield start
+    for server in servers:
+        server.shutdown()
+
+@pytest.fixture
+def limiter(monkeypatch):
+    """Install a process limiter with short backoffs"""
+    def install(**options):
+        limiter = drive.DriveRateLimiter(**{'backoff_base': 0.01, 'backoff_max': 0.05, **options})
+        monkeypatch.setattr(drive, '_limiter', limiter)
+        return limiter
+    return install
+
+def list_files():
+    return drive.execute(drive.build_drive_service('test').files().list(q="'folder' in parents", pageSize=10))
+
+def test_throttle_halves_rate_and_concurrency(fake, limiter):
+    fake(files=1, throttle_rate=1.0)
+    limiter = limiter(rate=20, concurrency=8, max_retries=0)
+
+    with pytest.raises(HttpError):
+        list_files()
+
+    assert limiter.rate == 10
+    assert int(limiter.limit) == 4
+    assert limiter.stats()['throttled'] == 1
+
+def test_throttles_within_a_second_count_as_one_decrease(fake, limiter):
+    fake(files=1, throttle_rate=1.0)
+    limiter = limiter(rate=20, concurrency=8, max_retries=2)
+
+    with pytest.raises(HttpError):
+        list_files()
+
+    assert limiter.stats()['throttled'] == 3
+    assert limiter.rate == 10
+
+def test_success_increases_rate_again(fake, limiter):
+    fake(files=1)
+    limiter = limiter(rate=4, concurrency=2)
+
+    list_files()
+
+    assert limiter.rate > 4
+    assert limiter.limit > 2
+
+def test_throttled_call_is_retried_until_it_succeeds(fake, limiter):
+    stats = fake(files=3, throttle_first=2)
+    limiter = limiter(max_retries=3)
+
+    assert len(list_files()['files']) == 3
+    assert stats['throttled'] == 2
+    assert limiter.stats()['retries'] == 2
+    assert limiter.stats()['failures'] == 0
+
+def test_retry_after_is_honoured(fake, limiter):
+    fake(files=1, throttle_first=1, retry_after=1)
+    limiter(max_retries=1, backoff_base=0.001, backoff_max=2)
+
+    started = time.monotonic()
+    list_files()
+
+    assert time.monotonic() - started >= 1
+
+def test_retries_are_exhausted(fake, limiter):
+    stats = fake(files=1, throttle_rate=1.0)
+    limiter = limiter(max_retries=2)
+
+    with pytest.raises(HttpError) as error:
+        list_files()
+
+    assert error.value.resp.status == 403
+    assert stats['requests'] == 3
+    assert limiter.stats()['retries'] == 2
+    assert limiter.stats()['failures'] == 1
+
+def test_server_errors_are_retried_without_slowing_down(fake, limiter):
+    stats = fake(files=1, error_rate=1.0)
+    limiter = limiter(rate=20, max_retries=1)
+
+    with pytest.raises(HttpError):
+        list_files()
+
+    assert stats['errors'] == 2
+    assert limiter.rate == 20
+    assert limiter.stats()['throttled'] == 0
+
+def test_final_errors_are_not_retried(fake, limiter):
+    stats = fake(files=1)
+    limiter = limiter(max_retries=3)
+
+    with pytest.raises(HttpError):
+        drive.execute(drive.build_drive_service('test').files().get(fileId='missing'))
+
+    assert stats['requests'] == 1
+    assert limiter.stats()['retries'] == 0
+
+def test_ranged_download_reassembles_the_file(fake, limiter):
+    size = 1000 * 1000 + 7
+    stats = fake(files=1, file_size=size)
+    limiter()
+
+    data = drive.download_ranged(FILE_ID, size, 'test', range_size=256 * 1024, parallelism=4)
+
+    assert data.getvalue() == fake_drive.file_content(FILE_ID, size)
+    assert stats['media'] == 4
+
+def test_ranged_download_retries_a_throttled_range(fake, limiter):
+    size = 600 * 1000
+    stats = fake(files=1, file_size=size, throttle_first=3)
+    limiter = limiter()
+
+    data = drive.download_ranged(FILE_ID, size, 'test', range_size=256 * 1024, parallelism=3)
+
+    assert data.getvalue() == fake_drive.file_content(FILE_ID, size)
+    assert stats['throttled'] == 3
+    assert limiter.stats()['failures'] == 0
+
+def test_ranged_download_retries_a_dropped_connection(fake, limiter):
+    size = 600 * 1000
+    stats = fake(files=1, file_size=size, drop_first=1)
+    limiter = limiter()
+
+    data = drive.download_ranged(FILE_ID, size, 'test', range_size=256 * 1024, parallelism=3)
+
+    assert data.getvalue() == fake_drive.file_content(FILE_ID, size)
+    assert stats['dropped'] == 1
+    assert limiter.stats()['retries'] == 1
+
+def test_ranged_download_fails_once_retries_are_exhausted(fake, limiter):
+    size = 600 * 1000
+    fake(files=1, file_size=size, drop_first=100)
+    limiter(max_retries=1)
+
+    with pytest.raises(ConnectionError):
+        drive.download_ranged(FILE_ID, size, 'test', range_size=256 * 1024, parallelism=3)
+
+def test_async_ranged_download_retries_a_dropped_connection(fake, monkeypatch):
+    import aiohttp
+
+    size = 600 * 1000
+    stats = fake(files=1, file_size=size, drop_first=1)
+    monkeypatch.setattr(drive, 'DRIVE_RANGED_THRESHOLD', 1)
+    monkeypatch.setattr(drive, 'DRIVE_RANGE_SIZE', 256 * 1024)
+
+    async def download():
+        limiter = drive.AsyncDriveRateLimiter(backoff_base=0.01, backoff_max=0.05)
+        async with aiohttp.ClientSession() as session:
+            data = await drive.download_media_async(session, limiter, FILE_ID, 'test', size=size)
+        return data, limiter
+
+    data, limiter = asyncio.run(download())
+
+    assert data.getvalue() == fake_drive.file_content(FILE_ID, size)
+    assert stats['dropped'] == 1
+    assert limiter.stats()['retries'] == 1
+
+def test_monolith_ranged_download_retries_a_dropped_connection(fake, monkeypatch):
+    from flask import Flask
+    from app.services import drive_rate_limiter
+    from app.services.google_drive_service import GoogleDriveService
+
+    size = 600 * 1000
+    stats = fake(files=1, file_size=size, drop_first=1)
+    limiter = drive_rate_limiter.DriveRateLimiter(backoff_base=0.01, backoff_max=0.05)
+    monkeypatch.setattr(drive_rate_limiter, '_limiter', limiter)
+    app = Flask(__name__)
+    app.config.update(
+        GOOGLE_API_KEY='test', GOOGLE_DRIVE_API_ENDPOINT=drive.GOOGLE_DRIVE_API_ENDPOINT,
+        DRIVE_RANGED_THRESHOLD=1, DRIVE_RANGE_SIZE=256 * 1024, DRIVE_RANGE_PARALLELISM=3
+    )
+
+    with app.app_context():
+        data = GoogleDriveService().download_file_ranged(FILE_ID, size)
+
+    assert data.getvalue() == fake_drive.file_content(FILE_ID, size)
+    assert stats['dropped'] == 1
+    assert limiter.stats()['retries'] == 1
@@ -0,0 +1,103 @@
+﻿"""Fencing of workers the import-service has taken files from: per-file leases, expired worker ids and undeliverable batches"""
+import importlib
+import os
+import time
+
+import pytest
+
+APP_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'services', 'import-service', 'app')
+
+FILES = [{'id': f'file-{i}', 'name': f'{i}.jpg', 'mimeType': 'image/jpeg', 'size': '100'} for i in range(2)]
+
+@pytest.fixture(scope='module')
+def import_service(tmp_path_factory):
+    """The import-service on a temporary manifest (imported once: it registers metrics)"""
+    directory = tmp_path_factory.mktemp('import')
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setenv('JOB_MANIFEST_PATH', str(directory / 'manifest.db'))
+        patch.syspath_prepend(APP_DIR)
+        yield importlib.import_module('import_service')
+
+@pytest.fixture
+def job(import_service):
+    """A job of two files, both sent to worker-a under lease-1"""
+    job_id = f'job-{time.monotonic_ns()}'
+    import_service.manifest.create_job(job_id, 'folder', FILES)
+    import_service.manifest.assign_files(job_id, [f['id'] for f in FILES], 'worker-a', 'lease-1')
+    with import_service.job_statuses_lock:
+        import_service.job_statuses[job_id] = {
+            'job_id': job_id, 'status': 'processing', 'total': len(FILES), 'processed': 0, 'failed': 0, 'imported': []
+        }
+    return job_id
+
+def report(import_service, job_id, state, lease, file_id='file-0', **extra):
+    return import_service.app.test_client().post('/import/update-status', json=dict(
+        extra, job_id=job_id, file_id=file_id, state=state, lease=lease
+    ))
+
+def test_reports_under_the_current_lease_are_recorded(import_service, job):
+    assert report(import_service, job, 'downloading', 'lease-1').status_code == 200
+    assert import_service.manifest.state_counts(job) == {'downloading': 1, 'pending': 1}
+
+def test_reports_under_an_older_lease_are_refused(import_service, job):
+    import_service.manifest.assign_files(job, ['file-0'], 'worker-b', 'lease-2')
+
+    response = report(import_service, job, 'uploaded', 'lease-1', storage_url='https://stale')
+
+    assert response.status_code == 409
+    assert import_service.manifest.state_counts(job) == {'pending': 2}
+    assert report(import_service, job, 'uploaded', 'lease-2', storage_url='https://new').status_code == 200
+
+def test_reports_without_a_lease_are_not_checked(import_service, job):
+    import_service.manifest.assign_files(job, ['file-0'], 'worker-b', 'lease-2')
+    assert report(import_service, job, 'downloading', None).status_code == 200
+
+def test_a_recorded_file_refuses_further_work(import_service, job):
+    image = {'id': 1, 'google_drive_id': 'file-0'}
+    assert report(import_service, job, 'recorded', 'lease-1', processed=1, imported=[image]).status_code == 200
+    import_service.manifest.assign_files(job, ['file-0'], 'worker-b', 'lease-2')
+
+    assert report(import_service, job, 'downloading', 'lease-2').status_code == 409
+    with import_service.job_statuses_lock:
+        assert import_service.job_statuses[job]['processed'] == 1
+
+def test_an_expired_worker_must_register_again(import_service):
+    from workers import WorkerExpired, WorkerRegistry
+
+    registry = WorkerRegistry(timeout=0.05)
+    assert registry.heartbeat({'worker_id': 'worker-a', 'url': 'http://a:5004'})
+    time.sleep(0.1)
+    assert registry.live() == []
+
+    with pytest.raises(WorkerExpired):
+        registry.heartbeat({'worker_id': 'worker-a', 'url': 'http://a:5004'})
+    assert registry.heartbeat({'worker_id': 'worker-a2', 'url': 'http://a:5004'})
+    assert [worker.worker_id for worker in registry.live()] == ['worker-a2']
+
+def test_the_heartbeat_reply_tells_an_expired_worker(import_service):
+    client = import_service.app.test_client()
+    import_service.workers.expired.add('worker-gone')
+
+    response = client.post('/workers/heartbeat', json={'worker_id': 'worker-gone', 'url': 'http://gone:5004'})
+
+    assert response.status_code == 409
+    assert response.get_json()['expired'] is True
+
+def test_a_batch_no_worker_accepts_fails_its_files(import_service, job, monkeypatch):
+    from workers import WorkerRegistry
+
+    registry = WorkerRegistry()
+    for name, port in (('worker-a', 9), ('worker-b', 1)):
+        # Nothing listens there: every POST is refused
+        registry.heartbeat({'worker_id': name, 'url': f'http://127.0.0.1:{port}'})
+    monkeypatch.setattr(import_service, 'workers', registry)
+
+    import_service.dispatch_files(job, FILES)
+
+    assert import_service.manifest.state_counts(job) == {'failed': 2}
+    rows = import_service.manifest._connect().execute('SELECT worker_id, lease FROM job_files WHERE job_id = ?', (job,))
+    assert [tuple(row) for row in rows] == [(None, None), (None, None)]
+    with import_service.job_statuses_lock:
+        assert import_service.job_statuses[job]['status'] == 'completed'
+        assert import_service.job_statuses[job]['failed'] == 2
+    assert len(import_service.manifest.resumable_files(job, include_failed=True)) == 2
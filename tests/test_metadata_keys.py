@@ -0,0 +1,147 @@
+﻿"""One image per google_drive_id (the image_keys table, across partitions, races and the cold store) and the archive job"""
+import sqlite3
+from datetime import datetime
+
+import pytest
+from sqlalchemy import MetaData, create_engine, exc
+from sqlalchemy.orm import Session
+
+@pytest.fixture
+def service(metadata_service):
+    """An empty primary: no images, keys or archived segments"""
+    module, directory = metadata_service
+    with module.app.app_context():
+        with module.db.engine.begin() as connection:
+            for table in (module.Image.__table__, module.ImageKey.__table__, module.ArchiveSegment.__table__):
+                connection.execute(table.delete())
+    module.cold_store.cache.clear()
+    return module, directory / 'primary.db'
+
+def image(drive_id='drive-1'):
+    return {
+        'name': 'photo.jpg', 'google_drive_id': drive_id, 'size': 10, 'mime_type': 'image/jpeg',
+        'storage_path': 'http://storage/photo.jpg', 'storage_key': 'photo.jpg', 'storage_provider': 'memory'
+    }
+
+def test_a_second_import_returns_the_first_image(service):
+    module, primary = service
+    client = module.app.test_client()
+    first = client.post('/images', json=image())
+
+    second = client.post('/images', json=image())
+
+    assert second.status_code == 409
+    assert second.json['image']['id'] == first.json['id']
+    assert sqlite3.connect(primary).execute('SELECT COUNT(*) FROM images').fetchone() == (1,)
+
+def test_an_archived_image_is_not_imported_again(service):
+    module, primary = service
+    client = module.app.test_client()
+    image_id = client.post('/images', json=image()).json['id']
+    with module.app.app_context():
+        assert module.archive_images(0) == {'images': 1}
+
+    response = client.post('/images', json=image())
+
+    assert response.status_code == 409
+    assert response.json['image']['id'] == image_id
+    assert response.json['image']['archived'] is True
+    assert sqlite3.connect(primary).execute('SELECT COUNT(*) FROM images').fetchone() == (0,)
+
+def test_deleting_an_image_frees_its_key(service):
+    module, _ = service
+    client = module.app.test_client()
+    image_id = client.post('/images', json=image()).json['id']
+    with module.app.app_context():
+        module.delete_rows([image_id])
+        module.db.session.commit()
+
+    response = client.post('/images', json=image())
+
+    assert response.status_code == 201
+    assert response.json['id'] > image_id
+
+def test_fill_keys_covers_hot_and_archived_images(service):
+    module, primary = service
+    client = module.app.test_client()
+    archived_id = client.post('/images', json=image('archived')).json['id']
+    with module.app.app_context():
+        module.archive_images(0)
+    hot_id = client.post('/images', json=image('hot')).json['id']
+    sqlite3.connect(primary, isolation_level=None).execute('DELETE FROM image_keys')
+
+    with module.app.app_context():
+        module.fill_keys()
+
+    keys = dict(sqlite3.connect(primary).execute('SELECT google_drive_id, id FROM image_keys'))
+    assert keys == {'archived': archived_id, 'hot': hot_id}
+    assert client.post('/images', json=image('archived')).status_code == 409
+
+def test_month_tables_share_one_unique_key(metadata_service, tmp_path):
+    module, _ = metadata_service
+    from partitioning import SQLiteShards
+
+    metadata = MetaData()
+    images = module.Image.__table__.to_metadata(metadata)
+    keys = module.ImageKey.__table__.to_metadata(metadata)
+    engine = create_engine(f"sqlite:///{tmp_path / 'shards.db'}")
+    metadata.create_all(engine)
+    with engine.begin() as connection:
+        # Ids up to 50 were handed out by the sequence used before image_keys
+        connection.exec_driver_sql('CREATE TABLE image_id_sequence (id INTEGER PRIMARY KEY AUTOINCREMENT)')
+        connection.exec_driver_sql('INSERT INTO image_id_sequence (id) VALUES (50)')
+    layout = SQLiteShards(images, keys)
+    layout.migrate(engine)
+
+    def insert(created_at):
+        with Session(engine) as session:
+            row = dict(image(), created_at=created_at, id=layout.next_id(session, 'drive-1'))
+            session.execute(layout.table_for(session, created_at).insert().values(**row))
+            session.commit()
+            return row['id']
+
+    assert insert(datetime(2026, 1, 15)) == 51
+    with pytest.raises(exc.IntegrityError):
+        insert(datetime(2026, 2, 15))
+    with engine.connect() as connection:
+        assert not layout.has_table(connection, 'image_id_sequence')
+        assert sum(len(connection.execute(table.select()).all()) for table in layout.tables(connection)) == 1
+
+def test_an_interrupted_archive_run_stores_each_image_once(service):
+    module, primary = service
+    client = module.app.test_client()
+    ids = [client.post('/images', json=image(f'drive-{i}')).json['id'] for i in range(3)]
+    with module.app.app_context():
+        # A run that died after committing a segment of two rows, before deleting them
+        rows = [module.image_dict(row) for row in module.find_images(lambda table: [table.c.id.in_(ids[:2])])]
+        with module.db.engine.begin() as connection:
+            module.cold_store.write(connection, rows, datetime.utcnow())
+
+        assert module.archive_images(0) == {'images': 3}
+        with module.db.engine.connect() as connection:
+            assert module.cold_store.count(connection) == 3
+            assert sorted(row['id'] for rows in module.cold_store.segments(connection) for row in rows) == ids
+    assert sqlite3.connect(primary).execute('SELECT COUNT(*) FROM images').fetchone() == (0,)
+
+def test_archived_images_can_be_deleted(service, monkeypatch):
+    module, _ = service
+    client = module.app.test_client()
+    stored = []
+    monkeypatch.setattr(module, 'delete_stored_files', lambda rows: stored.extend(rows) or {})
+    ids = [client.post('/images', json=image(f'drive-{i}')).json['id'] for i in range(3)]
+    with module.app.app_context():
+        module.archive_images(0)
+    hot_id = client.post('/images', json=image('hot')).json['id']
+
+    assert client.delete(f'/images/{ids[0]}').status_code == 200
+    response = client.post('/images/bulk-delete', json={'ids': [ids[1], hot_id]})
+
+    assert response.status_code == 200 and response.json['deleted'] == 2
+    assert sorted(row[0] for row in stored) == [ids[0], ids[1], hot_id]
+    with module.app.app_context():
+        assert list(module.find_archived(ids)) == [ids[2]]
+        with module.db.engine.connect() as connection:
+            assert module.cold_store.count(connection) == 1
+    assert client.delete(f'/images/{ids[0]}').status_code == 404
+    assert client.post('/images', json=image('drive-0')).status_code == 201
+    assert client.post('/images', json=image('drive-2')).status_code == 409
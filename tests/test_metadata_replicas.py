@@ -0,0 +1,68 @@
+﻿"""Read-your-writes routing of the metadata-service against a primary and a replica SQLite file"""
+import shutil
+import sqlite3
+import time
+
+import pytest
+
+@pytest.fixture
+def service(metadata_service):
+    """An empty primary, and a replica that is a copy of it; nothing replicates afterwards"""
+    module, directory = metadata_service
+    with module.app.app_context():
+        with module.db.engine.begin() as connection:
+            connection.execute(module.Image.__table__.delete())
+            connection.execute(module.ImageKey.__table__.delete())
+        for engine in module.db.engines.values():
+            engine.dispose()
+    shutil.copy(directory / 'primary.db', directory / 'replica.db')
+    return module, directory / 'primary.db'
+
+def create(client, drive_id='drive-1'):
+    response = client.post('/images', json={
+        'name': 'photo.jpg', 'google_drive_id': drive_id, 'size': 10, 'mime_type': 'image/jpeg',
+        'storage_path': 'http://storage/photo.jpg', 'storage_key': 'photo.jpg', 'storage_provider': 'memory'
+    })
+    assert response.status_code == 201
+    return response.json['id'], response.headers['X-Last-Write']
+
+def test_write_goes_to_the_primary_only(service):
+    module, primary = service
+    image_id, _ = create(module.app.test_client())
+
+    rows = sqlite3.connect(primary).execute('SELECT id FROM images').fetchall()
+    assert rows == [(image_id,)]
+
+def test_replica_read_is_stale(service):
+    module, _ = service
+    client = module.app.test_client()
+    image_id, _ = create(client)
+
+    assert client.get(f'/images/{image_id}').status_code == 404
+    assert client.get('/images').json['total'] == 0
+
+def test_read_with_a_recent_write_token_sees_the_write(service):
+    module, _ = service
+    client = module.app.test_client()
+    image_id, token = create(client)
+    headers = {'X-Last-Write': token}
+
+    response = client.get(f'/images/{image_id}', headers=headers)
+    assert response.status_code == 200
+    assert response.json['google_drive_id'] == 'drive-1'
+    assert client.get('/images', headers=headers).json['total'] == 1
+
+def test_expired_write_token_reads_the_replica(service):
+    module, _ = service
+    client = module.app.test_client()
+    image_id, _ = create(client)
+    expired = f'{time.time() - module.REPLICA_READ_AFTER_WRITE_SECONDS - 1:.3f}'
+
+    assert client.get(f'/images/{image_id}', headers={'X-Last-Write': expired}).status_code == 404
+
+def test_malformed_write_token_reads_the_primary(service):
+    module, _ = service
+    client = module.app.test_client()
+    image_id, _ = create(client)
+
+    assert client.get(f'/images/{image_id}', headers={'X-Last-Write': 'garbage'}).status_code == 200
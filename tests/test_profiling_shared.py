@@ -0,0 +1,61 @@
+﻿"""Profiles and captures shared by the processes of a service through PROFILING_DIR"""
+import os
+import time
+
+import pytest
+
+from common.profiling import SharedProfile, Watchdog
+
+def busy(seconds):
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        sum(range(1000))
+
+@pytest.fixture
+def child(tmp_path):
+    """Another process of the service, following the shared profile until it is told to leave"""
+    leave = tmp_path / 'leave'
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            profile = SharedProfile(str(tmp_path))
+            profile.follow()
+            while not leave.exists():
+                busy(0.05)
+            profile.leave()
+            status = 0
+        finally:
+            os._exit(status)
+    yield leave
+    leave.touch()
+    assert os.waitpid(pid, 0)[1] == 0
+
+def test_stop_merges_the_stacks_of_every_process(tmp_path, child):
+    profile = SharedProfile(str(tmp_path))
+    profile.follow()
+    try:
+        assert profile.start(0.005, 30)
+        assert not profile.start(0.005, 30)
+        busy(1)
+
+        stacks, samples, processes, _ = profile.stop()
+    finally:
+        profile.leave()
+
+    assert processes == 2
+    assert samples > 0 and sum(stacks.values()) > 0
+    assert any('busy' in stack for stack in stacks)
+    assert os.listdir(tmp_path / 'stacks') == []
+    assert profile.stop() is None
+
+def test_captures_are_found_by_any_process(tmp_path):
+    first, second = (Watchdog(0.005, 0, keep=2, directory=str(tmp_path)) for _ in range(2))
+    for capture_id in ('aa', 'bb', 'cc'):
+        first.store({'id': capture_id, 'pid': os.getpid()})
+        time.sleep(0.01)
+
+    assert [capture['id'] for capture in second.recent()] == ['cc', 'bb']
+    assert second.find('bb') == {'id': 'bb', 'pid': os.getpid()}
+    assert second.find('aa') is None
+    assert second.find('../session') is None